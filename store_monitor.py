@@ -1,21 +1,39 @@
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, FeatureNotFound, Tag
 import time
 import os
 import random
 import re
 import psycopg2
+import psycopg2.extensions
 from psycopg2 import pool
+from psycopg2.extras import execute_values
 import traceback
-from urllib.parse import urljoin, urlparse, urlunparse
+from urllib.parse import urljoin, urlparse, urlunparse, parse_qs
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from zoneinfo import ZoneInfo
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 import json
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from requests.utils import dict_from_cookiejar, cookiejar_from_dict
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import queue
+import atexit
+import asyncio
+import codecs
+import hashlib
+import html as html_lib
+import heapq
+import select
+import signal
+import socket
+import sys
+import itertools
+from requests.utils import dict_from_cookiejar
 
 # Correct stealth import
 # =========================================================
@@ -41,10 +59,14 @@ except Exception:
 PLAYWRIGHT_AVAILABLE = False
 try:
     from playwright.sync_api import sync_playwright
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
     PLAYWRIGHT_AVAILABLE = True
 except Exception:
     PLAYWRIGHT_AVAILABLE = False
 
+    class PlaywrightTimeoutError(Exception):
+        pass
+
 
 # =========================================================
 #  DECODO PROXY SUPPORT (requests + optional Playwright proxy)
@@ -201,19 +223,108 @@ CURRENT_ROLE_ID = None
 # =========================================================
 #  SESSION (requests) + retries/backoff
 # =========================================================
+# 429/503 are not retried in-thread: the rate limiter below defers the whole domain instead
 retry_strategy = Retry(
     total=1,
     backoff_factor=1,
-    status_forcelist=[429, 500, 502, 503, 504],
-    allowed_methods=frozenset(["GET", "POST"])
+    status_forcelist=[500, 502, 504],
+    allowed_methods=frozenset(["GET", "POST"]),
+    respect_retry_after_header=False,
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
+# One pool per host for every monitored shop, so concurrent checks keep their keep-alive connections
+adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=256, pool_maxsize=16)
 
 SESSION = requests.Session()
 SESSION.mount("http://", adapter)
 SESSION.mount("https://", adapter)
 
 DOMAIN_SESSIONS = {}
+DOMAIN_SESSIONS_LOCK = threading.Lock()
+
+
+# =========================================================
+#  PER-DOMAIN RATE LIMITING (token bucket + Retry-After)
+# =========================================================
+DOMAIN_REQUESTS_PER_SECOND = float(os.getenv("DOMAIN_REQUESTS_PER_SECOND", "2"))
+DOMAIN_BURST = int(os.getenv("DOMAIN_BURST", "5"))
+DOMAIN_RATE_OVERRIDES = {
+    # "example.co.uk": (0.5, 2),  # (checks per second, burst)
+}
+RATE_LIMIT_DEFAULT_BACKOFF = 30  # seconds, for a 429 without Retry-After
+RATE_LIMIT_MAX_BACKOFF = 900
+
+DOMAIN_BUCKETS = {}  # {domain: {"tokens", "updated", "blocked_until"}} on the monotonic clock
+DOMAIN_BUCKETS_LOCK = threading.Lock()
+
+
+def _bucket_for(domain, now):
+    bucket = DOMAIN_BUCKETS.get(domain)
+    if bucket is None:
+        bucket = {"tokens": float(DOMAIN_RATE_OVERRIDES.get(domain, (0, DOMAIN_BURST))[1]), "updated": now, "blocked_until": 0.0}
+        DOMAIN_BUCKETS[domain] = bucket
+    return bucket
+
+
+def take_domain_token(domain: str, now: float) -> float:
+    # Returns 0 when the check may start now, otherwise the monotonic time to try again
+    rate, burst = DOMAIN_RATE_OVERRIDES.get(domain, (DOMAIN_REQUESTS_PER_SECOND, DOMAIN_BURST))
+    with DOMAIN_BUCKETS_LOCK:
+        bucket = _bucket_for(domain, now)
+        if now < bucket["blocked_until"]:
+            return bucket["blocked_until"]
+        bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * rate)
+        bucket["updated"] = now
+        if bucket["tokens"] >= 1:
+            bucket["tokens"] -= 1
+            return 0
+        return now + (1 - bucket["tokens"]) / rate
+
+
+def throttle_domain(domain: str, seconds: float):
+    seconds = min(max(seconds, 1), RATE_LIMIT_MAX_BACKOFF)
+    now = time.monotonic()
+    with DOMAIN_BUCKETS_LOCK:
+        bucket = _bucket_for(domain, now)
+        if now + seconds > bucket["blocked_until"]:
+            bucket["blocked_until"] = now + seconds
+            bucket["tokens"] = 0
+            print(f" Rate limited by {domain}: pausing it for {seconds:.0f}s")
+
+
+def retry_after_seconds(headers):
+    value = headers.get("Retry-After")
+    if value:
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            return (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            pass
+    reset = headers.get("X-RateLimit-Reset") or headers.get("RateLimit-Reset")
+    if reset:
+        try:
+            reset = float(reset)
+        except ValueError:
+            return None
+        # Either an epoch timestamp or seconds until the window resets
+        return reset - time.time() if reset > 1e9 else reset
+    return None
+
+
+def rate_limit_hook(response, *args, **kwargs):
+    # requests response hook: 429/503 (or an exhausted X-RateLimit window) pauses the domain
+    headers = response.headers
+    wait_s = None
+    if response.status_code in (429, 503):
+        wait_s = retry_after_seconds(headers)
+        if wait_s is None and response.status_code == 429:
+            wait_s = RATE_LIMIT_DEFAULT_BACKOFF
+    elif (headers.get("X-RateLimit-Remaining") or headers.get("RateLimit-Remaining")) == "0":
+        wait_s = retry_after_seconds(headers)
+    if wait_s and wait_s > 0:
+        throttle_domain(_host_for_url(response.url), wait_s)
+    return response
 
 
 # =========================================================
@@ -365,19 +476,26 @@ STATE_DIR = 'states'
 os.makedirs(STATE_DIR, exist_ok=True)
 
 def get_session_for_domain(domain: str):
-    if domain not in DOMAIN_SESSIONS:
-        DOMAIN_SESSIONS[domain] = requests.Session()
-        DOMAIN_SESSIONS[domain].mount("http://", adapter)
-        DOMAIN_SESSIONS[domain].mount("https://", adapter)
-        cookie_file = os.path.join(DOMAIN_COOKIES_DIR, f"{domain}.json")
-        if os.path.exists(cookie_file):
-            try:
-                with open(cookie_file, 'r') as f:
-                    cookies = json.load(f)
-                for cookie in cookies:
-                    DOMAIN_SESSIONS[domain].cookies.set(**cookie)
-            except:
-                pass
+    session = DOMAIN_SESSIONS.get(domain)
+    if session is not None:
+        return session
+    with DOMAIN_SESSIONS_LOCK:
+        if domain not in DOMAIN_SESSIONS:
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.hooks["response"].append(rate_limit_hook)
+            session.hooks["response"].append(note_connection_use)
+            cookie_file = os.path.join(DOMAIN_COOKIES_DIR, f"{domain}.json")
+            if os.path.exists(cookie_file):
+                try:
+                    with open(cookie_file, 'r') as f:
+                        cookies = json.load(f)
+                    for cookie in cookies:
+                        session.cookies.set(**cookie)
+                except:
+                    pass
+            DOMAIN_SESSIONS[domain] = session
     return DOMAIN_SESSIONS[domain]
 
 
@@ -399,110 +517,551 @@ def clear_cookies_for_domain(domain: str):
         os.remove(state_file)
     if domain in DOMAIN_SESSIONS:
         DOMAIN_SESSIONS[domain].cookies.clear()
+    mark_playwright_domain_stale(domain)
+
+
+# Per-URL validators from the last fully classified response: {url: {"etag", "last_modified", "body_hash", "fingerprint"}}
+VALIDATOR_CACHE = {}
+
+
+def body_hash(html: str) -> str:
+    return hashlib.blake2b(html.encode("utf-8", "replace"), digest_size=16).hexdigest()
+
+
+# Streaming reads: stop at the byte budget, or once a complete JSON-LD offer has arrived - except that
+# a short tail of known length is drained so the keep-alive connection goes back to the pool
+STREAM_FETCH = os.getenv("STREAM_FETCH", "1") == "1"
+STREAM_CHUNK_BYTES = 64 * 1024
+STREAM_EARLY_STOP_MIN_BYTES = int(os.getenv("STREAM_EARLY_STOP_MIN_BYTES", str(256 * 1024)))
+FETCH_BYTE_BUDGET = int(os.getenv("FETCH_BYTE_BUDGET", str(2 * 1024 * 1024)))
+DOMAIN_BYTE_BUDGET_OVERRIDES = {
+    # "example.co.uk": 4 * 1024 * 1024,
+}
+
+
+def body_bytes_remaining(r):
+    # Wire bytes still unread, or None when the length isn't known up front (chunked responses)
+    length = r.headers.get("Content-Length", "")
+    if not length.isdigit():
+        return None
+    try:
+        return int(length) - r.raw.tell()
+    except Exception:
+        return None
+
+
+def read_body_streaming(r, domain: str) -> str:
+    budget = DOMAIN_BYTE_BUDGET_OVERRIDES.get(domain, FETCH_BYTE_BUDGET)
+    try:
+        decoder = codecs.getincrementaldecoder(r.encoding or "utf-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    parts = []
+    received = 0
+    tail = ""
+    saw_json_ld = False
+    complete = True
+    chunks = r.iter_content(STREAM_CHUNK_BYTES)
+    for chunk in chunks:
+        received += len(chunk)
+        piece = decoder.decode(chunk)
+        parts.append(piece)
+        if received >= budget:
+            complete = False
+            break
+        window = (tail + piece).lower()
+        tail = piece[-16:]
+        saw_json_ld = saw_json_ld or "ld+json" in window
+        if saw_json_ld and "</script" in window and extract_structured_offer("".join(parts), r.url):
+            remaining = body_bytes_remaining(r)
+            if remaining is None or remaining >= STREAM_EARLY_STOP_MIN_BYTES:
+                complete = False
+                break
+            # Cheaper to drain a short known tail than to pay a new TCP+TLS handshake next check
+            for chunk in chunks:
+                received += len(chunk)
+                if received >= budget:
+                    complete = False
+                    break
+            break
+    if complete:
+        parts.append(decoder.decode(b"", final=True))
+    else:
+        # The rest of the body is never read, so the connection can't go back to the pool
+        r.close()
+    return "".join(parts)
 
 
-def fetch_html_requests(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str):
+def fetch_html_requests(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str, validators: dict = None):
+    # validators: sent as If-None-Match / If-Modified-Since, then refreshed from the response in place
     session = get_session_for_domain(domain)
     proxies = proxies_for_url(url) if use_proxy else None
+    if validators:
+        headers = dict(headers)
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    hedge_delay = hedge_delay_for_domain(domain)
+    if hedge_delay is None:
+        status_code, final_url, text, response_headers = _fetch_once(session, url, headers, timeout_s, proxies, domain)
+    else:
+        status_code, final_url, text, response_headers = fetch_hedged(session, url, headers, timeout_s, proxies, domain, hedge_delay)
+    if validators is not None:
+        if response_headers.get("ETag"):
+            validators["etag"] = response_headers["ETag"]
+        if response_headers.get("Last-Modified"):
+            validators["last_modified"] = response_headers["Last-Modified"]
+    return status_code, final_url, text
+
+
+def _fetch_once(session, url, headers, timeout_s, proxies, domain):
     r = session.get(
         url,
         headers=headers,
         timeout=timeout_s,
         proxies=proxies,
+        stream=STREAM_FETCH,
     )
-    return r.status_code, r.url, r.text
+    if STREAM_FETCH and r.status_code == 200:
+        return r.status_code, r.url, read_body_streaming(r, domain), r.headers
+    return r.status_code, r.url, r.text, r.headers
 
 
-def fetch_html_playwright(url: str, timeout_ms: int, use_proxy: bool, domain: str):
-    state_file = os.path.join(DOMAIN_STATE_DIR, f"{domain}.json")
+# =========================================================
+#  HEDGED REQUESTS (second request after the domain's p95)
+# =========================================================
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+HEDGE_MIN_SAMPLES = 20  # no hedging until the domain's p95 is meaningful
+HEDGE_MIN_DELAY = 0.5
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.1"))  # extra requests per request, per domain
+HEDGE_WINDOW = 200  # requests per domain before the budget counters are halved
 
-    launch_kwargs = {
-        "headless": True,
-    }
+HEDGE_EXECUTOR = None
+HEDGE_EXECUTOR_LOCK = threading.Lock()
+HEDGE_BUDGETS = {}  # {domain: {"requests": n, "hedges": n}}
+HEDGE_BUDGETS_LOCK = threading.Lock()
+
+
+def hedge_delay_for_domain(domain: str):
+    if not HEDGE_REQUESTS:
+        return None
+    latencies = DOMAIN_HEALTH.get(domain, {}).get('latency', [])
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return max(HEDGE_MIN_DELAY, latency_percentile(latencies, 0.95))
+
+
+def take_hedge_budget(domain: str, hedge: bool) -> bool:
+    with HEDGE_BUDGETS_LOCK:
+        budget = HEDGE_BUDGETS.setdefault(domain, {"requests": 0, "hedges": 0})
+        if not hedge:
+            budget["requests"] += 1
+            if budget["requests"] > HEDGE_WINDOW:
+                budget["requests"] //= 2
+                budget["hedges"] //= 2
+            return True
+        if budget["hedges"] + 1 > budget["requests"] * HEDGE_BUDGET_RATIO:
+            return False
+        budget["hedges"] += 1
+        return True
+
+
+def get_hedge_executor():
+    global HEDGE_EXECUTOR
+    with HEDGE_EXECUTOR_LOCK:
+        if HEDGE_EXECUTOR is None:
+            HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=FETCH_MAX_IN_FLIGHT * 2, thread_name_prefix="hedge")
+        return HEDGE_EXECUTOR
+
+
+def _hedge_session(session):
+    # Fresh connection pool, same cookies: a stalled keep-alive connection can't slow the hedge too
+    hedge_session = requests.Session()
+    hedge_adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=1, pool_maxsize=1)
+    hedge_session.mount("http://", hedge_adapter)
+    hedge_session.mount("https://", hedge_adapter)
+    hedge_session.hooks["response"].append(rate_limit_hook)
+    hedge_session.cookies.update(session.cookies)
+    return hedge_session
+
+
+def fetch_hedged(session, url, headers, timeout_s, proxies, domain, delay):
+    take_hedge_budget(domain, hedge=False)
+    executor = get_hedge_executor()
+    primary = executor.submit(_fetch_once, session, url, headers, timeout_s, proxies, domain)
+    try:
+        return primary.result(timeout=delay)
+    except FutureTimeoutError:
+        pass
+    if not take_hedge_budget(domain, hedge=True):
+        return primary.result()
+
+    hedge_session = _hedge_session(session)
+    hedge = executor.submit(_fetch_once, hedge_session, url, headers, timeout_s, proxies, domain)
+    hedge.add_done_callback(lambda f: hedge_session.close())
+    # First successful response wins; the loser finishes in the background and is dropped
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+    return primary.result()
+
+
+def stop_hedge_executor():
+    global HEDGE_EXECUTOR
+    with HEDGE_EXECUTOR_LOCK:
+        if HEDGE_EXECUTOR is not None:
+            HEDGE_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+            HEDGE_EXECUTOR = None
+
+
+atexit.register(stop_hedge_executor)
+
+
+# =========================================================
+#  PLAYWRIGHT BROWSER POOL (long-lived browsers + per-domain contexts)
+# =========================================================
+PW_POOL_SIZE = int(os.getenv("PW_POOL_SIZE", "2"))
+PW_MAX_PAGES_PER_BROWSER = int(os.getenv("PW_MAX_PAGES_PER_BROWSER", "40"))
+PW_MAX_CONTEXTS_PER_BROWSER = int(os.getenv("PW_MAX_CONTEXTS_PER_BROWSER", "6"))
+PW_MAX_RSS_MB = int(os.getenv("PW_MAX_RSS_MB", "750"))  # per browser (its own Chromium processes, PSS)
+PW_RECYCLE_LOCK = threading.Lock()  # memory recycles happen one browser at a time
+
+PW_LAUNCH_ARGS = [
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-http2",
+    "--disable-quic",
+    "--disable-blink-features=AutomationControlled",
+    "--disable-gpu",
+    "--disable-infobars",
+    "--window-size=1920,1080",
+]
+
+PW_CONSENT_SELECTORS = [
+    "#onetrust-accept-btn-handler",
+    "button:has-text('Accept all')",
+    "button:has-text('Accept All')",
+    "button:has-text('Accept')",
+    "[aria-label*='accept']",
+]
+
+PW_PRIORITY_VERIFY = 0
+PW_PRIORITY_NORMAL = 1
+PW_PRIORITY_SHUTDOWN = 9
+PW_TIMEOUT_STATUS = -1  # status returned when the page itself timed out, so it counts as a latency sample
+
+PW_JOBS = queue.PriorityQueue()  # (priority, seq, job) - verifications jump the sweep
+PW_JOB_SEQ = itertools.count()
+PW_WORKERS = []
+PW_POOL_LOCK = threading.Lock()
+PW_DOMAIN_GENERATION = {}  # {domain: n} - bumped when cached contexts must be dropped (e.g. after a block)
 
+
+def _process_memory_kb(pid) -> float:
+    # PSS splits shared pages between the processes mapping them, so Chromium's shared memory isn't counted
+    # once per process; RSS is the fallback on kernels without smaps_rollup
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return float(line.split()[1])
+    except Exception:
+        pass
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024
+    except Exception:
+        return 0.0
+
+
+def _process_tree_mb(root_pids=None, marker=None) -> float:
+    # Memory of root_pids (default: this process), or of processes whose command line holds marker,
+    # plus all their descendants
+    try:
+        parents = {}
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f'/proc/{pid}/stat', 'r') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                parents[int(pid)] = int(fields[1])
+            except Exception:
+                continue
+        if marker:
+            tree = set()
+            for pid in parents:
+                try:
+                    with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                        if marker.encode() in f.read():
+                            tree.add(pid)
+                except Exception:
+                    continue
+        else:
+            tree = set(root_pids or {os.getpid()})
+        changed = True
+        while changed:
+            changed = False
+            for pid, ppid in parents.items():
+                if ppid in tree and pid not in tree:
+                    tree.add(pid)
+                    changed = True
+        return sum(_process_memory_kb(pid) for pid in tree) / 1024
+    except Exception:
+        return 0.0
+
+
+def mark_playwright_domain_stale(domain: str):
+    # Every worker compares its own contexts against this, so all of them drop the blocked state
+    with PW_POOL_LOCK:
+        PW_DOMAIN_GENERATION[domain] = PW_DOMAIN_GENERATION.get(domain, 0) + 1
+
+
+def _pw_generation(domain):
+    return PW_DOMAIN_GENERATION.get(domain, 0)
+
+
+def _pw_close_context(domain, context, save_state=True, generation=None):
+    # A context from an older generation holds state that was cleared on purpose - never write it back
+    if save_state and (generation is None or generation == _pw_generation(domain)):
+        try:
+            context.storage_state(path=os.path.join(STATE_DIR, f"{domain}.json"))
+        except Exception:
+            pass
+    try:
+        context.close()
+    except Exception:
+        pass
+
+
+def _pw_new_context(browser, domain, proxy_cfg):
+    state_file = os.path.join(STATE_DIR, f"{domain}.json")
     context_kwargs = {
+        "user_agent": random.choice(REAL_UAS),
+        "viewport": {"width": 1920, "height": 1080},
+        "java_script_enabled": True,
+        "locale": "en-GB",
+        "timezone_id": "Europe/London",
         "ignore_https_errors": True,
         "bypass_csp": True,
     }
-
     if os.path.exists(state_file):
-        try:
-            context_kwargs["storage_state"] = state_file
-        except Exception:
-            pass
+        context_kwargs["storage_state"] = state_file
+    if proxy_cfg:
+        context_kwargs["proxy"] = proxy_cfg
 
-    with sync_playwright() as p:
-        browser = None
-        try:
-            browser = p.chromium.launch(**launch_kwargs)
-            context = browser.new_context(**context_kwargs)
-            page = context.new_page()
-
-            if STEALTH_AVAILABLE and stealth:
-                stealth(page)
-
-            consent_selectors = [
-                "#onetrust-accept-btn-handler",
-                "button:has-text('Accept all')",
-                "button:has-text('Accept All')",
-                "button:has-text('Accept')",
-                "[aria-label*='accept']",
-            ]
-            for sel in consent_selectors:
-                try:
-                    btn = page.locator(sel).first
-                    if btn.is_visible(timeout=3000):
-                        btn.click(timeout=5000)
-                        time.sleep(1.5)
-                        break
-                except Exception:
-                    continue
+    context = browser.new_context(**context_kwargs)
+
+    def route_filter(route):
+        rt = route.request.resource_type
+        if rt in ("media", "font"):
+            return route.abort()
+        return route.continue_()
+
+    context.route("**/*", route_filter)
+    return context
+
+
+def _pw_fetch_page(context, url, timeout_ms, domain, generation=None):
+    page = context.new_page()
+    try:
+        if STEALTH_AVAILABLE and stealth:
+            stealth(page)
+
+        time.sleep(random.uniform(0.2, 0.8))
+
+        resp = page.goto(url, wait_until="domcontentloaded", timeout=timeout_ms)
+        status = resp.status if resp else 0
+
+        for sel in PW_CONSENT_SELECTORS:
+            try:
+                btn = page.locator(sel).first
+                if btn.is_visible(timeout=1000):
+                    btn.click(timeout=3000)
+                    time.sleep(1.0)
+                    break
+            except Exception:
+                continue
 
-            def route_filter(route):
-                rt = route.request.resource_type
-                if rt in ("media", "font"):
-                    return route.abort()
-                return route.continue_()
+        html = page.content() or ""
+        final_url = page.url
 
-            page.route("**/*", route_filter)
+        if generation is None or generation == _pw_generation(domain):
+            try:
+                context.storage_state(path=os.path.join(STATE_DIR, f"{domain}.json"))
+            except Exception:
+                pass
 
-            time.sleep(random.uniform(0.5, 1.5))
+        return status, final_url, html
+    finally:
+        try:
+            page.close()
+        except Exception:
+            pass
 
-            resp = page.goto(url, wait_until="domcontentloaded", timeout=timeout_ms)
-            status = resp.status if resp else 0
-            html = page.content() or ""
-            final_url = page.url
 
+def _pw_worker_loop(worker_id):
+    playwright = None
+    browser = None
+    contexts = {}  # {(domain, proxied): (context, generation)}, insertion order = LRU order
+    pages_served = 0
+    # Chromium ignores unknown switches; this one lets the worker find its own browser processes
+    browser_marker = f"--stockcheck-pw-worker={os.getpid()}-{worker_id}"
+
+    def shutdown_browser():
+        nonlocal browser, pages_served
+        for (ctx_domain, _), (ctx, ctx_generation) in list(contexts.items()):
+            _pw_close_context(ctx_domain, ctx, generation=ctx_generation)
+        contexts.clear()
+        if browser:
             try:
-                with open(state_file, "w") as f:
-                    json.dump(context.storage_state(), f)
+                browser.close()
             except Exception:
                 pass
+        browser = None
+        pages_served = 0
+
+    try:
+        playwright = sync_playwright().start()
+    except Exception as e:
+        print(f" Playwright worker {worker_id} failed to start: {str(e)[:120]}")
+        playwright = None
 
-            return status, final_url, html
+    while True:
+        _, _, job = PW_JOBS.get()
+        if job is None:
+            break
+        url, timeout_ms, use_proxy, domain, future = job
+        if not future.set_running_or_notify_cancel():
+            continue
+        if playwright is None:
+            future.set_result((0, url, ""))
+            continue
 
+        try:
+            generation = _pw_generation(domain)
+            for key in [k for k, (_, g) in contexts.items() if k[0] == domain and g != generation]:
+                _pw_close_context(domain, contexts.pop(key)[0], save_state=False)
+
+            if browser is None or not browser.is_connected():
+                contexts.clear()
+                browser = playwright.chromium.launch(headless=True, args=PW_LAUNCH_ARGS + [browser_marker])
+                pages_served = 0
+
+            proxy_cfg = playwright_proxy_for_url(url) if use_proxy else None
+            key = (domain, bool(proxy_cfg))
+            context, _ = contexts.pop(key, (None, None))
+            if context is None:
+                context = _pw_new_context(browser, domain, proxy_cfg)
+            contexts[key] = (context, generation)
+            while len(contexts) > PW_MAX_CONTEXTS_PER_BROWSER:
+                old_key = next(iter(contexts))
+                old_context, old_generation = contexts.pop(old_key)
+                _pw_close_context(old_key[0], old_context, generation=old_generation)
+
+            result = _pw_fetch_page(context, url, timeout_ms, domain, generation)
+            pages_served += 1
+            future.set_result(result)
+        except PlaywrightTimeoutError:
+            pages_served += 1
+            future.set_result((PW_TIMEOUT_STATUS, url, ""))
         except Exception as e:
             print(f" Playwright error on {url}: {str(e)[:120]}")
-            return 0, url, ""
-
-        finally:
-            if browser:
+            future.set_result((0, url, ""))
+            # A crashed page can leave the browser wedged - start clean next time
+            shutdown_browser()
+            continue
+
+        if pages_served >= PW_MAX_PAGES_PER_BROWSER:
+            print(f" Playwright worker {worker_id}: recycling browser after {pages_served} pages")
+            shutdown_browser()
+        elif PW_MAX_RSS_MB and _process_tree_mb(marker=browser_marker) > PW_MAX_RSS_MB:
+            # If another worker is mid-recycle this one waits for its next page, so the pool never goes cold at once
+            if PW_RECYCLE_LOCK.acquire(blocking=False):
                 try:
-                    browser.close()
-                except Exception:
-                    pass
+                    print(f" Playwright worker {worker_id}: browser memory above {PW_MAX_RSS_MB}MB, recycling it")
+                    shutdown_browser()
+                finally:
+                    PW_RECYCLE_LOCK.release()
+
+    shutdown_browser()
+    if playwright:
+        try:
+            playwright.stop()
+        except Exception:
+            pass
+
+
+def start_playwright_pool():
+    if not PLAYWRIGHT_AVAILABLE:
+        return
+    with PW_POOL_LOCK:
+        PW_WORKERS[:] = [t for t in PW_WORKERS if t.is_alive()]
+        while len(PW_WORKERS) < PW_POOL_SIZE:
+            worker_id = len(PW_WORKERS) + 1
+            t = threading.Thread(target=_pw_worker_loop, args=(worker_id,), name=f"pw-worker-{worker_id}", daemon=True)
+            t.start()
+            PW_WORKERS.append(t)
+
+
+def stop_playwright_pool(timeout_s=30):
+    with PW_POOL_LOCK:
+        workers = list(PW_WORKERS)
+        PW_WORKERS.clear()
+    for _ in workers:
+        PW_JOBS.put((PW_PRIORITY_SHUTDOWN, next(PW_JOB_SEQ), None))
+    for t in workers:
+        t.join(timeout=timeout_s)
+
+
+def fetch_html_playwright(url: str, timeout_ms: int, use_proxy: bool, domain: str, priority: int = PW_PRIORITY_NORMAL):
+    if not PLAYWRIGHT_AVAILABLE:
+        return 0, url, ""
+    start_playwright_pool()
+    future = Future()
+    PW_JOBS.put((priority, next(PW_JOB_SEQ), (url, timeout_ms, use_proxy, domain, future)))
+    try:
+        # Leave headroom for queueing behind other pages plus consent handling
+        return future.result(timeout=timeout_ms / 1000 * 3 + 30)
+    except Exception:
+        future.cancel()
+        print(f" Playwright error on {url}: no worker response")
+        return 0, url, ""
+
+
+atexit.register(stop_playwright_pool)
 
-def fetch_html(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str):
+
+def fetch_html(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str, priority: int = PW_PRIORITY_NORMAL, validators: dict = None):
     timeout_s = min(timeout_s, MAX_TIMEOUT)
     if should_use_playwright(url) and PLAYWRIGHT_AVAILABLE:
-        return fetch_html_playwright(url, timeout_ms=timeout_s * 1000, use_proxy=use_proxy, domain=domain)
-    return fetch_html_requests(url, headers=headers, timeout_s=timeout_s, use_proxy=use_proxy, domain=domain)
+        return fetch_html_playwright(url, timeout_ms=timeout_s * 1000, use_proxy=use_proxy, domain=domain, priority=priority)
+    return fetch_html_requests(url, headers=headers, timeout_s=timeout_s, use_proxy=use_proxy, domain=domain, validators=validators)
 
 
 # =========================================================
 #  DATABASE
 # =========================================================
-DB_LOCK = threading.Lock()
+DB_POOL_MIN = 1
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_CHECKOUT_TIMEOUT = 10  # seconds to wait for a free pooled connection
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+DB_HEALTHCHECK_IDLE_SECONDS = 30  # ping connections that sat idle longer than this
+
+DB_POOL_SLOTS = threading.BoundedSemaphore(DB_POOL_MAX)
+DB_CONN_LAST_USED = {}  # {id(conn): monotonic time it was returned}
+DB_CONNECT_KWARGS = {
+    "connect_timeout": 10,
+    "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 3,
+}
 
 
 def init_db_pool():
@@ -513,7 +1072,7 @@ def init_db_pool():
         return False
     if DB_POOL is None:
         try:
-            DB_POOL = pool.SimpleConnectionPool(1, 10, DATABASE_URL, connect_timeout=10)
+            DB_POOL = pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, **DB_CONNECT_KWARGS)
             print(" Database pool initialized")
             return True
         except Exception as e:
@@ -522,19 +1081,87 @@ def init_db_pool():
     return True
 
 
+def _connection_is_healthy(conn):
+    if conn.closed or conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    last_used = DB_CONN_LAST_USED.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE_SECONDS:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
 def get_db_connection():
-    global DB_POOL
-    if DB_POOL:
-        return DB_POOL.getconn()
-    return psycopg2.connect(DATABASE_URL)
+    if DB_POOL is None:
+        return psycopg2.connect(DATABASE_URL, **DB_CONNECT_KWARGS)
+    if not DB_POOL_SLOTS.acquire(timeout=DB_CHECKOUT_TIMEOUT):
+        raise pool.PoolError("timed out waiting for a database connection")
+    try:
+        for _ in range(DB_POOL_MAX + 1):
+            conn = DB_POOL.getconn()
+            if _connection_is_healthy(conn):
+                return conn
+            DB_CONN_LAST_USED.pop(id(conn), None)
+            DB_POOL.putconn(conn, close=True)
+        raise psycopg2.OperationalError("no healthy database connection available")
+    except Exception:
+        DB_POOL_SLOTS.release()
+        raise
 
 
-def return_db_connection(conn):
-    global DB_POOL
-    if DB_POOL and conn:
-        DB_POOL.putconn(conn)
-    elif conn:
+def return_db_connection(conn, discard=False):
+    if not conn:
+        return
+    if DB_POOL is None:
         conn.close()
+        return
+    discard = discard or conn.closed
+    if discard:
+        DB_CONN_LAST_USED.pop(id(conn), None)
+    else:
+        DB_CONN_LAST_USED[id(conn)] = time.monotonic()
+    try:
+        DB_POOL.putconn(conn, close=discard)
+    finally:
+        DB_POOL_SLOTS.release()
+
+
+def run_db(operation, retries=1, timeout_ms=None):
+    # Runs operation(cursor) in one transaction on a pooled connection.
+    # Dropped connections (SSL resets, server restarts) are discarded and retried.
+    for attempt in range(retries + 1):
+        conn = None
+        try:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            if timeout_ms:
+                cur.execute("SET LOCAL statement_timeout = %s", (int(timeout_ms),))
+            result = operation(cur)
+            conn.commit()
+            cur.close()
+            return_db_connection(conn)
+            return result
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if conn:
+                return_db_connection(conn, discard=True)
+            if attempt >= retries:
+                raise
+            time.sleep(1)
+        except Exception:
+            if conn:
+                try:
+                    conn.rollback()
+                except Exception:
+                    return_db_connection(conn, discard=True)
+                    raise
+                return_db_connection(conn)
+            raise
 
 
 def init_database():
@@ -569,6 +1196,13 @@ def init_database():
                 last_ping TEXT
             )
         """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS domain_platforms (
+                domain TEXT PRIMARY KEY,
+                platform TEXT NOT NULL,
+                detected_at TIMESTAMPTZ DEFAULT NOW()
+            )
+        """)
         cur.execute("""
             CREATE TABLE IF NOT EXISTS monitored_urls (
                 url TEXT NOT NULL,
@@ -577,6 +1211,7 @@ def init_database():
                 PRIMARY KEY (url, file_group)
             )
         """)
+        cur.execute(MONITORED_URLS_NOTIFY_SQL)
         conn.commit()
         cur.close()
         return_db_connection(conn)
@@ -585,7 +1220,7 @@ def init_database():
     except Exception as e:
         print(f" Database error: {e}")
         if conn:
-            return_db_connection(conn)
+            return_db_connection(conn, discard=True)
         return False
 
 
@@ -594,107 +1229,81 @@ def load_ping_state():
     if not DATABASE_URL:
         print(" Skipping ping state load (no DATABASE_URL).")
         return
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+
+    def read(cur):
         cur.execute("SELECT ping_type, last_ping FROM ping_state")
-        rows = cur.fetchall()
-        for ping_type, last_ping in rows:
+        return cur.fetchall()
+
+    try:
+        for ping_type, last_ping in run_db(read):
             if ping_type == "hourly":
                 LAST_HOURLY_PING = last_ping
             elif ping_type == "daily":
                 LAST_DAILY_PING = last_ping
-        cur.close()
-        return_db_connection(conn)
         if LAST_HOURLY_PING or LAST_DAILY_PING:
             print(f" Loaded ping state: hourly={LAST_HOURLY_PING}, daily={LAST_DAILY_PING}")
     except Exception as e:
         print(f" Error loading ping state: {e}")
-        if conn:
-            return_db_connection(conn)
 
 
 def save_ping_state(ping_type, value):
     if not DATABASE_URL:
         return
-    for attempt in range(3):
-        conn = None
-        try:
-            with DB_LOCK:
-                conn = get_db_connection()
-                cur = conn.cursor()
-                cur.execute("""
-                    INSERT INTO ping_state (ping_type, last_ping)
-                    VALUES (%s, %s)
-                    ON CONFLICT (ping_type) DO UPDATE SET last_ping = EXCLUDED.last_ping
-                """, (ping_type, value))
-                conn.commit()
-                cur.close()
-                return_db_connection(conn)
-            return
-        except Exception as e:
-            if conn:
-                try:
-                    conn.close()
-                except:
-                    pass
-            if attempt < 2:
-                time.sleep(1)
-                init_db_pool()
-            else:
-                print(f" Error saving ping state: {e}")
+
+    def write(cur):
+        cur.execute("""
+            INSERT INTO ping_state (ping_type, last_ping)
+            VALUES (%s, %s)
+            ON CONFLICT (ping_type) DO UPDATE SET last_ping = EXCLUDED.last_ping
+        """, (ping_type, value))
+
+    try:
+        run_db(write, retries=2)
+    except Exception as e:
+        print(f" Error saving ping state: {e}")
 
 
 def sync_urls_to_db():
     if not DATABASE_URL:
         return
-    conn = None
+
+    def sync(cur):
+        total_added = 0
+        total_removed = 0
+        for franchise in FRANCHISES:
+            for file_path in franchise.get("direct_files", []):
+                file_urls = set()
+                try:
+                    with open(file_path, "r") as f:
+                        for line in f:
+                            line = line.strip()
+                            if line and line.startswith("http"):
+                                file_urls.add(line.split()[0])
+                except FileNotFoundError:
+                    continue
+                cur.execute("SELECT url FROM monitored_urls WHERE file_group = %s", (file_path,))
+                db_urls = set(row[0] for row in cur.fetchall())
+                new_urls = file_urls - db_urls
+                removed_urls = db_urls - file_urls
+                for url in new_urls:
+                    cur.execute(
+                        "INSERT INTO monitored_urls (url, file_group) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                        (url, file_path)
+                    )
+                    total_added += 1
+                for url in removed_urls:
+                    cur.execute("DELETE FROM monitored_urls WHERE url = %s AND file_group = %s", (url, file_path))
+                    total_removed += 1
+        return total_added, total_removed
+
     try:
-        with DB_LOCK:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            total_added = 0
-            total_removed = 0
-            for franchise in FRANCHISES:
-                for file_path in franchise.get("direct_files", []):
-                    file_urls = set()
-                    try:
-                        with open(file_path, "r") as f:
-                            for line in f:
-                                line = line.strip()
-                                if line and line.startswith("http"):
-                                    file_urls.add(line.split()[0])
-                    except FileNotFoundError:
-                        continue
-                    cur.execute("SELECT url FROM monitored_urls WHERE file_group = %s", (file_path,))
-                    db_urls = set(row[0] for row in cur.fetchall())
-                    new_urls = file_urls - db_urls
-                    removed_urls = db_urls - file_urls
-                    for url in new_urls:
-                        cur.execute(
-                            "INSERT INTO monitored_urls (url, file_group) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                            (url, file_path)
-                        )
-                        total_added += 1
-                    for url in removed_urls:
-                        cur.execute("DELETE FROM monitored_urls WHERE url = %s AND file_group = %s", (url, file_path))
-                        total_removed += 1
-            conn.commit()
-            cur.close()
-            return_db_connection(conn)
+        total_added, total_removed = run_db(sync)
         if total_added > 0 or total_removed > 0:
             print(f" URL sync: {total_added} added, {total_removed} removed")
         else:
             print(f" URL sync: all up to date")
     except Exception as e:
         print(f" URL sync error: {e}")
-        if conn:
-            try:
-                conn.rollback()
-            except:
-                pass
-            return_db_connection(conn)
 
 
 def load_urls(file_list):
@@ -711,35 +1320,157 @@ def load_urls(file_list):
     return list(all_urls)
 
 
-def load_urls_from_db(file_path):
-    if not DATABASE_URL:
-        return load_urls([file_path])
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT url FROM monitored_urls WHERE file_group = %s", (file_path,))
-        urls = [row[0] for row in cur.fetchall()]
-        cur.close()
-        return_db_connection(conn)
-        return urls
-    except Exception as e:
-        print(f" DB URL load error, falling back to file: {e}")
-        if conn:
-            return_db_connection(conn)
-        return load_urls([file_path])
+# =========================================================
+#  MONITORED URL SET (in memory, hot-reloaded via LISTEN/NOTIFY)
+# =========================================================
+URL_NOTIFY_CHANNEL = "monitored_urls_changed"
+MONITORED_URLS_NOTIFY_SQL = f"""
+    CREATE OR REPLACE FUNCTION notify_monitored_urls_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('{URL_NOTIFY_CHANNEL}', json_build_object('op', TG_OP, 'url', OLD.url, 'file_group', OLD.file_group)::text);
+        ELSE
+            PERFORM pg_notify('{URL_NOTIFY_CHANNEL}', json_build_object('op', TG_OP, 'url', NEW.url, 'file_group', NEW.file_group)::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    CREATE OR REPLACE TRIGGER monitored_urls_notify
+        AFTER INSERT OR UPDATE OR DELETE ON monitored_urls
+        FOR EACH ROW EXECUTE FUNCTION notify_monitored_urls_changed();
+"""
+
+MONITORED_URLS = {}  # {file_group: set(urls)}
+MONITORED_URLS_LOCK = threading.Lock()
+URL_LIST_VERSION = 0  # bumped on every change, so the scheduler only rebuilds when something moved
+URL_FILE_MTIMES = {}
+URL_LISTENER_THREAD = None
+URL_LISTENER_STOP = threading.Event()
+
+
+def _replace_monitored_urls(groups):
+    global URL_LIST_VERSION
+    with MONITORED_URLS_LOCK:
+        if groups != MONITORED_URLS:
+            MONITORED_URLS.clear()
+            MONITORED_URLS.update(groups)
+            URL_LIST_VERSION += 1
+
+
+def load_monitored_urls():
+    file_groups = [fp for franchise in FRANCHISES for fp in franchise.get("direct_files", [])]
+    groups = {fp: set() for fp in file_groups}
+    if DATABASE_URL:
+        def read(cur):
+            cur.execute("SELECT file_group, url FROM monitored_urls")
+            return cur.fetchall()
 
+        try:
+            for file_group, url in run_db(read):
+                if file_group in groups:
+                    groups[file_group].add(url)
+            _replace_monitored_urls(groups)
+            return
+        except Exception as e:
+            print(f" DB URL load error, falling back to files: {e}")
+    for fp in file_groups:
+        groups[fp] = set(load_urls([fp]))
+    _replace_monitored_urls(groups)
 
-def load_direct_state():
-    direct_state = {}
-    if not DATABASE_URL:
-        return direct_state
-    conn = None
+
+def monitored_urls_snapshot():
+    with MONITORED_URLS_LOCK:
+        return URL_LIST_VERSION, {fp: set(urls) for fp, urls in MONITORED_URLS.items()}
+
+
+def apply_url_notification(payload: str):
+    global URL_LIST_VERSION
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+        change = json.loads(payload)
+        op, url, file_group = change["op"], change["url"], change["file_group"]
+    except (ValueError, KeyError, TypeError):
+        load_monitored_urls()
+        return
+    if op == "UPDATE":
+        load_monitored_urls()
+        return
+    with MONITORED_URLS_LOCK:
+        urls = MONITORED_URLS.get(file_group)
+        if urls is None:
+            return
+        if op == "INSERT" and url not in urls:
+            urls.add(url)
+            URL_LIST_VERSION += 1
+            print(f" URL added: {url} -> {file_group}")
+        elif op == "DELETE" and url in urls:
+            urls.discard(url)
+            URL_LIST_VERSION += 1
+            print(f" URL removed: {url} <- {file_group}")
+
+
+def _url_listener_loop():
+    backoff = 1
+    while not URL_LISTENER_STOP.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL, **DB_CONNECT_KWARGS)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {URL_NOTIFY_CHANNEL}")
+            # Anything committed while we were disconnected never reaches us as a notification
+            load_monitored_urls()
+            backoff = 1
+            while not URL_LISTENER_STOP.is_set():
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    apply_url_notification(conn.notifies.pop(0).payload)
+        except Exception as e:
+            print(f" URL listener error, reconnecting in {backoff}s: {str(e)[:80]}")
+            URL_LISTENER_STOP.wait(backoff)
+            backoff = min(backoff * 2, 60)
+        finally:
+            if conn:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+
+def start_url_listener():
+    global URL_LISTENER_THREAD
+    if not DATABASE_URL or URL_LISTENER_THREAD is not None:
+        return
+    URL_LISTENER_THREAD = threading.Thread(target=_url_listener_loop, name="url-listener", daemon=True)
+    URL_LISTENER_THREAD.start()
+
+
+def url_files_changed() -> bool:
+    changed = False
+    for franchise in FRANCHISES:
+        for file_path in franchise.get("direct_files", []):
+            try:
+                mtime = os.stat(file_path).st_mtime
+            except OSError:
+                mtime = None
+            if URL_FILE_MTIMES.get(file_path, -1) != mtime:
+                URL_FILE_MTIMES[file_path] = mtime
+                changed = True
+    return changed
+
+
+def load_direct_state():
+    direct_state = {}
+    if not DATABASE_URL:
+        return direct_state
+
+    def read(cur):
         cur.execute("SELECT product_url, product_name, in_stock, stock_status, last_alerted, last_error, last_checked FROM product_state WHERE store_url = product_url")
-        rows = cur.fetchall()
+        return cur.fetchall()
+
+    try:
+        rows = run_db(read)
         for url, name, in_stock, stock_status, last_alerted, last_error, last_checked in rows:
             direct_state[url] = {
                 "name": name or "",
@@ -749,75 +1480,191 @@ def load_direct_state():
                 "last_error": last_error,
                 "last_checked": last_checked
             }
-        cur.close()
-        return_db_connection(conn)
         print(f" Loaded {len(rows)} direct products from DB")
     except Exception as e:
         print(f" Error loading direct state: {e}")
-        if conn:
-            return_db_connection(conn)
     return direct_state
 
 
-def save_product(product_url, product_name, in_stock, stock_status="unknown", last_checked=None, last_error=None, retry=True):
+# =========================================================
+#  WRITE-BEHIND PERSISTENCE (batched product_state UPSERTs)
+# =========================================================
+WRITE_FLUSH_SECONDS = int(os.getenv("WRITE_FLUSH_SECONDS", "5"))
+
+PENDING_PRODUCT_WRITES = {}  # {product_url: row} - the latest state for a URL wins
+PENDING_ALERT_MARKS = {}  # {product_url: alerted_at}
+WRITE_BUFFER_LOCK = threading.Lock()
+WRITE_FLUSH_LOCK = threading.Lock()
+WRITE_BEHIND_STOP = threading.Event()
+WRITE_BEHIND_THREAD = None
+
+PRODUCT_UPSERT_SQL = """
+    INSERT INTO product_state (store_url, product_url, product_name, in_stock, stock_status, last_checked, last_error, last_seen)
+    VALUES %s
+    ON CONFLICT (store_url, product_url)
+    DO UPDATE SET product_name = EXCLUDED.product_name,
+                  stock_status = EXCLUDED.stock_status,
+                  last_checked = EXCLUDED.last_checked,
+                  last_error = EXCLUDED.last_error,
+                  last_seen = CURRENT_TIMESTAMP,
+                  in_stock = CASE WHEN EXCLUDED.stock_status = 'unknown'
+                                  THEN product_state.in_stock
+                                  ELSE EXCLUDED.in_stock END
+"""
+PRODUCT_UPSERT_TEMPLATE = "(%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)"
+
+ALERT_MARK_SQL = """
+    UPDATE product_state AS p
+    SET last_alerted = v.alerted_at
+    FROM (VALUES %s) AS v(product_url, alerted_at)
+    WHERE p.product_url = v.product_url
+"""
+ALERT_MARK_TEMPLATE = "(%s, %s::timestamptz)"
+
+
+def save_product(product_url, product_name, in_stock, stock_status="unknown", last_checked=None, last_error=None):
     if not DATABASE_URL:
         return
     if last_checked is None:
         last_checked = datetime.now(timezone.utc)
-    conn = None
-    try:
-        ...
-        with DB_LOCK:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            update_in_stock = ", in_stock = EXCLUDED.in_stock" if stock_status != "unknown" else ""
-            cur.execute("""
-                INSERT INTO product_state (store_url, product_url, product_name, in_stock, stock_status, last_checked, last_error, last_seen)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-                ON CONFLICT (store_url, product_url)
-                DO UPDATE SET product_name = EXCLUDED.product_name,
-                              stock_status = EXCLUDED.stock_status,
-                              last_checked = EXCLUDED.last_checked,
-                              last_error = EXCLUDED.last_error,
-                              last_seen = CURRENT_TIMESTAMP
-                              """ + update_in_stock + """
-            """, (product_url, product_url, product_name, in_stock, stock_status, last_checked, last_error))
-            conn.commit()
-            cur.close()
-            return_db_connection(conn)
-    except Exception as e:
-        if conn:
-            try:
-                conn.close()
-            except:
-                pass
-        if retry and "SSL" in str(e):
-            time.sleep(1)
-            save_product(product_url, product_name, in_stock, stock_status, last_checked, last_error, retry=False)
-        else:
-            print(f" Error saving product: {e}")
+    with WRITE_BUFFER_LOCK:
+        PENDING_PRODUCT_WRITES[product_url] = (
+            product_url, product_url, product_name, in_stock, stock_status, last_checked, last_error
+        )
 
 
-def mark_alerted(product_url):
+def mark_alerted(product_url, flush_now=True):
     if not DATABASE_URL:
         return
-    conn = None
+    with WRITE_BUFFER_LOCK:
+        PENDING_ALERT_MARKS[product_url] = datetime.now(timezone.utc)
+    if flush_now:
+        flush_pending_writes()
+
+
+def _requeue_writes(product_rows, alert_marks):
+    # Put a failed batch back without clobbering anything newer that arrived meanwhile
+    with WRITE_BUFFER_LOCK:
+        for row in product_rows:
+            PENDING_PRODUCT_WRITES.setdefault(row[1], row)
+        for url, alerted_at in alert_marks:
+            PENDING_ALERT_MARKS.setdefault(url, alerted_at)
+
+
+def flush_pending_writes():
+    if not DATABASE_URL:
+        return
+    with WRITE_FLUSH_LOCK:
+        with WRITE_BUFFER_LOCK:
+            product_rows = list(PENDING_PRODUCT_WRITES.values())
+            alert_marks = list(PENDING_ALERT_MARKS.items())
+            PENDING_PRODUCT_WRITES.clear()
+            PENDING_ALERT_MARKS.clear()
+        if not product_rows and not alert_marks:
+            return
+
+        def write(cur):
+            if product_rows:
+                execute_values(cur, PRODUCT_UPSERT_SQL, product_rows, template=PRODUCT_UPSERT_TEMPLATE, page_size=500)
+            if alert_marks:
+                execute_values(cur, ALERT_MARK_SQL, alert_marks, template=ALERT_MARK_TEMPLATE, page_size=500)
+
+        try:
+            run_db(write)
+        except Exception as e:
+            _requeue_writes(product_rows, alert_marks)
+            print(f" Error flushing {len(product_rows)} product writes / {len(alert_marks)} alert marks: {e}")
+
+
+def _write_behind_loop():
+    while not WRITE_BEHIND_STOP.wait(WRITE_FLUSH_SECONDS):
+        try:
+            flush_pending_writes()
+        except Exception as e:
+            print(f" Write-behind flush error: {e}")
+
+
+def start_write_behind():
+    global WRITE_BEHIND_THREAD
+    if not DATABASE_URL or WRITE_BEHIND_THREAD is not None:
+        return
+    WRITE_BEHIND_THREAD = threading.Thread(target=_write_behind_loop, name="write-behind", daemon=True)
+    WRITE_BEHIND_THREAD.start()
+
+
+def stop_write_behind():
+    WRITE_BEHIND_STOP.set()
+    flush_pending_writes()
+
+
+atexit.register(stop_write_behind)
+
+
+# =========================================================
+#  EXTRACTION PROFILES (which selectors worked, per domain)
+# =========================================================
+EXTRACTION_PROFILES_FILE = 'extraction_profiles.json'
+EXTRACTION_PROFILES = {}  # {domain: {"main": selector, "image": selector, "price": selector}}
+EXTRACTION_PROFILES_LOCK = threading.Lock()
+EXTRACTION_PROFILES_DIRTY = False
+
+WIX_MAIN_SELECTOR = 'data-hook=product-page'
+MAIN_AREA_SELECTORS = [
+    'product-essential', 'product-main', 'product-info-main',
+    'product-details-wrapper', 'product-single', 'pdp-main',
+    'product-form', 'product-info', 'product-summary'
+]
+MAIN_AREA_PATTERNS = {selector: re.compile(rf'\b{selector}\b', re.I) for selector in MAIN_AREA_SELECTORS}
+
+
+def load_extraction_profiles():
     try:
-        with DB_LOCK:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("""
-                UPDATE product_state
-                SET last_alerted = CURRENT_TIMESTAMP
-                WHERE product_url = %s
-            """, (product_url,))
-            conn.commit()
-            cur.close()
-            return_db_connection(conn)
+        with open(EXTRACTION_PROFILES_FILE, 'r') as f:
+            EXTRACTION_PROFILES.update(json.load(f))
+        print(f" Loaded extraction profiles for {len(EXTRACTION_PROFILES)} domains")
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        print(f" Error marking alerted: {e}")
-        if conn:
-            return_db_connection(conn)
+        print(f" Failed to load extraction profiles: {e}")
+
+
+def save_extraction_profiles():
+    global EXTRACTION_PROFILES_DIRTY
+    with EXTRACTION_PROFILES_LOCK:
+        if not EXTRACTION_PROFILES_DIRTY:
+            return
+        snapshot = {domain: dict(profile) for domain, profile in EXTRACTION_PROFILES.items()}
+        EXTRACTION_PROFILES_DIRTY = False
+    try:
+        tmp_file = EXTRACTION_PROFILES_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_file, EXTRACTION_PROFILES_FILE)
+    except Exception as e:
+        print(f" Failed to save extraction profiles: {e}")
+
+
+def profile_selector(domain, kind):
+    return EXTRACTION_PROFILES.get(domain, {}).get(kind) if domain else None
+
+
+def remember_selector(domain, kind, selector):
+    global EXTRACTION_PROFILES_DIRTY
+    if not domain or profile_selector(domain, kind) == selector:
+        return
+    with EXTRACTION_PROFILES_LOCK:
+        EXTRACTION_PROFILES.setdefault(domain, {})[kind] = selector
+        EXTRACTION_PROFILES_DIRTY = True
+
+
+def ordered_selectors(selectors, preferred):
+    # The domain's last matching selector first, then the usual discovery order
+    if preferred in selectors:
+        return [preferred] + [selector for selector in selectors if selector != preferred]
+    return selectors
+
+
+atexit.register(save_extraction_profiles)
 
 
 # =========================================================
@@ -852,1697 +1699,2322 @@ ADD_TO_CART_BUTTON_TERMS = [
 ]
 
 PREORDER_PATTERN = re.compile('|'.join(re.escape(term) for term in PREORDER_TERMS), re.IGNORECASE)
-OUT_OF_STOCK_PATTERN = re.compile('|'.join(re.escape(term) for term in OUT_OF_STOCK_TERMS), re.IGNORECASE)
-IN_STOCK_TEXT_PATTERN = re.compile('|'.join(re.escape(term) for term in IN_STOCK_TEXT_TERMS), re.IGNORECASE)
-ADD_TO_CART_PATTERN = re.compile('|'.join(re.escape(term) for term in ADD_TO_CART_BUTTON_TERMS), re.IGNORECASE)
+
+STOCK_TERMS = {
+    "out": OUT_OF_STOCK_TERMS,
+    "preorder": PREORDER_TERMS,
+    "in": IN_STOCK_TEXT_TERMS,
+    "cart": ADD_TO_CART_BUTTON_TERMS,
+}
+
+
+class TermScanner:
+    # One compiled regex over every category: a lookahead alternation (longest term first) finds each
+    # start offset in a single pass, and the shorter terms that are prefixes of the match are added
+    # from a precomputed table, so overlapping hits across categories are never lost.
+    def __init__(self, terms_by_category):
+        terms = {}
+        for category, category_terms in terms_by_category.items():
+            for term in category_terms:
+                terms.setdefault(term.lower(), set()).add(category)
+        ordered = sorted(terms, key=len, reverse=True)
+        self.pattern = re.compile('(?=(' + '|'.join(re.escape(t) for t in ordered) + '))', re.IGNORECASE)
+        self.prefix_hits = {
+            term: [(category, other) for other in ordered if term.startswith(other) for category in sorted(terms[other])]
+            for term in ordered
+        }
+
+    def scan(self, text):
+        # [(category, offset, term)] in text order
+        hits = []
+        for match in self.pattern.finditer(text):
+            for category, term in self.prefix_hits[match.group(1).lower()]:
+                hits.append((category, match.start(), term))
+        return hits
+
+    def categories(self, text):
+        return {category for category, _, _ in self.scan(text)}
+
+
+TERM_SCANNERS = {}  # {franchise name: TermScanner}, built once per franchise
+
+
+def get_term_scanner(franchise=None):
+    # Franchises may add their own terms via an optional "stock_terms": {category: [terms]} entry
+    name = franchise.get("name") if franchise else None
+    scanner = TERM_SCANNERS.get(name)
+    if scanner is None:
+        terms = {category: list(category_terms) for category, category_terms in STOCK_TERMS.items()}
+        for category, extra in ((franchise or {}).get("stock_terms") or {}).items():
+            terms.setdefault(category, []).extend(extra)
+        scanner = TermScanner(terms)
+        TERM_SCANNERS[name] = scanner
+    return scanner
+
+
+# Any BeautifulSoup tree builder. Classification is defined on html.parser's tree; lxml is faster but
+# closes some elements implicitly (a <p> before a nested <div>, an <li> before a sibling <li>, ...)
+# where html.parser nests, and closes unclosed tags at different points. So "lxml" only parses pages
+# its tree matches html.parser's for - strictly nested, with no child that lxml would auto-close its
+# parent for - and everything else goes through html.parser. tests/test_parser_equivalence.py checks it.
+PARSER_BACKEND = os.getenv("PARSER_BACKEND", "lxml")
+
+VOID_ELEMENTS = frozenset((
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'meta',
+    'param', 'source', 'track', 'wbr',
+))
+RAW_TEXT_ELEMENTS = frozenset(('script', 'style'))  # html.parser's CDATA elements
+ESCAPABLE_TEXT_ELEMENTS = frozenset(('textarea', 'title', 'iframe'))  # text-only for lxml, markup for html.parser
+LXML_UNSAFE_ELEMENTS = frozenset(('frameset', 'plaintext', 'image', 'xmp', 'listing'))
+OPTIONAL_CLOSE_AT_END = frozenset(('html', 'head', 'body'))
+_HEADING_CLOSERS = frozenset(('fieldset', 'form', 'li', 'p', 'table'))
+_INLINE_CLOSERS = frozenset(('p', 'td', 'th', 'center'))
+_CELL_CLOSERS = frozenset(('tbody', 'td', 'tfoot', 'th', 'tr'))
+# {parent: children whose start tag makes lxml close the parent first} - lxml only ever checks the
+# direct parent, so nothing deeper needs tracking
+LXML_AUTO_CLOSE = {
+    'p': frozenset((
+        'address', 'blockquote', 'caption', 'center', 'col', 'colgroup', 'dd', 'dir', 'div', 'dl', 'dt',
+        'fieldset', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'li', 'listing', 'menu', 'ol', 'p',
+        'pre', 'table', 'tbody', 'td', 'tfoot', 'th', 'title', 'tr', 'ul', 'xmp',
+    )),
+    'a': frozenset(('a', 'fieldset', 'table', 'td', 'th')),
+    'address': frozenset(('dd', 'dl', 'dt', 'form', 'li', 'ul')),
+    'b': _INLINE_CLOSERS, 'i': _INLINE_CLOSERS, 'u': _INLINE_CLOSERS, 'font': _INLINE_CLOSERS,
+    's': frozenset(('p',)), 'small': frozenset(('p',)), 'tt': frozenset(('p',)),
+    'big': frozenset(('p',)), 'strike': frozenset(('p',)),
+    'span': frozenset(('td', 'th')),
+    'caption': frozenset(('col', 'colgroup', 'tbody', 'tfoot', 'thead', 'tr')),
+    'colgroup': frozenset(('colgroup', 'tbody', 'tfoot', 'thead', 'tr')),
+    'dd': frozenset(('dt',)), 'dt': frozenset(('dd', 'dl')), 'dl': frozenset(('form', 'li')),
+    'form': frozenset(('form',)), 'legend': frozenset(('fieldset',)), 'li': frozenset(('li',)),
+    'h1': _HEADING_CLOSERS, 'h2': _HEADING_CLOSERS, 'h3': _HEADING_CLOSERS,
+    'h4': _HEADING_CLOSERS, 'h5': _HEADING_CLOSERS, 'h6': _HEADING_CLOSERS,
+    'menu': frozenset(('dd', 'dl', 'dt', 'form', 'ul')),
+    'ol': frozenset(('form',)), 'ul': frozenset(('address', 'form', 'menu', 'pre')),
+    'option': frozenset(('optgroup', 'option')),
+    'pre': frozenset(('dd', 'dl', 'dt', 'fieldset', 'form', 'li', 'table', 'ul')),
+    'tbody': frozenset(('tbody', 'tfoot')), 'thead': frozenset(('tbody', 'tfoot')),
+    'tfoot': frozenset(('tbody',)), 'tr': frozenset(('tbody', 'tfoot', 'tr')),
+    'td': _CELL_CLOSERS, 'th': _CELL_CLOSERS,
+}
+MARKUP_TOKEN_PATTERN = re.compile(r'<!--.*?-->|<![^>]*>|<\?[^>]*>|<(/?)([a-zA-Z][\w:-]*)(?:"[^"]*"|\'[^\']*\'|[^\'">])*>', re.S)
+
+
+def lxml_builds_same_tree(html: str) -> bool:
+    # One regex pass over the tags, a small fraction of a parse. (lxml doesn't treat <source>, <track>,
+    # <wbr>, <embed> or <keygen> as void and nests the following siblings inside them; that leaves the
+    # text and every button where they were, so it doesn't change a classification.)
+    stack = []
+    pos = 0
+    length = len(html)
+    while pos < length:
+        match = MARKUP_TOKEN_PATTERN.search(html, pos)
+        if not match:
+            break
+        pos = match.end()
+        name = match.group(2)
+        if not name:
+            continue  # comment, doctype or processing instruction
+        name = name.lower()
+        if match.group(1):
+            if name in VOID_ELEMENTS:
+                return False
+            if not stack or stack[-1] != name:
+                return False
+            stack.pop()
+            continue
+        if name in OPTIONAL_CLOSE_AT_END:
+            if name in stack or name == 'html' and stack:
+                return False
+        elif name in LXML_UNSAFE_ELEMENTS:
+            return False
+        if stack and name in LXML_AUTO_CLOSE.get(stack[-1], ()):
+            return False
+        if name in VOID_ELEMENTS or match.group(0).endswith('/>'):
+            continue
+        if name in RAW_TEXT_ELEMENTS or name in ESCAPABLE_TEXT_ELEMENTS:
+            close = re.compile(rf'</{name}\s*>', re.I).search(html, pos)
+            content = html[pos:close.start()] if close else ''
+            if not close or (name in ESCAPABLE_TEXT_ELEMENTS and '<' in content) or (name == 'iframe' and content.strip()):
+                return False
+            pos = close.end()
+            continue
+        stack.append(name)
+    return all(name in OPTIONAL_CLOSE_AT_END for name in stack)
+
+
+def make_soup(html: str):
+    global PARSER_BACKEND
+    backend = PARSER_BACKEND
+    if backend == "lxml" and not lxml_builds_same_tree(html):
+        backend = "html.parser"
+    try:
+        return BeautifulSoup(html, backend)
+    except FeatureNotFound:
+        print(f" Parser '{PARSER_BACKEND}' not installed, falling back to html.parser")
+        PARSER_BACKEND = "html.parser"
+        return BeautifulSoup(html, PARSER_BACKEND)
+
+
+MAX_BUTTON_CANDIDATES = 300  # buttons/inputs inspected per page before giving up
+
+
+def is_self_hidden(element):
+    style = element.get('style', '')
+    if style and ('display:none' in style.replace(' ', '') or 'display: none' in style):
+        return True
+    classes = element.get('class', [])
+    class_str = ' '.join(classes).lower() if classes else ''
+    return 'hidden' in class_str or 'hide' in class_str or 'd-none' in class_str
 
 
 def is_element_hidden(element):
     current = element
     while current and hasattr(current, 'get'):
-        style = current.get('style', '')
-        if style and ('display:none' in style.replace(' ', '') or 'display: none' in style):
-            return True
-        classes = current.get('class', [])
-        class_str = ' '.join(classes).lower() if classes else ''
-        if 'hidden' in class_str or 'hide' in class_str or 'd-none' in class_str:
+        if is_self_hidden(current):
             return True
         current = current.parent
     return False
 
 
-def has_active_add_to_cart_button(soup):
-    buttons = soup.find_all(['button', 'input'])
-    for btn in buttons:
-        btn_text = btn.get('value', '') if btn.name == 'input' else btn.get_text(strip=True)
-        if ADD_TO_CART_PATTERN.search(btn_text.lower()):
-            is_disabled = (
-                btn.get('disabled') is not None or
-                'disabled' in btn.get('class', []) or
-                btn.get('aria-disabled') == 'true'
-            )
-            is_hidden = is_element_hidden(btn)
-            if not is_disabled and not is_hidden:
-                return True
+BUTTON_INPUT_TYPES = ('', 'submit', 'button', 'image')  # '' keeps untyped inputs styled as buttons
+
+
+def has_active_add_to_cart_button(soup, scanner=None):
+    # One top-down walk: a hidden element hides its whole subtree, so those branches are skipped
+    # instead of walking every button's ancestors. Returns None (undecided) when the page has more
+    # visible buttons than MAX_BUTTON_CANDIDATES, so the cap alone never makes a page "out".
+    scanner = scanner or get_term_scanner()
+    if is_element_hidden(soup):
+        return False
+    inspected = 0
+    stack = [child for child in reversed(soup.contents) if isinstance(child, Tag)]
+    while stack:
+        node = stack.pop()
+        if is_self_hidden(node):
+            continue
+        if node.name == 'button' or (node.name == 'input' and node.get('type', '').lower() in BUTTON_INPUT_TYPES):
+            inspected += 1
+            if inspected > MAX_BUTTON_CANDIDATES:
+                return None
+            btn_text = node.get('value', '') if node.name == 'input' else node.get_text(strip=True)
+            if "cart" in scanner.categories(btn_text):
+                is_disabled = (
+                    node.get('disabled') is not None or
+                    'disabled' in node.get('class', []) or
+                    node.get('aria-disabled') == 'true'
+                )
+                if not is_disabled:
+                    return True
+        stack.extend(child for child in reversed(node.contents) if isinstance(child, Tag))
     return False
 
 
-def find_main_product_area(soup):
-    wix_product = soup.find(attrs={'data-hook': 'product-page'})
-    if wix_product:
-        return wix_product
+def _find_main_area_with(soup, selector):
+    if selector == WIX_MAIN_SELECTOR:
+        return soup.find(attrs={'data-hook': 'product-page'})
+    return soup.find(class_=MAIN_AREA_PATTERNS[selector])
 
-    main_selectors = [
-        'product-essential', 'product-main', 'product-info-main',
-        'product-details-wrapper', 'product-single', 'pdp-main',
-        'product-form', 'product-info', 'product-summary'
-    ]
-    for selector in main_selectors:
-        area = soup.find(class_=re.compile(rf'\b{selector}\b', re.I))
+
+def find_main_product_area(soup, domain=None):
+    for selector in ordered_selectors([WIX_MAIN_SELECTOR] + MAIN_AREA_SELECTORS, profile_selector(domain, "main")):
+        area = _find_main_area_with(soup, selector)
         if area:
+            remember_selector(domain, "main", selector)
             return area
     return None
 
 
-def classify_stock_with_soup(soup, page_text, raw_html):
-    text_lower = page_text.lower()
-    main_area = find_main_product_area(soup)
+def region_fingerprint(area):
+    # Stable hash of the buy box: normalized text plus every button's label, disabled and hidden state.
+    # Hidden form inputs (CSRF tokens, form keys) change per request and are left out.
+    parts = [' '.join(area.get_text().split()).lower()]
+    stack = [(child, False) for child in reversed(area.contents) if isinstance(child, Tag)]
+    while stack:
+        node, hidden = stack.pop()
+        hidden = hidden or is_self_hidden(node)
+        if node.name in ('button', 'input') and node.get('type') != 'hidden':
+            label = node.get('value', '') if node.name == 'input' else node.get_text(strip=True)
+            disabled = (node.get('disabled') is not None or 'disabled' in node.get('class', [])
+                        or node.get('aria-disabled') == 'true')
+            parts.append(f"{node.name}|{label}|{int(disabled)}|{int(hidden)}")
+        stack.extend((child, hidden) for child in reversed(node.contents) if isinstance(child, Tag))
+    return body_hash('\n'.join(parts))
+
+
+def classify_stock_with_soup(soup, page_text, raw_html, franchise=None, domain=None):
+    scanner = get_term_scanner(franchise)
+    main_area = find_main_product_area(soup, domain)
 
     if main_area:
-        main_text = main_area.get_text().lower()
-        if OUT_OF_STOCK_PATTERN.search(main_text):
+        found = scanner.categories(main_area.get_text())
+        if "out" in found:
             return "out"
-        if has_active_add_to_cart_button(main_area):
-            if PREORDER_PATTERN.search(main_text):
+        active = has_active_add_to_cart_button(main_area, scanner)
+        if active or (active is None and "in" in found):
+            if "preorder" in found:
                 return "preorder"
             return "in"
-        if PREORDER_PATTERN.search(main_text):
+        if "preorder" in found:
             return "preorder"
         return "out"
 
-    if OUT_OF_STOCK_PATTERN.search(text_lower):
+    found = scanner.categories(page_text)
+    if "out" in found:
         return "out"
 
-    if has_active_add_to_cart_button(soup):
-        if PREORDER_PATTERN.search(text_lower):
+    if has_active_add_to_cart_button(soup, scanner):
+        if "preorder" in found:
             return "preorder"
         return "in"
 
-    if IN_STOCK_TEXT_PATTERN.search(text_lower):
-        if PREORDER_PATTERN.search(text_lower):
+    if "in" in found:
+        if "preorder" in found:
             return "preorder"
         return "in"
 
-    if PREORDER_PATTERN.search(text_lower):
+    if "preorder" in found:
         return "preorder"
 
     return "out"
 
 
 # =========================================================
-#  SKIP/FAIL HELPERS
+#  STRUCTURED DATA (schema.org JSON-LD / microdata offers)
 # =========================================================
-def is_site_in_failure_cooldown(url):
-    if url not in FAILED_SITES:
-        return False
-    failure_time = FAILED_SITES[url]
-    if datetime.now(timezone.utc) - failure_time < timedelta(minutes=FAILURE_COOLDOWN_MINUTES):
-        return True
-    del FAILED_SITES[url]
-    return False
+JSON_LD_PATTERN = re.compile(r'<script[^>]+type=["\']?application/ld\+json["\']?[^>]*>(.*?)</script>', re.I | re.S)
+MICRODATA_AVAILABILITY_PATTERN = re.compile(r'<[^>]+itemprop=["\']availability["\'][^>]*>', re.I)
+MICRODATA_PRODUCT_TYPE = re.compile(r'schema\.org/Product\b', re.I)
+TITLE_PATTERN = re.compile(r'<title[^>]*>(.*?)</title>', re.I | re.S)
 
+SCHEMA_AVAILABILITY = {
+    "instock": "in", "onlineonly": "in", "limitedavailability": "in",
+    "preorder": "preorder", "presale": "preorder",
+    "outofstock": "out", "soldout": "out", "discontinued": "out",
+    "backorder": "out", "instoreonly": "out",
+}
+CURRENCY_SYMBOLS = {"GBP": "£", "USD": "$", "EUR": "€"}
+STRUCTURED_SKIP_TYPES = {"itemlist", "breadcrumblist", "searchaction"}  # related-product carousels live here
 
-def mark_site_failed(url):
-    FAILED_SITES[url] = datetime.now(timezone.utc)
 
+def _schema_types(node):
+    types = node.get("@type") or []
+    if isinstance(types, str):
+        types = [types]
+    return {str(t).lower() for t in types}
 
-def is_js_only_url(url):
-    return any(pattern in url.lower() for pattern in JS_URL_PATTERNS)
+
+def _find_products(node, found):
+    if isinstance(node, list):
+        for item in node:
+            _find_products(item, found)
+    elif isinstance(node, dict):
+        types = _schema_types(node)
+        if types & STRUCTURED_SKIP_TYPES:
+            return
+        if types & {"product", "productgroup"}:
+            found.append(node)
+            return
+        for value in node.values():
+            if isinstance(value, (dict, list)):
+                _find_products(value, found)
+
+
+def _offer_list(product):
+    offers = []
+    pending = [product.get("offers")]
+    for variant in product.get("hasVariant") or []:
+        if isinstance(variant, dict):
+            pending.append(variant.get("offers"))
+    while pending:
+        item = pending.pop(0)
+        if isinstance(item, list):
+            pending.extend(item)
+        elif isinstance(item, dict):
+            offers.append(item)
+            if item.get("offers"):  # AggregateOffer
+                pending.append(item.get("offers"))
+    return offers
+
+
+def _availability_status(value):
+    if not isinstance(value, str) or not value:
+        return None
+    return SCHEMA_AVAILABILITY.get(value.rstrip("/").rsplit("/", 1)[-1].lower())
 
 
-def is_js_only_page(html_content, product_count):
-    if len(html_content) < 2000 and product_count < 3:
-        return True
-    html_lower = html_content.lower()
-    return any(indicator in html_lower for indicator in JS_PAGE_INDICATORS)
+def _format_offer_price(offer):
+    amount = offer.get("price", offer.get("lowPrice"))
+    if amount in (None, ""):
+        return None
+    try:
+        amount = float(str(amount).replace(",", ""))
+    except ValueError:
+        return None
+    return f"{CURRENCY_SYMBOLS.get(offer.get('priceCurrency', 'GBP'), '£')}{amount:.2f}"
 
 
-def is_in_js_skip_cache(url):
-    if url not in JS_SKIP_CACHE:
-        return False
-    if datetime.now(timezone.utc) < JS_SKIP_CACHE[url]:
+def _image_from_schema(image, base_url):
+    if isinstance(image, list):
+        image = image[0] if image else None
+    if isinstance(image, dict):
+        image = image.get("url") or image.get("contentUrl")
+    if not isinstance(image, str) or not image:
+        return None
+    return urljoin(base_url, image)
+
+
+def extract_structured_offer(raw_html: str, base_url: str):
+    # First-tier classifier: exact availability/price/image from schema.org data, None if the page has none
+    products = []
+    for block in JSON_LD_PATTERN.findall(raw_html):
+        block = block.strip()
+        if block.startswith("<!--"):
+            block = block.strip("<!->").strip()
+        try:
+            _find_products(json.loads(block, strict=False), products)
+        except ValueError:
+            continue
+
+    for product in products:
+        statuses = []
+        price = None
+        in_price = None
+        for offer in _offer_list(product):
+            offer_price = _format_offer_price(offer)
+            price = price or offer_price
+            status = _availability_status(offer.get("availability"))
+            if status:
+                statuses.append(status)
+                if status == "in":
+                    in_price = in_price or offer_price
+        price = in_price or price
+        if not statuses:
+            continue
+        if "in" in statuses:
+            stock_status = "in"
+            preorder_text = f"{product.get('name') or ''} {product.get('description') or ''}"
+            if PREORDER_PATTERN.search(preorder_text):
+                stock_status = "preorder"
+        elif "preorder" in statuses:
+            stock_status = "preorder"
+        else:
+            stock_status = "out"
+        name = product.get("name")
+        return {
+            "name": html_lib.unescape(name)[:100] if isinstance(name, str) else None,
+            "stock_status": stock_status,
+            "price": price,
+            "image_url": _image_from_schema(product.get("image"), base_url),
+        }
+
+    if MICRODATA_AVAILABILITY_PATTERN.search(raw_html):
+        status = _microdata_product_status(raw_html)
+        if status:
+            return {"name": None, "stock_status": status, "price": None, "image_url": None}
+    return None
+
+
+def _is_page_product(soup, product):
+    # A lone itemscope can still be a carousel item (the main product unmarked), so it must hold
+    # the page heading or carry the same name
+    heading = soup.find("h1")
+    if heading is None or product is heading or heading in product.descendants:
         return True
-    del JS_SKIP_CACHE[url]
-    return False
+    name_tag = product.find(itemprop="name")
+    if name_tag is None:
+        return False
+    name = name_tag.get("content") or name_tag.get_text(" ", strip=True)
+    normalise = lambda text: re.sub(r'\s+', ' ', text or '').strip().lower()
+    return bool(name) and normalise(name) == normalise(heading.get_text(" ", strip=True))
+
+
+def _microdata_product_status(raw_html: str):
+    # Only the page's own Product itemscope counts - related-product carousels carry their own
+    # availability. No clear main product is ambiguous, so the term classifier decides.
+    soup = make_soup(raw_html)
+    products = [
+        tag for tag in soup.find_all(itemtype=MICRODATA_PRODUCT_TYPE)
+        if tag.find_parent(itemtype=MICRODATA_PRODUCT_TYPE) is None and _is_page_product(soup, tag)
+    ]
+    if len(products) != 1:
+        return None
+    statuses = []
+    for tag in products[0].find_all(itemprop="availability"):
+        if tag.find_parent(itemtype=MICRODATA_PRODUCT_TYPE) is not products[0]:
+            continue  # belongs to a nested product (isRelatedTo, isSimilarTo)
+        status = _availability_status(tag.get("href") or tag.get("content") or tag.get_text(strip=True))
+        if status:
+            statuses.append(status)
+    if not statuses:
+        return None
+    return "in" if "in" in statuses else "preorder" if "preorder" in statuses else "out"
 
 
-def add_to_js_skip_cache(url):
-    JS_SKIP_CACHE[url] = datetime.now(timezone.utc) + timedelta(minutes=JS_SKIP_MINUTES)
+def title_from_html(raw_html: str):
+    match = TITLE_PATTERN.search(raw_html)
+    if not match:
+        return None
+    return html_lib.unescape(re.sub(r'\s+', ' ', match.group(1))).strip()[:100] or None
 
 
 # =========================================================
-#  ALERT CONTROL
+#  SHOPIFY JSON FAST PATH (/products/<handle>.js)
 # =========================================================
-def should_alert(last_alerted):
-    return True  # Always alert on change (no cooldown)
+SHOPIFY_HANDLE_PATTERN = re.compile(r'/products/([^/?#.]+)/?$')
+SHOPIFY_JSON_UNSUPPORTED = {}  # {domain: retry_after} for sites where .js isn't Shopify
+SHOPIFY_UNSUPPORTED_MINUTES = 60
 
 
-# =========================================================
-#  SEND ALERT
-# =========================================================
-def send_alert(product_name, url, store_name, is_preorder=False, is_new=False,
-               image_url=None, price=None, store_file=None):
-    webhook_url = None
-    role_id = None
+def shopify_handle_for_url(url: str):
+    match = SHOPIFY_HANDLE_PATTERN.search(urlparse(url).path)
+    return match.group(1) if match else None
 
-    for group in CURRENT_FRANCHISE.get("webhook_secrets", []):
-        if store_file and group["file"] == store_file:
-            webhook_url = group["webhook"]
-            break
 
-    role_id = CURRENT_FRANCHISE.get("role_id")
+def is_shopify_response(response) -> bool:
+    headers = response.headers
+    return bool(
+        headers.get('x-shopid') or headers.get('x-shopify-stage') or
+        'shopify' in headers.get('powered-by', '').lower()
+    )
 
-    if webhook_url is None:
-        webhook_url = CURRENT_WEBHOOK
 
-    if webhook_url is None:
-        print(" Warning: No webhook for this file/group")
-        return
+def format_minor_price(amount):
+    if amount is None:
+        return None
+    try:
+        return f"£{int(amount) / 100:.2f}"
+    except (TypeError, ValueError):
+        return None
 
-    if is_preorder:
-        title = f"PREORDER AVAILABLE - {product_name}"
-        status = "Preorder"
-        color = 16753920
-        emoji = "📋"
-    elif is_new:
-        title = f"NEW PRODUCT - {product_name}"
-        status = "In Stock"
-        color = 3447003
-        emoji = "🆕"
-    else:
-        title = f"BACK IN STOCK - {product_name}"
-        status = "In Stock"
-        color = 65280
-        emoji = "📦"
 
-    role_mention = f"<@&{role_id}>" if role_id else ""
+def parse_shopify_product(data: dict, url: str):
+    variants = data.get('variants') or []
+    variant = None
+    variant_id = parse_qs(urlparse(url).query).get('variant', [None])[0]
+    if variant_id:
+        variant = next((v for v in variants if str(v.get('id')) == variant_id), None)
 
-    embed = {
-        "title": title,
-        "url": url,
-        "color": color,
-        "fields": [
-            {"name": "Retailer", "value": store_name, "inline": True},
-            {"name": "Price", "value": price or "N/A", "inline": True},
-            {"name": "Status", "value": status, "inline": True},
-            {"name": "Direct Link", "value": f"[Click Here]({url})", "inline": False}
-        ],
-        "footer": {"text": f"{CURRENT_FRANCHISE['name']} Restocks Monitor"},
-        "timestamp": datetime.now(timezone.utc).isoformat()
+    if variant:
+        available = bool(variant.get('available'))
+        price = variant.get('price')
+        image = (variant.get('featured_image') or {}).get('src') or data.get('featured_image')
+    else:
+        available = bool(data.get('available'))
+        if not available and variants:
+            available = any(v.get('available') for v in variants)
+        price = data.get('price')
+        if price is None and variants:
+            price = variants[0].get('price')
+        image = data.get('featured_image')
+
+    if isinstance(image, dict):
+        image = image.get('src')
+    if image and image.startswith('//'):
+        image = 'https:' + image
+
+    if available:
+        tags = data.get('tags') or []
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        preorder_text = ' '.join([data.get('title') or '', ' '.join(tags), data.get('description') or ''])
+        stock_status = "preorder" if PREORDER_PATTERN.search(preorder_text) else "in"
+    else:
+        stock_status = "out"
+
+    return {
+        "name": (data.get('title') or '')[:100],
+        "stock_status": stock_status,
+        "price": format_minor_price(price),
+        "image_url": image,
     }
 
-    if image_url:
-        embed["thumbnail"] = {"url": image_url}
 
-    data = {
-        "content": f"{emoji} **RESTOCK** - **{product_name}** @{store_name} {role_mention}",
-        "embeds": [embed],
-        "allowed_mentions": {"parse": ["roles"]}
-    }
+def fetch_shopify_product_json(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str):
+    handle = shopify_handle_for_url(url)
+    if not handle:
+        return None
+    retry_after = SHOPIFY_JSON_UNSUPPORTED.get(domain)
+    if retry_after and datetime.now(timezone.utc) < retry_after:
+        return None
+
+    parsed = urlparse(url)
+    json_url = f"{parsed.scheme}://{parsed.netloc}/products/{handle}.js"
+    json_headers = dict(headers)
+    json_headers["Accept"] = "application/json"
+    json_headers["Sec-Fetch-Dest"] = "empty"
+    json_headers["Sec-Fetch-Mode"] = "cors"
+    json_headers.pop("Upgrade-Insecure-Requests", None)
+    json_headers.pop("Sec-Fetch-User", None)
 
     try:
-        r = SESSION.post(webhook_url, json=data, timeout=10)
-        if r.status_code == 204:
-            print(f" Alert sent to {store_file or 'default'}!")
-        else:
-            print(f" Failed to send alert ({r.status_code}): {r.text[:200]}")
-    except Exception as e:
-        print(f" Discord error: {e}")
+        session = get_session_for_domain(domain)
+        proxies = proxies_for_url(url) if use_proxy else None
+        r = session.get(json_url, headers=json_headers, timeout=min(timeout_s, MAX_TIMEOUT), proxies=proxies)
+    except requests.exceptions.RequestException:
+        return None
 
+    if r.status_code != 200 or 'json' not in r.headers.get('content-type', '').lower():
+        if not is_shopify_response(r):
+            SHOPIFY_JSON_UNSUPPORTED[domain] = datetime.now(timezone.utc) + timedelta(minutes=SHOPIFY_UNSUPPORTED_MINUTES)
+        return None
 
-# =========================================================
-#  TIMEOUTS
-# =========================================================
-def get_timeout_for_url(url):
-    slow_sites = ["very.co.uk", "game.co.uk", "johnlewis.com", "argos.co.uk"]
-    if any(site in url for site in slow_sites):
-        return 45
-    return 15
+    try:
+        data = r.json()
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or 'variants' not in data:
+        return None
+
+    SHOPIFY_JSON_UNSUPPORTED.pop(domain, None)
+    return parse_shopify_product(data, url)
 
 
 # =========================================================
-#  DIRECT PRODUCT CHECK
+#  PLATFORM DETECTION (once per domain, cached in memory + Postgres)
 # =========================================================
-def check_direct_product(url, previous_state, stats, store_file=None, is_verification=False, is_dormant=False):
-    if is_site_in_failure_cooldown(url):
-        print(f" SKIPPED (failed recently)")
-        if not is_verification:
-            stats['skipped'] += 1
-        return previous_state, None
+GENERATOR_PATTERN = re.compile(r'<meta[^>]+name=["\']generator["\'][^>]*content=["\']([^"\']+)', re.I)
+PLATFORM_SIGNATURES = [
+    # Checked in order; the first platform with any matching marker wins
+    ("shopify", re.compile(r'cdn\.shopify\.com|Shopify\.theme|shopify-section', re.I)),
+    ("woocommerce", re.compile(r'wp-content/plugins/woocommerce|woocommerce-product|wc-block', re.I)),
+    ("bigcommerce", re.compile(r'cdn11\.bigcommerce\.com|BCData', re.I)),
+    ("wix", re.compile(r'data-hook=["\']product-page["\']|static\.wixstatic\.com', re.I)),
+    ("magento", re.compile(r'Magento_|mage/cookies', re.I)),
+]
+GENERATOR_PLATFORMS = {"shopify": "shopify", "woocommerce": "woocommerce", "bigcommerce": "bigcommerce",
+                       "wix": "wix", "magento": "magento"}
 
-    domain = _host_for_url(url)
-    health = DOMAIN_HEALTH.get(domain, {
-        'strategy': 'playwright' if domain in PLAYWRIGHT_DOMAINS else 'requests',
-        'use_proxy': domain in DECODO_BLOCKED_DOMAINS,
-        'cooldown_until': None,
-        'history': [],
-        'success_rate': 1.0,
-        'failure_streak': 0,
-        'last_success': None,
-        'latency': []
-    })
-    DOMAIN_HEALTH[domain] = health
+DOMAIN_PLATFORMS = {}  # {domain: platform}, "custom" when nothing matched
 
-    if health['cooldown_until'] and datetime.now(timezone.utc) < health['cooldown_until']:
-        print(f" UNKNOWN (cooldown)")
-        if not is_verification:
-            stats['failed'] += 1
-            file_label = store_file.split('/')[-1].replace('.txt', '') if store_file else "Unknown"
-            HOURLY_FAILED_DETAILS.append({"url": domain, "file": file_label, "reason": "Cooldown"})
-        return {
-            "name": previous_state.get("name") if previous_state else None,
-            "in_stock": previous_state.get("in_stock") if previous_state else False,
-            "stock_status": "unknown",
-            "last_alerted": previous_state.get("last_alerted") if previous_state else None
-        }, None
+
+def detect_platform(raw_html: str) -> str:
+    generator = GENERATOR_PATTERN.search(raw_html)
+    if generator:
+        generator_text = generator.group(1).lower()
+        for marker, platform in GENERATOR_PLATFORMS.items():
+            if marker in generator_text:
+                return platform
+    for platform, pattern in PLATFORM_SIGNATURES:
+        if pattern.search(raw_html):
+            return platform
+    return "custom"
+
+
+def load_domain_platforms():
+    if not DATABASE_URL:
+        return
+
+    def read(cur):
+        cur.execute("SELECT domain, platform FROM domain_platforms")
+        return cur.fetchall()
 
     try:
-        headers = get_headers_for_url(url)
-        timeout_s = 15 if health['strategy'] == 'requests' else 20
-        start_time = time.time()
+        DOMAIN_PLATFORMS.update(run_db(read))
+        if DOMAIN_PLATFORMS:
+            print(f" Loaded platforms for {len(DOMAIN_PLATFORMS)} domains")
+    except Exception as e:
+        print(f" Error loading domain platforms: {e}")
 
-        status_code, final_url, html = fetch_html(url, headers, timeout_s, health['use_proxy'], domain)
 
-        latency = time.time() - start_time
+def record_platform(domain: str, platform: str):
+    if DOMAIN_PLATFORMS.get(domain) == platform:
+        return
+    DOMAIN_PLATFORMS[domain] = platform
+    print(f" Platform detected: {domain} -> {platform}")
+    if not DATABASE_URL:
+        return
 
-        if status_code != 200 or not html:
-            raise Exception(f"HTTP {status_code}")
+    def write(cur):
+        cur.execute("""
+            INSERT INTO domain_platforms (domain, platform, detected_at) VALUES (%s, %s, NOW())
+            ON CONFLICT (domain) DO UPDATE SET platform = EXCLUDED.platform, detected_at = NOW()
+        """, (domain, platform))
 
-        html_lower = html.lower()
-        if any(marker in html_lower for marker in BLOCKED_MARKERS):
-            clear_cookies_for_domain(domain)
-            raise Exception("Blocked")
+    try:
+        run_db(write)
+    except Exception as e:
+        print(f" Error saving platform for {domain}: {e}")
 
-        # Success
-        health['history'].append('success')
-        if len(health['history']) > 10:
-            health['history'].pop(0)
-        health['success_rate'] = health['history'].count('success') / len(health['history'])
-        health['failure_streak'] = 0
-        health['last_success'] = datetime.now(timezone.utc)
-        health['latency'].append(latency)
-        if len(health['latency']) > 10:
-            health['latency'].pop(0)
 
-        if health['strategy'] == 'requests':
-            save_cookies_for_domain(domain, get_session_for_domain(domain))
-        else:
-            state_file = os.path.join(STATE_DIR, f"{domain}.json")
-            # Storage state saved in fetch_html_playwright
+def use_shopify_fast_path(domain: str) -> bool:
+    # Undetected domains still try it once; known non-Shopify domains skip the wasted .js request
+    return DOMAIN_PLATFORMS.get(domain) in (None, "shopify")
 
-        if is_dormant:
-            original_path = urlparse(url).path.rstrip('/')
-            final_path = urlparse(final_url).path.rstrip('/')
-            if final_path == '' or final_path == '/' or (original_path != final_path and len(final_path) < 10):
-                print(f"OUT - redirected")
-                return {
-                    "name": None, "in_stock": False, "stock_status": "out",
-                    "last_alerted": previous_state.get("last_alerted") if previous_state else None
-                }, None
 
-        if not is_verification:
-            stats['fetched'] += 1
-
-        soup = BeautifulSoup(html, "html.parser")
-        page_text = soup.get_text()
-        raw_html = html
-
-        if is_store_unavailable(page_text):
-            print(" UNKNOWN (store unavailable)")
-            return {
-                "name": previous_state.get("name") if previous_state else None,
-                "in_stock": previous_state.get("in_stock") if previous_state else False,
-                "stock_status": "unknown",
-                "last_alerted": previous_state.get("last_alerted") if previous_state else None
-            }, None
-
-        product_name = None
-        title_tag = soup.find('title')
-        if title_tag:
-            product_name = title_tag.get_text(strip=True)[:100]
-        if not product_name:
-            h1 = soup.find('h1')
-            if h1:
-                product_name = h1.get_text(strip=True)[:100]
-        if not product_name:
-            product_name = urlparse(url).path.split('/')[-1].replace('-', ' ').replace('.html', '')[:100]
-
-        if product_name and not is_tcg_product(product_name, url):
-            return {
-                "name": product_name,
-                "in_stock": False,
-                "stock_status": "out",
-                "last_alerted": previous_state.get("last_alerted") if previous_state else None
-            }, None
+# =========================================================
+#  WOOCOMMERCE STORE API FAST PATH (/wp-json/wc/store/v1/products?slug=)
+# =========================================================
+WOO_SLUG_PATTERN = re.compile(r'/product/([^/?#]+)/?$')
+WOO_API_UNSUPPORTED = {}  # {domain: retry_after} for shops with the Store API disabled
+WOO_UNSUPPORTED_MINUTES = 60
 
-        stock_status = classify_stock_with_soup(soup, page_text, raw_html)
-        is_available = stock_status in ("in", "preorder")
 
-        image_url = None
-        img_selectors = [
-            'img.product-featured-image', 'img.product-image', 'img.product__image',
-            'meta[property="og:image"]', 'meta[name="og:image"]'
-        ]
-        for selector in img_selectors:
-            elem = soup.select_one(selector)
-            if elem:
-                if elem.name == 'meta':
-                    image_url = elem.get('content')
-                else:
-                    image_url = elem.get('src') or elem.get('data-src')
-                if image_url:
-                    if image_url.startswith('//'):
-                        image_url = 'https:' + image_url
-                    elif image_url.startswith('/'):
-                        parsed = urlparse(url)
-                        image_url = f"{parsed.scheme}://{parsed.netloc}{image_url}"
-                    break
+def woo_slug_for_url(url: str):
+    match = WOO_SLUG_PATTERN.search(urlparse(url).path)
+    return match.group(1) if match else None
 
-        price = None
-        price_selectors = ['.price', '.product-price', 'meta[property="product:price:amount"]', '[data-hook="formatted-primary-price"]']
-        for selector in price_selectors:
-            elem = soup.select_one(selector)
-            if elem:
-                if elem.name == 'meta':
-                    amt = elem.get('content')
-                    if amt:
-                        price = f"£{amt}"
-                else:
-                    price_text = elem.get_text(strip=True)
-                    match = re.search(r'[£$€][\d,]+\.?\d*', price_text)
-                    if match:
-                        price = match.group()
-                if price:
-                    break
 
-        current_state = {
-            "name": product_name,
-            "in_stock": is_available,
-            "stock_status": stock_status,
-            "last_alerted": previous_state.get("last_alerted") if previous_state else None,
-            "image_url": image_url,
-            "price": price
-        }
+def format_woo_price(prices: dict):
+    amount = prices.get('price')
+    if amount in (None, ""):
+        return None
+    try:
+        value = int(amount) / 10 ** int(prices.get('currency_minor_unit', 2))
+    except (TypeError, ValueError):
+        return None
+    return f"{prices.get('currency_symbol') or '£'}{value:.2f}"
 
-        change = None
-        if previous_state:
-            was_available = previous_state.get("in_stock", False)
-            if not was_available and is_available:
-                last_alerted = previous_state.get("last_alerted")
-                if should_alert(last_alerted):
-                    change = {
-                        "type": "preorder" if stock_status == "preorder" else "restock",
-                        "name": product_name,
-                        "url": url,
-                        "store_file": store_file,
-                        "image_url": image_url,
-                        "price": price
-                    }
-        elif not previous_state and is_available:
-            change = {
-                "type": "preorder" if stock_status == "preorder" else "new",
-                "name": product_name,
-                "url": url,
-                "store_file": store_file,
-                "image_url": image_url,
-                "price": price
-            }
 
-        return current_state, change
+def parse_woo_product(data: dict):
+    name = html_lib.unescape(data.get('name') or '')
+    if data.get('is_on_backorder'):
+        # The Store API reports backorders as in stock; the HTML path treats them as out
+        stock_status = "out"
+    elif data.get('is_in_stock') and data.get('is_purchasable', True):
+        preorder_text = f"{name} {data.get('short_description') or ''}"
+        stock_status = "preorder" if PREORDER_PATTERN.search(preorder_text) else "in"
+    else:
+        stock_status = "out"
+    images = data.get('images') or []
+    return {
+        "name": name[:100],
+        "stock_status": stock_status,
+        "price": format_woo_price(data.get('prices') or {}),
+        "image_url": images[0].get('src') if images and isinstance(images[0], dict) else None,
+    }
 
-    except requests.exceptions.Timeout:
-        health['history'].append('fail')
-        if len(health['history']) > 10:
-            health['history'].pop(0)
-        health['success_rate'] = health['history'].count('success') / len(health['history'])
-        health['failure_streak'] += 1
-        if health['failure_streak'] > 4:
-            health['cooldown_until'] = datetime.now(timezone.utc) + timedelta(minutes=10)
-        if health['success_rate'] < 0.5 and health['strategy'] == 'requests':
-            health['strategy'] = 'playwright'
-        if len(health['history']) >= 5 and health['history'][-5:].count('fail') > 3:
-            health['use_proxy'] = not health['use_proxy']
-        domain = urlparse(url).netloc
-        file_label = store_file.split('/')[-1].replace('.txt', '') if store_file else "Unknown"
-        if is_dormant:
-            print(f"OUT - timeout")
-            return {"name": None, "in_stock": False, "stock_status": "out",
-                    "last_alerted": previous_state.get("last_alerted") if previous_state else None}, None
-        print(f" UNKNOWN (timeout)")
-        mark_site_failed(url)
-        if not is_verification:
-            stats['failed'] += 1
-            HOURLY_FAILED_DETAILS.append({"url": domain, "file": file_label, "reason": "Timeout"})
-        return {
-            "name": previous_state.get("name") if previous_state else None,
-            "in_stock": previous_state.get("in_stock") if previous_state else False,
-            "stock_status": "unknown",
-            "last_alerted": previous_state.get("last_alerted") if previous_state else None
-        }, None
-    except Exception as e:
-        health['history'].append('fail')
-        if len(health['history']) > 10:
-            health['history'].pop(0)
-        health['success_rate'] = health['history'].count('success') / len(health['history'])
-        health['failure_streak'] += 1
-        if health['failure_streak'] > 4:
-            health['cooldown_until'] = datetime.now(timezone.utc) + timedelta(minutes=10)
-        if health['success_rate'] < 0.5 and health['strategy'] == 'requests':
-            health['strategy'] = 'playwright'
-        if len(health['history']) >= 5 and health['history'][-5:].count('fail') > 3:
-            health['use_proxy'] = not health['use_proxy']
-        domain = urlparse(url).netloc
-        file_label = store_file.split('/')[-1].replace('.txt', '') if store_file else "Unknown"
-        print(f" UNKNOWN ({str(e)[:80]})")
-        mark_site_failed(url)
-        if not is_verification:
-            stats['failed'] += 1
-            HOURLY_FAILED_DETAILS.append({"url": domain, "file": file_label, "reason": str(e)[:80]})
-        return {
-            "name": previous_state.get("name") if previous_state else None,
-            "in_stock": previous_state.get("in_stock") if previous_state else False,
-            "stock_status": "unknown",
-            "last_alerted": previous_state.get("last_alerted") if previous_state else None
-        }, None
 
+def fetch_woocommerce_product_json(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str):
+    slug = woo_slug_for_url(url)
+    if not slug:
+        return None
+    retry_after = WOO_API_UNSUPPORTED.get(domain)
+    if retry_after and datetime.now(timezone.utc) < retry_after:
+        return None
 
-# =========================================================
-#  MAIN LOOP (this is your original flow)
-# =========================================================
-CHECK_INTERVAL = 5
+    parsed = urlparse(url)
+    api_url = f"{parsed.scheme}://{parsed.netloc}/wp-json/wc/store/v1/products"
+    json_headers = dict(headers)
+    json_headers["Accept"] = "application/json"
+    json_headers.pop("Upgrade-Insecure-Requests", None)
 
+    try:
+        session = get_session_for_domain(domain)
+        proxies = proxies_for_url(url) if use_proxy else None
+        r = session.get(api_url, params={"slug": slug}, headers=json_headers,
+                        timeout=min(timeout_s, MAX_TIMEOUT), proxies=proxies)
+    except requests.exceptions.RequestException:
+        return None
 
-def main():
-    global CURRENT_WEBHOOK, CURRENT_ROLE_ID, USE_MOBILE_HEADERS
-    global TOTAL_SCANS, DAILY_SCANS, LAST_HOURLY_PING, LAST_DAILY_PING
-    global HOURLY_STATS, DAILY_STATS
+    if r.status_code != 200 or 'json' not in r.headers.get('content-type', '').lower():
+        if r.status_code in (401, 403, 404):
+            # Store API switched off (or blocked): fall back to HTML for a while
+            WOO_API_UNSUPPORTED[domain] = datetime.now(timezone.utc) + timedelta(minutes=WOO_UNSUPPORTED_MINUTES)
+        return None
 
-    print(" Starting Store Monitor Bot...")
-    print(f"   Time: {datetime.now(timezone.utc)}")
-    print(f"   Production mode: {IS_PRODUCTION}")
-    print(f"   Franchises: {', '.join(f['name'] for f in FRANCHISES)}")
-    print(f"   Playwright available: {PLAYWRIGHT_AVAILABLE}")
-    if PLAYWRIGHT_AVAILABLE:
-        print(f"   Playwright domains: {', '.join(sorted(PLAYWRIGHT_DOMAINS))}")
+    try:
+        data = r.json()
+    except ValueError:
+        return None
+    if not isinstance(data, list) or not data or not isinstance(data[0], dict):
+        return None
 
-    db_ok = init_db_pool()
-    if not db_ok:
-        print(" Database not configured. Continuing without database.")
-    else:
-        if not init_database():
-            print(" Database init failed. Continuing without database.")
-            db_ok = False
+    WOO_API_UNSUPPORTED.pop(domain, None)
+    return parse_woo_product(data[0])
 
-    if db_ok:
-        sync_urls_to_db()
-        load_ping_state()
-        direct_state = load_direct_state()
-    else:
-        direct_state = {}
 
-    first_run = len(direct_state) == 0
-    if first_run:
-        print(" First run - building initial database (no alerts)...")
-        for franchise in FRANCHISES:
-            for fp in franchise.get("direct_files", []):
-                _ = load_urls_from_db(fp)
+# =========================================================
+#  SHOPIFY BULK POLLING (/products.json, once per domain per check interval)
+# =========================================================
+# A poll costs one request per catalogue page, so it is only used where it
+# replaces more per-handle .js requests than it sends.
+SHOPIFY_BULK_MIN_HANDLES = 2  # domains with fewer monitored handles keep per-handle checks
+SHOPIFY_BULK_PAGE_SIZE = 250
+SHOPIFY_BULK_MAX_PAGES = int(os.getenv("SHOPIFY_BULK_MAX_PAGES", "4"))
+SHOPIFY_HANDLE_COUNTS = {}  # {domain: monitored Shopify handles}, rebuilt with the schedule
+SHOPIFY_BULK_PAGES = {}  # {domain: pages the last complete poll needed}; unknown = SHOPIFY_BULK_MAX_PAGES
+SHOPIFY_BULK_CACHE = {}  # {domain: {"fetched_at", "products": {handle: product}}}
+SHOPIFY_BULK_LOCKS = {}
+SHOPIFY_BULK_LOCKS_GUARD = threading.Lock()
 
-    for franchise in FRANCHISES:
-        direct_files = franchise.get("direct_files", [])
-        webhook_groups = len(franchise.get("webhook_secrets", []))
-        print(f"   {franchise['name']}: {len(direct_files)} direct files, {webhook_groups} webhook groups")
 
-    while True:
-        USE_MOBILE_HEADERS = not USE_MOBILE_HEADERS
-        header_type = " Mobile" if USE_MOBILE_HEADERS else " Desktop"
+def update_shopify_handle_counts(urls):
+    counts = {}
+    for url in urls:
+        if shopify_handle_for_url(url):
+            domain = _host_for_url(url)
+            counts[domain] = counts.get(domain, 0) + 1
+    SHOPIFY_HANDLE_COUNTS.clear()
+    SHOPIFY_HANDLE_COUNTS.update(counts)
 
-        if db_ok and not IS_PRODUCTION:
-            sync_urls_to_db()
 
-        cycle_start = time.time()
-        total_cycle_changes = 0
-        total_stats = {'fetched': 0, 'failed': 0}
+def shopify_bulk_to_js(product: dict):
+    # /products.json uses major-unit price strings and image lists; reshape to the .js format
+    def minor(amount):
+        try:
+            return int(round(float(amount) * 100))
+        except (TypeError, ValueError):
+            return None
+
+    images = product.get('images') or []
+    variants = []
+    for variant in product.get('variants') or []:
+        variants.append({
+            "id": variant.get('id'),
+            "available": bool(variant.get('available')),
+            "price": minor(variant.get('price')),
+            "featured_image": variant.get('featured_image'),
+        })
+    return {
+        "title": product.get('title'),
+        "variants": variants,
+        "available": any(v["available"] for v in variants),
+        "price": variants[0]["price"] if variants else None,
+        "featured_image": images[0].get('src') if images else None,
+        "tags": product.get('tags') or [],
+        "description": product.get('body_html') or '',
+    }
 
-        for franchise in FRANCHISES:
-            global CURRENT_FRANCHISE, CURRENT_WEBHOOK, CURRENT_ROLE_ID
-            CURRENT_FRANCHISE = franchise
-            franchise_name = franchise["name"]
-            CURRENT_WEBHOOK = None
-            CURRENT_ROLE_ID = None
-
-            print(f"\n{'='*50}")
-            print(f" Scanning {franchise_name}...")
-            print(f"{'='*50}")
-
-            direct_files = franchise.get("direct_files", [])
-            if not direct_files:
-                print(f"   No direct files for {franchise_name}")
-                continue
 
-            stats = {'fetched': 0, 'failed': 0}
-            franchise_changes = 0
+def fetch_shopify_bulk_products(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str):
+    parsed = urlparse(url)
+    json_headers = dict(headers)
+    json_headers["Accept"] = "application/json"
+    json_headers.pop("Upgrade-Insecure-Requests", None)
+    session = get_session_for_domain(domain)
+    proxies = proxies_for_url(url) if use_proxy else None
+    products = {}
+    for page in range(1, SHOPIFY_BULK_MAX_PAGES + 1):
+        # The check that started the poll already paid for page 1; later pages go through the bucket
+        if page > 1 and take_domain_token(domain, time.monotonic()):
+            break
+        try:
+            r = session.get(f"{parsed.scheme}://{parsed.netloc}/products.json",
+                            params={"limit": SHOPIFY_BULK_PAGE_SIZE, "page": page},
+                            headers=json_headers, timeout=min(timeout_s, MAX_TIMEOUT), proxies=proxies)
+            batch = r.json().get('products') if r.status_code == 200 else None
+        except (requests.exceptions.RequestException, ValueError, AttributeError):
+            batch = None
+        if not batch:
+            break
+        for product in batch:
+            if product.get('handle'):
+                products[product['handle']] = product
+        if len(batch) < SHOPIFY_BULK_PAGE_SIZE:
+            SHOPIFY_BULK_PAGES[domain] = page
+            break
+    return products
 
-            dormant_files = franchise.get("dormant_files", [])
-            for file_path in direct_files:
-                file_name = file_path.split('/')[-1].replace('.txt', '')
-                file_urls = load_urls_from_db(file_path)
-                is_dormant = file_path in dormant_files
 
-                if not file_urls:
-                    continue
+def shopify_bulk_max_age():
+    # One poll per domain per check interval, so spread-out checks don't re-poll within it
+    return CHECK_INTERVAL * (1 - CHECK_JITTER)
 
-                if not is_dormant:
-                    if file_name not in HOURLY_STATS:
-                        HOURLY_STATS[file_name] = {'fetched': 0, 'failed': 0, 'alerts': 0, 'products': len(file_urls)}
-                    else:
-                        HOURLY_STATS[file_name]['products'] = len(file_urls)
-                    if file_name not in DAILY_STATS:
-                        DAILY_STATS[file_name] = {'fetched': 0, 'failed': 0, 'alerts': 0, 'products': len(file_urls)}
-                    else:
-                        DAILY_STATS[file_name]['products'] = len(file_urls)
-
-                file_stats = {'fetched': 0, 'failed': 0, 'alerts': 0, 'skipped': 0}
-                dormant_label = " [DORMANT]" if is_dormant else ""
-                print(f"\n {file_name}{dormant_label} ({len(file_urls)} products)")
-
-                requests_urls = []
-                pw_urls = []
-
-                for url in file_urls:
-                    domain = _host_for_url(url)
-                    health = DOMAIN_HEALTH.get(domain, {})
-                    if health.get('strategy', 'requests') == 'playwright':
-                        pw_urls.append((url, file_path, is_dormant))
-                    else:
-                        requests_urls.append((url, file_path, is_dormant))
-
-                with ThreadPoolExecutor(max_workers=8) as requests_executor, ThreadPoolExecutor(max_workers=1) as pw_executor:
-                    futures = []
-                    for url, fp, dormant in requests_urls:
-                        prev = direct_state.get(url)
-                        futures.append(requests_executor.submit(check_direct_product, url, prev, file_stats, fp, False, dormant))
-                    for url, fp, dormant in pw_urls:
-                        prev = direct_state.get(url)
-                        futures.append(pw_executor.submit(check_direct_product, url, prev, file_stats, fp, False, dormant))
-
-                    for future in as_completed(futures):
-                        current_state, change = future.result()
-                        if current_state:
-                            direct_state[url] = current_state
-                            detailed_status = current_state.get("stock_status", "unknown").upper()
-
-                            if change and not first_run:
-                                print(f" Potential {change.get('type', 'change')} - verifying...", end=" ")
-                                time.sleep(5)
-                                verified_state, _ = check_direct_product(
-                                    url, direct_state.get(url), file_stats,
-                                    store_file=file_path, is_verification=True, is_dormant=is_dormant
-                                )
-                                if verified_state:
-                                    verified_status = verified_state.get("stock_status", "unknown")
-                                    if verified_status in ("in", "preorder"):
-                                        direct_state[url]["in_stock"] = True
-                                        last_alerted = direct_state[url].get("last_alerted")
-                                        if not should_alert(last_alerted):
-                                            print(f" {'PREORDER' if verified_status == 'preorder' else 'IN STOCK'} (no alert)")
-                                        else:
-                                            franchise_changes += 1
-                                            file_stats['alerts'] += 1
-                                            is_preorder = verified_status == "preorder"
-                                            print(f" {'PREORDER CONFIRMED!' if is_preorder else 'RESTOCK CONFIRMED!'}")
-                                            img = verified_state.get("image_url") or change.get("image_url")
-                                            prc = verified_state.get("price") or change.get("price")
-                                            send_alert(
-                                                change['name'], change["url"], _host_for_url(url),
-                                                is_preorder=is_preorder, is_new=False,
-                                                image_url=img, price=prc,
-                                                store_file=file_path
-                                            )
-                                            direct_state[url]["last_alerted"] = datetime.now(timezone.utc)
-                                            save_product(url, current_state["name"], True)
-                                            mark_alerted(url)
-                                    else:
-                                        print(f" Verification failed ({verified_status.upper()})")
-                                        save_product(url, current_state["name"], False)
-                                else:
-                                    print(f" Verification failed (no response)")
-                            else:
-                                if is_dormant and detailed_status == "OUT":
-                                    pass
-                                elif detailed_status in ("IN", "PREORDER") and prev and prev.get("in_stock"):
-                                    print(f"{detailed_status} - ping already sent")
-                                else:
-                                    print(f"{detailed_status}")
-
-                            prev_in_stock = prev.get("in_stock") if prev else None  # <-- fixed NameError here (prev_state → prev)
-                            if current_state["in_stock"] != prev_in_stock:
-                                save_product(url, current_state["name"], current_state["in_stock"])
-
-                    # small delay per URL + jitter
-                    time.sleep(max(1, 1 + random.uniform(-0.5, 1.5)))
-
-                if not is_dormant:
-                    HOURLY_STATS[file_name]['fetched'] += file_stats['fetched']
-                    HOURLY_STATS[file_name]['failed'] += file_stats['failed']
-                    HOURLY_STATS[file_name]['alerts'] += file_stats['alerts']
-                    DAILY_STATS[file_name]['fetched'] += file_stats['fetched']
-                    DAILY_STATS[file_name]['failed'] += file_stats['failed']
-                    DAILY_STATS[file_name]['alerts'] += file_stats['alerts']
-
-                stats['fetched'] += file_stats['fetched']
-                stats['failed'] += file_stats['failed']
-
-            print(f"\n {franchise_name}: {franchise_changes} alerts sent")
-            print(f"   Stats: {stats['fetched']} fetched, {stats['failed']} failed")
-
-            total_cycle_changes += franchise_changes
-            total_stats['fetched'] += stats['fetched']
-            total_stats['failed'] += stats['failed']
-
-        cycle_time = round(time.time() - cycle_start, 1)
 
-        TOTAL_SCANS += 1
-        DAILY_SCANS += 1
+def shopify_bulk_worthwhile(domain):
+    handles = SHOPIFY_HANDLE_COUNTS.get(domain, 0)
+    return handles >= SHOPIFY_BULK_MIN_HANDLES and handles > SHOPIFY_BULK_PAGES.get(domain, SHOPIFY_BULK_MAX_PAGES)
 
-        if first_run:
-            print(f"\n{'='*50}")
-            print(f" Initial scan complete! Tracking {len(direct_state)} products")
-            print("   Future changes will trigger Discord alerts.")
-            print(f"{'='*50}\n")
-            first_run = False
-        else:
-            print(f"\n{'='*50}")
-            if total_cycle_changes > 0:
-                print(f" Cycle complete. {total_cycle_changes} total alerts sent.")
-            else:
-                print(f" Cycle complete. No changes detected.")
-
-        print(f" Total: {total_stats['fetched']} fetched, {total_stats['failed']} failed | {header_type} | Cycle: {cycle_time}s")
-
-        now_utc = datetime.now(timezone.utc)
-        now_london = now_utc.astimezone(ZoneInfo("Europe/London"))
-        current_hour = now_london.strftime("%Y-%m-%d %H")
-        current_day = now_london.strftime("%Y-%m-%d")
-
-        # HOURLY PING
-        if HOURLY_WEBHOOK := os.getenv("HOURLYDATA"):
-            if now_london.minute < 15 and LAST_HOURLY_PING != current_hour:
-                prev_hour = now_london - timedelta(hours=1)
-                time_range = f"{prev_hour.strftime('%H:%M')} - {now_london.strftime('%H:%M')}"
-
-                file_breakdown = ""
-                total_hourly_alerts = 0
-                total_hourly_fetched = 0
-                total_hourly_failed = 0
-                for file_name, st in sorted(HOURLY_STATS.items()):
-                    file_breakdown += f"  • **{file_name}**: {st['products']} products, {st['fetched']} fetched, {st['failed']} failed, {st['alerts']} alerts\n"
-                    total_hourly_alerts += st['alerts']
-                    total_hourly_fetched += st['fetched']
-                    total_hourly_failed += st['failed']
-
-                failed_sites_text = ""
-                if HOURLY_FAILED_DETAILS:
-                    failed_sites_text = f"\n**Failed Requests ({len(HOURLY_FAILED_DETAILS)} total)**\n"
-                    for fail in HOURLY_FAILED_DETAILS:
-                        failed_sites_text += f"  • {fail['url']} | {fail['file']} | {fail['reason']}\n"
-
-                hourly_summary = (
-                    f"🟢 **Hourly Bot Status** ({now_london.strftime('%d %B %Y %H:00 UK time')})\n"
-                    f"**Period covered: {time_range}**\n\n"
-                    f"**Overall Stats**\n"
-                    f"• **Products tracked**: {len(direct_state)}\n"
-                    f"• **Full cycle scans completed**: {TOTAL_SCANS}\n"
-                    f"• **Total fetched**: {total_hourly_fetched}\n"
-                    f"• **Total failed**: {total_hourly_failed}\n"
-                    f"• **Alerts sent**: {total_hourly_alerts}\n\n"
-                    f"**Per-File Breakdown**\n{file_breakdown}"
-                    f"{failed_sites_text}\n"
-                    f"• **Bot status**: ✅ Active"
-                )
-                if len(hourly_summary) > 1950:
-                    hourly_summary = hourly_summary[:1950] + "\n..."
-                try:
-                    resp = SESSION.post(HOURLY_WEBHOOK, json={"content": hourly_summary}, timeout=10)
-                    if resp.status_code == 204:
-                        print(" Sent hourly status ping")
-                    else:
-                        print(f" Hourly ping returned HTTP {resp.status_code}: {resp.text[:100]}")
-                    LAST_HOURLY_PING = current_hour
-                    save_ping_state("hourly", current_hour)
-                    HOURLY_STATS = {k: {'fetched': 0, 'failed': 0, 'alerts': 0, 'products': v['products']} for k, v in HOURLY_STATS.items()}
-                    HOURLY_FAILED_DETAILS.clear()
-                    TOTAL_SCANS = 0
-                except Exception as e:
-                    print(f" Hourly ping failed: {e}")
-
-        # DAILY PING
-        if DAILY_WEBHOOK := os.getenv("DAILYDATA"):
-            if now_london.hour == 8 and now_london.minute < 15 and LAST_DAILY_PING != current_day:
-                yesterday = (now_london - timedelta(days=1)).strftime("%d %B %Y")
-
-                daily_file_breakdown = ""
-                daily_total_alerts = 0
-                daily_total_fetched = 0
-                daily_total_failed = 0
-                for file_name, st in sorted(DAILY_STATS.items()):
-                    daily_file_breakdown += f"  • **{file_name}**: {st['products']} products, {st['fetched']} fetched, {st['failed']} failed, {st['alerts']} alerts\n"
-                    daily_total_alerts += st['alerts']
-                    daily_total_fetched += st['fetched']
-                    daily_total_failed += st['failed']
-
-                daily_summary = (
-                    f"📅 **Daily Bot Report – {yesterday}**\n\n"
-                    f"**Overall Summary**\n"
-                    f"• **Total products tracked**: {len(direct_state)}\n"
-                    f"• **Full cycle scans completed**: {DAILY_SCANS}\n"
-                    f"• **Total fetched**: {daily_total_fetched}\n"
-                    f"• **Total failed**: {daily_total_failed}\n"
-                    f"• **Total alerts sent**: {daily_total_alerts}\n\n"
-                    f"**Per-File Breakdown**\n{daily_file_breakdown}\n"
-                    f"• **Bot status**: ✅ Active\n"
-                    f"• **Last full cycle**: {datetime.now(timezone.utc).strftime('%H:%M UTC')}"
-                )
-                if len(daily_summary) > 1950:
-                    daily_summary = daily_summary[:1950] + "\n..."
-                try:
-                    resp = SESSION.post(DAILY_WEBHOOK, json={"content": daily_summary}, timeout=10)
-                    if resp.status_code == 204:
-                        print(" Sent daily status ping (8 AM UK time)")
-                    else:
-                        print(f" Daily ping returned HTTP {resp.status_code}: {resp.text[:100]}")
-                    LAST_DAILY_PING = current_day
-                    save_ping_state("daily", current_day)
-                    DAILY_STATS = {k: {'fetched': 0, 'failed': 0, 'alerts': 0, 'products': v['products']} for k, v in DAILY_STATS.items()}
-                    DAILY_SCANS = 0
-                except Exception as e:
-                    print(f" Daily ping failed: {e}")
-
-        print(f" Next scan in {CHECK_INTERVAL} seconds...\n")
-        time.sleep(CHECK_INTERVAL)
 
+def shopify_bulk_lookup(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str):
+    # One /products.json poll answers every monitored handle on the domain for a check interval;
+    # handles it didn't include fall back to the per-handle .js check
+    handle = shopify_handle_for_url(url)
+    if not handle or not shopify_bulk_worthwhile(domain):
+        return None
+    with SHOPIFY_BULK_LOCKS_GUARD:
+        lock = SHOPIFY_BULK_LOCKS.setdefault(domain, threading.Lock())
+    with lock:
+        cached = SHOPIFY_BULK_CACHE.get(domain)
+        if cached is None or time.monotonic() - cached["fetched_at"] > shopify_bulk_max_age():
+            cached = {
+                "fetched_at": time.monotonic(),
+                "products": fetch_shopify_bulk_products(url, headers, timeout_s, use_proxy, domain),
+            }
+            SHOPIFY_BULK_CACHE[domain] = cached
+    product = cached["products"].get(handle)
+    if not product:
+        return None
+    return parse_shopify_product(shopify_bulk_to_js(product), url)
 
-if __name__ == "__main__":
-    main()
 
-import requests
-from bs4 import BeautifulSoup
-import time
-import os
-import random
-import re
-import psycopg2
-from psycopg2 import pool
-import traceback
-from urllib.parse import urljoin, urlparse, urlunparse
-from datetime import datetime, timedelta, timezone
-from zoneinfo import ZoneInfo
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-import json
-import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from requests.utils import dict_from_cookiejar, cookiejar_from_dict
+def fetch_fast_path(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str, is_verification=False):
+    # Cheapest exact stock source for the domain's platform, None when the HTML page is needed
+    platform = DOMAIN_PLATFORMS.get(domain)
+    if platform == "woocommerce":
+        return fetch_woocommerce_product_json(url, headers, timeout_s, use_proxy, domain)
+    if not use_shopify_fast_path(domain):
+        return None
+    if platform == "shopify" and not is_verification:
+        result = shopify_bulk_lookup(url, headers, timeout_s, use_proxy, domain)
+        if result:
+            return result
+    return fetch_shopify_product_json(url, headers, timeout_s, use_proxy, domain)
 
-# Correct stealth import
-from playwright_stealth import stealth
 
 # =========================================================
-#  PLAYWRIGHT (optional but supported)
+#  SKIP/FAIL HELPERS
 # =========================================================
-PLAYWRIGHT_AVAILABLE = False
-try:
-    from playwright.sync_api import sync_playwright
-    PLAYWRIGHT_AVAILABLE = True
-except Exception:
-    PLAYWRIGHT_AVAILABLE = False
-
-
-# =========================================================
-#  DECODO PROXY SUPPORT (requests + optional Playwright proxy)
-# =========================================================
-DECODO_BLOCKED_DOMAINS = {
-    "thetoyplanet.co.uk",
-    "johnlewis.com",
-    # Add more as needed
-}
+def is_site_in_failure_cooldown(url):
+    # Called from many fetch threads at once (a URL can sit in two files), so no check-then-index
+    failure_time = FAILED_SITES.get(url)
+    if failure_time is None:
+        return False
+    if datetime.now(timezone.utc) - failure_time < timedelta(minutes=FAILURE_COOLDOWN_MINUTES):
+        return True
+    FAILED_SITES.pop(url, None)
+    return False
 
 
-def _host_for_url(url: str) -> str:
-    try:
-        host = url.split("/")[2].lower()
-    except Exception:
-        return ""
-    if host.startswith("www."):
-        host = host[4:]
-    return host
+def mark_site_failed(url):
+    FAILED_SITES[url] = datetime.now(timezone.utc)
 
 
-def proxies_for_url(url: str):
-    host = _host_for_url(url)
-    if not host or host not in DECODO_BLOCKED_DOMAINS:
-        return None
+def is_js_only_url(url):
+    return any(pattern in url.lower() for pattern in JS_URL_PATTERNS)
 
-    user = os.getenv("DECODO_USER")
-    pw = os.getenv("DECODO_PASS")
-    proxy_host = os.getenv("DECODO_HOST", "proxy.decodo.com")
-    proxy_port = os.getenv("DECODO_PORT", "10000")
 
-    if not user or not pw:
-        return None
+def is_js_only_page(html_content, product_count):
+    if len(html_content) < 2000 and product_count < 3:
+        return True
+    html_lower = html_content.lower()
+    return any(indicator in html_lower for indicator in JS_PAGE_INDICATORS)
 
-    proxy = f"http://{user}:{pw}@{proxy_host}:{proxy_port}"
-    return {"http": proxy, "https": proxy}
 
+def is_in_js_skip_cache(url):
+    if url not in JS_SKIP_CACHE:
+        return False
+    if datetime.now(timezone.utc) < JS_SKIP_CACHE[url]:
+        return True
+    del JS_SKIP_CACHE[url]
+    return False
 
-def playwright_proxy_for_url(url: str):
-    host = _host_for_url(url)
-    if not host or host not in DECODO_BLOCKED_DOMAINS:
-        return None
 
-    user = os.getenv("DECODO_USER")
-    pw = os.getenv("DECODO_PASS")
-    proxy_host = os.getenv("DECODO_HOST", "proxy.decodo.com")
-    proxy_port = os.getenv("DECODO_PORT", "10000")
+def add_to_js_skip_cache(url):
+    JS_SKIP_CACHE[url] = datetime.now(timezone.utc) + timedelta(minutes=JS_SKIP_MINUTES)
 
-    if not user or not pw:
-        return None
 
-    return {
-        "server": f"http://{proxy_host}:{proxy_port}",
-        "username": user,
-        "password": pw,
-    }
+# =========================================================
+#  ALERT CONTROL
+# =========================================================
+def should_alert(last_alerted):
+    return True  # Always alert on change (no cooldown)
 
 
 # =========================================================
-#  PLAYWRIGHT DOMAINS (JS-heavy / bot-protected)
+#  SEND ALERT
 # =========================================================
-PLAYWRIGHT_DOMAINS = {
-    "argos.co.uk",
-    "freemans.com",
-    "currys.co.uk",
-    "forbiddenplanet.com",
-    "game.co.uk",
-    "houseoffraser.co.uk",
-    "hamleys.com",
-    "hillscards.co.uk",
-    "hmv.com",
-    "jdwilliams.co.uk",
-    "johnlewis.com",
-    "sportsdirect.com",
-    "very.co.uk",
-    "waylandgames.co.uk",
-    "alchemistsworkshops.com",
-    "chaoscards.co.uk",
-    "board-game.co.uk",
-    "newrealitiesgaming.com",
-    "firestormgames.co.uk",
-    "tritex-games.co.uk",
-}
+def send_alert(product_name, url, store_name, is_preorder=False, is_new=False,
+               image_url=None, price=None, store_file=None):
+    webhook_url = None
+    role_id = None
+
+    for group in CURRENT_FRANCHISE.get("webhook_secrets", []):
+        if store_file and group["file"] == store_file:
+            webhook_url = group["webhook"]
+            break
 
+    role_id = CURRENT_FRANCHISE.get("role_id")
 
-def should_use_playwright(url: str) -> bool:
-    host = _host_for_url(url)
-    return host in PLAYWRIGHT_DOMAINS
+    if webhook_url is None:
+        webhook_url = CURRENT_WEBHOOK
 
+    if webhook_url is None:
+        print(" Warning: No webhook for this file/group")
+        return
 
-# =========================================================
-#  DATABASE CONNECTION POOL
-# =========================================================
-DB_POOL = None
-MAX_TIMEOUT = 60
-IS_PRODUCTION = os.getenv("REPLIT_DEPLOYMENT") == "1"
-DATABASE_URL = os.getenv("DATABASE_URL")
+    if is_preorder:
+        title = f"PREORDER AVAILABLE - {product_name}"
+        status = "Preorder"
+        color = 16753920
+        emoji = "📋"
+    elif is_new:
+        title = f"NEW PRODUCT - {product_name}"
+        status = "In Stock"
+        color = 3447003
+        emoji = "🆕"
+    else:
+        title = f"BACK IN STOCK - {product_name}"
+        status = "In Stock"
+        color = 65280
+        emoji = "📦"
 
+    role_mention = f"<@&{role_id}>" if role_id else ""
 
-# =========================================================
-#  FRANCHISE CONFIGURATIONS
-# =========================================================
-FRANCHISES = [
-    {
-        "name": "Pokemon",
-        "role_id": os.getenv("POKE_ROLE"),
-        "direct_files": [
-            "Pokemon/Poke-30A.txt",
-            "Pokemon/Poke-AH.txt",
-            "Pokemon/Poke-DR.txt",
-            "Pokemon/Poke-ME.txt",
-            "Pokemon/Poke-PO.txt",
-            "Pokemon/Poke-Other.txt"
-        ],
-        "webhook_secrets": [
-            {"file": "Pokemon/Poke-30A.txt", "webhook": os.getenv("POKE30A")},
-            {"file": "Pokemon/Poke-AH.txt", "webhook": os.getenv("POKEAH")},
-            {"file": "Pokemon/Poke-DR.txt", "webhook": os.getenv("POKEDR")},
-            {"file": "Pokemon/Poke-ME.txt", "webhook": os.getenv("POKEME")},
-            {"file": "Pokemon/Poke-PO.txt", "webhook": os.getenv("POKEPO")},
-            {"file": "Pokemon/Poke-Other.txt", "webhook": os.getenv("POKEOTHER")},
-        ],
-        "dormant_files": ["Pokemon/Poke-Other.txt"]
-    },
-    {
-        "name": "One Piece",
-        "role_id": os.getenv("OP_ROLE"),
-        "direct_files": [
-            "One Piece/EB-02.txt",
-            "One Piece/EB-03.txt",
-            "One Piece/IB-V5.txt",
-            "One Piece/IB-V6.txt",
-            "One Piece/OP-13.txt",
-            "One Piece/OP-14.txt",
-            "One Piece/OP-Other.txt"
+    embed = {
+        "title": title,
+        "url": url,
+        "color": color,
+        "fields": [
+            {"name": "Retailer", "value": store_name, "inline": True},
+            {"name": "Price", "value": price or "N/A", "inline": True},
+            {"name": "Status", "value": status, "inline": True},
+            {"name": "Direct Link", "value": f"[Click Here]({url})", "inline": False}
         ],
-        "webhook_secrets": [
-            {"file": "One Piece/EB-02.txt", "webhook": os.getenv("EB02")},
-            {"file": "One Piece/EB-03.txt", "webhook": os.getenv("EB03")},
-            {"file": "One Piece/IB-V5.txt", "webhook": os.getenv("IBV5")},
-            {"file": "One Piece/IB-V6.txt", "webhook": os.getenv("IBV6")},
-            {"file": "One Piece/OP-13.txt", "webhook": os.getenv("OP13")},
-            {"file": "One Piece/OP-14.txt", "webhook": os.getenv("OP14")},
-            {"file": "One Piece/OP-Other.txt", "webhook": os.getenv("OPOTHER")},
-        ]
+        "footer": {"text": f"{CURRENT_FRANCHISE['name']} Restocks Monitor"},
+        "timestamp": datetime.now(timezone.utc).isoformat()
     }
-]
 
-CURRENT_FRANCHISE = None
-CURRENT_WEBHOOK = None
-CURRENT_ROLE_ID = None
+    if image_url:
+        embed["thumbnail"] = {"url": image_url}
+
+    data = {
+        "content": f"{emoji} **RESTOCK** - **{product_name}** @{store_name} {role_mention}",
+        "embeds": [embed],
+        "allowed_mentions": {"parse": ["roles"]}
+    }
+
+    try:
+        r = SESSION.post(webhook_url, json=data, timeout=10)
+        if r.status_code == 204:
+            print(f" Alert sent to {store_file or 'default'}!")
+        else:
+            print(f" Failed to send alert ({r.status_code}): {r.text[:200]}")
+    except Exception as e:
+        print(f" Discord error: {e}")
 
 
 # =========================================================
-#  SESSION (requests) + retries/backoff
+#  TIMEOUTS
 # =========================================================
-retry_strategy = Retry(
-    total=1,
-    backoff_factor=1,
-    status_forcelist=[429, 500, 502, 503, 504],
-    allowed_methods=frozenset(["GET", "POST"])
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
+SLOW_SITES = ["very.co.uk", "game.co.uk", "johnlewis.com", "argos.co.uk"]  # starting point until measured
+LATENCY_SAMPLES = 50  # per-domain rolling window
+MIN_LATENCY_SAMPLES = 5
+TIMEOUT_FACTOR = float(os.getenv("TIMEOUT_FACTOR", "3"))
+MIN_TIMEOUT = 5
 
-SESSION = requests.Session()
-SESSION.mount("http://", adapter)
-SESSION.mount("https://", adapter)
 
-DOMAIN_SESSIONS = {}
+def record_latency(health, latency):
+    health['latency'].append(latency)
+    if len(health['latency']) > LATENCY_SAMPLES:
+        del health['latency'][:len(health['latency']) - LATENCY_SAMPLES]
+
+
+def latency_percentile(latencies, pct):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def get_timeout_for_url(url, health):
+    # Rolling p99 x TIMEOUT_FACTOR once a domain has history, clamped to [MIN_TIMEOUT, MAX_TIMEOUT].
+    # Timeouts are recorded as samples too, so a shop that slows down earns a longer limit.
+    if len(health['latency']) >= MIN_LATENCY_SAMPLES:
+        timeout_s = latency_percentile(health['latency'], 0.99) * TIMEOUT_FACTOR
+        return int(min(MAX_TIMEOUT, max(MIN_TIMEOUT, timeout_s)) + 0.5)
+    if any(site in url for site in SLOW_SITES):
+        return 45
+    return 15 if health['strategy'] == 'requests' else 20
 
 
 # =========================================================
-#  HEADERS: desktop/mobile (toggle each cycle) + realistic UAs
+#  PRODUCT DETAILS (display metadata, extracted lazily)
 # =========================================================
-REAL_UAS = [
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:124.0) Gecko/20100101 Firefox/124.0",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14.3) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.3 Safari/605.1.15",
+IMAGE_SELECTORS = [
+    'img.product-featured-image', 'img.product-image', 'img.product__image',
+    'meta[property="og:image"]', 'meta[name="og:image"]'
 ]
+PRICE_SELECTORS = ['.price', '.product-price', 'meta[property="product:price:amount"]', '[data-hook="formatted-primary-price"]']
+PRICE_TEXT_PATTERN = re.compile(r'[£$€][\d,]+\.?\d*')
 
-LANG_HEADERS = [
-    "en-GB,en;q=0.9",
-    "en-US,en;q=0.9",
-    "en-GB,en-US;q=0.9,en;q=0.8",
-]
 
-REFERERS = [
-    "https://www.google.com/",
-    "https://www.google.co.uk/",
-    "https://www.bing.com/",
-    None,
-]
+def extract_display_details(soup, url):
+    domain = _host_for_url(url)
+    image_url = None
+    for selector in ordered_selectors(IMAGE_SELECTORS, profile_selector(domain, "image")):
+        elem = soup.select_one(selector)
+        if elem:
+            if elem.name == 'meta':
+                image_url = elem.get('content')
+            else:
+                image_url = elem.get('src') or elem.get('data-src')
+            if image_url:
+                if image_url.startswith('//'):
+                    image_url = 'https:' + image_url
+                elif image_url.startswith('/'):
+                    parsed = urlparse(url)
+                    image_url = f"{parsed.scheme}://{parsed.netloc}{image_url}"
+                remember_selector(domain, "image", selector)
+                break
+
+    price = None
+    for selector in ordered_selectors(PRICE_SELECTORS, profile_selector(domain, "price")):
+        elem = soup.select_one(selector)
+        if elem:
+            if elem.name == 'meta':
+                amt = elem.get('content')
+                if amt:
+                    price = f"£{amt}"
+            else:
+                price_text = elem.get_text(strip=True)
+                match = PRICE_TEXT_PATTERN.search(price_text)
+                if match:
+                    price = match.group()
+            if price:
+                remember_selector(domain, "price", selector)
+                break
 
-USE_MOBILE_HEADERS = False
+    return image_url, price
 
 
-def get_headers_for_url(url: str) -> dict:
-    ua = random.choice(REAL_UAS)
-    lang = random.choice(LANG_HEADERS)
-    referer = random.choice(REFERERS)
+class ProductDetails:
+    # Image and price are only needed when an alert goes out, so HTML pages keep the raw
+    # document here and parse it for the selectors on first access, then let it go
+    __slots__ = ("_raw_html", "_base_url", "_image_url", "_price")
 
-    headers = {
-        "User-Agent": ua,
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
-        "Accept-Language": lang,
-        "Accept-Encoding": "gzip, deflate, br",
-        "Connection": "keep-alive",
-        "Upgrade-Insecure-Requests": "1",
-        "Sec-Fetch-Dest": "document",
-        "Sec-Fetch-Mode": "navigate",
-        "Sec-Fetch-Site": "none",
-        "Sec-Fetch-User": "?1",
-    }
-    if referer:
-        headers["Referer"] = referer
+    def __init__(self, raw_html=None, base_url="", image_url=None, price=None):
+        self._raw_html = raw_html
+        self._base_url = base_url
+        self._image_url = image_url
+        self._price = price
 
-    if USE_MOBILE_HEADERS:
-        headers["User-Agent"] = "Mozilla/5.0 (iPhone; CPU iPhone OS 17_3 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.3 Mobile/15E148 Safari/604.1"
+    def _resolve(self):
+        if self._raw_html is not None:
+            self._image_url, self._price = extract_display_details(make_soup(self._raw_html), self._base_url)
+            self._raw_html = None
 
-    return headers
+    @property
+    def image_url(self):
+        self._resolve()
+        return self._image_url
+
+    @property
+    def price(self):
+        self._resolve()
+        return self._price
 
 
 # =========================================================
-#  OPTIMIZATION: Failed site cache (skip for 3 minutes)
+#  PARSE STAGE (process pool, outside the GIL)
 # =========================================================
-FAILED_SITES = {}  # {url: failure_time}
-FAILURE_COOLDOWN_MINUTES = 3
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))  # 0 parses inline
+PARSE_QUEUE_MAX = int(os.getenv("PARSE_QUEUE_MAX", str(max(1, PARSE_WORKERS) * 2)))
+PARSE_SLOTS = threading.BoundedSemaphore(PARSE_QUEUE_MAX)  # pages handed to the pool and not yet parsed
+PARSE_POOL = None
+IN_PARSE_WORKER = False  # set by the pool initializer; inline parsing shares the parent's profiles
+PARSE_POOL_LOCK = threading.Lock()
 
 
-# =========================================================
-#  HOURLY/DAILY PING TRACKING + STATS
-# =========================================================
-LAST_HOURLY_PING = None
-LAST_DAILY_PING = None
+def product_name_from_url(url):
+    return urlparse(url).path.split('/')[-1].replace('-', ' ').replace('.html', '')[:100]
 
-HOURLY_STATS = {}
-DAILY_STATS = {}
-TOTAL_SCANS = 0
-DAILY_SCANS = 0
-HOURLY_FAILED_DETAILS = []
+
+def parse_product_page(raw_html, url, base_url, franchise=None, profile=None, previous_fingerprint=None):
+    # Pure function of its arguments so it can run in a parse worker process; returns plain data only.
+    # status: "ok", "unavailable" (store closed/password page), "filtered" (not a TCG product)
+    # or "unchanged" (product region matches previous_fingerprint, nothing else was evaluated)
+    domain = _host_for_url(url)
+    if IN_PARSE_WORKER:
+        # The worker's own copy of the module only knows what the parent sends with each page
+        if profile is not None:
+            EXTRACTION_PROFILES[domain] = dict(profile)
+        else:
+            EXTRACTION_PROFILES.pop(domain, None)
+    result = {"status": "ok", "name": None, "stock_status": "out", "image_url": None, "price": None,
+              "structured": False, "profile": None, "fingerprint": None}
+
+    structured = extract_structured_offer(raw_html, base_url)
+    if structured:
+        # Product offer markup: no tree walk, text extraction or term matching needed
+        result.update(structured, structured=True)
+        result["name"] = structured["name"] or title_from_html(raw_html) or product_name_from_url(url)
+        if not is_tcg_product(result["name"], url):
+            result.update(status="filtered", stock_status="out")
+        return result
+
+    soup = make_soup(raw_html)
+    main_area = find_main_product_area(soup, domain)
+    if main_area is not None:
+        # Only the buy box is fingerprinted; whole pages change every request (tokens, carousels)
+        result["fingerprint"] = region_fingerprint(main_area)
+        if result["fingerprint"] == previous_fingerprint:
+            result.update(status="unchanged", profile=EXTRACTION_PROFILES.get(domain))
+            return result
+
+    page_text = soup.get_text()
+    if is_store_unavailable(page_text):
+        result["status"] = "unavailable"
+        return result
+
+    product_name = None
+    title_tag = soup.find('title')
+    if title_tag:
+        product_name = title_tag.get_text(strip=True)[:100]
+    if not product_name:
+        h1 = soup.find('h1')
+        if h1:
+            product_name = h1.get_text(strip=True)[:100]
+    if not product_name:
+        product_name = product_name_from_url(url)
+    result["name"] = product_name
+
+    if product_name and not is_tcg_product(product_name, url):
+        result["status"] = "filtered"
+        return result
+
+    result["stock_status"] = classify_stock_with_soup(soup, page_text, raw_html, franchise, domain)
+    with EXTRACTION_PROFILES_LOCK:
+        result["profile"] = dict(EXTRACTION_PROFILES[domain]) if domain in EXTRACTION_PROFILES else None
+    return result
+
+
+def _init_parse_worker():
+    # Parse workers import this module too; only the parent may flush writes or save profiles
+    global IN_PARSE_WORKER
+    IN_PARSE_WORKER = True
+    atexit.unregister(stop_write_behind)
+    atexit.unregister(save_extraction_profiles)
+    atexit.unregister(stop_playwright_pool)
+    atexit.unregister(stop_parse_pool)
+
+
+def get_parse_pool():
+    global PARSE_POOL
+    if PARSE_WORKERS <= 0:
+        return None
+    with PARSE_POOL_LOCK:
+        if PARSE_POOL is None:
+            # spawn, not fork: the parent has DB, browser and event-loop threads that must not be forked mid-lock
+            PARSE_POOL = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_parse_worker,
+            )
+        return PARSE_POOL
 
 
-# =========================================================
-#  JS skip cache + verified out cache
-# =========================================================
-JS_SKIP_CACHE = {}
-JS_SKIP_MINUTES = 5
+def stop_parse_pool():
+    global PARSE_POOL
+    with PARSE_POOL_LOCK:
+        if PARSE_POOL is not None:
+            PARSE_POOL.shutdown(wait=False, cancel_futures=True)
+            PARSE_POOL = None
 
-VERIFIED_OUT_CACHE = set()
 
-JS_URL_PATTERNS = ['#/', 'dffullscreen', '?view=ajax', 'doofinder']
-JS_PAGE_INDICATORS = ['enable javascript', 'javascript is required', 'doofinder',
-                      'please enable javascript', 'browser does not support']
+def run_parse_stage(raw_html, url, base_url, franchise, domain, previous_fingerprint=None):
+    profile = EXTRACTION_PROFILES.get(domain)
+    pool = get_parse_pool()
+    result = None
+    if pool is not None:
+        # Fetch threads block here while the pool is full, so raw pages never pile up in memory
+        with PARSE_SLOTS:
+            try:
+                result = pool.submit(parse_product_page, raw_html, url, base_url, franchise, profile,
+                                     previous_fingerprint).result()
+            except BrokenProcessPool:
+                print(" Parse pool crashed, restarting it")
+                stop_parse_pool()
+    if result is None:
+        result = parse_product_page(raw_html, url, base_url, franchise, profile, previous_fingerprint)
+    for kind, selector in (result["profile"] or {}).items():
+        remember_selector(domain, kind, selector)
+    return result
+
+
+atexit.register(stop_parse_pool)
 
 
 # =========================================================
-#  PRODUCT TYPE FILTERING
+#  DIRECT PRODUCT CHECK
 # =========================================================
-BLOCK_KEYWORDS = [
-    "plush", "plushie", "figure", "toy",
-    "mug", "cup", "glass",
-    "poster", "art", "canvas",
-    "postcard", "stationery",
-    "clothing", "hoodie", "t-shirt", "shirt",
-    "bag", "backpack",
-    "keyring", "keychain",
-    "playmat",
-    "dice", "coin",
-    "notebook", "binder",
-    "squishmallow", "cushion", "pillow",
-    "lamp", "light", "clock",
-    "wallet", "purse",
-    "lunchbox", "water bottle",
-    "blanket", "towel",
-    "hat", "cap", "beanie",
-    "socks", "slippers",
-    "puzzle", "jigsaw", "challenge",
-    "funko", "pop!", "sleeves", "portfolio", "accessories", "event",
-]
+def record_domain_success(health, latency):
+    health['history'].append('success')
+    if len(health['history']) > 10:
+        health['history'].pop(0)
+    health['success_rate'] = health['history'].count('success') / len(health['history'])
+    health['failure_streak'] = 0
+    health['last_success'] = datetime.now(timezone.utc)
+    record_latency(health, latency)
 
 
-def is_tcg_product(name: str, url: str = "") -> bool:
-    text = f"{name} {url}".lower()
-    return not any(word in text for word in BLOCK_KEYWORDS)
+def check_direct_product(url, previous_state, stats, store_file=None, is_verification=False, is_dormant=False):
+    if is_site_in_failure_cooldown(url):
+        print(f" SKIPPED (failed recently)")
+        if not is_verification:
+            stats['skipped'] += 1
+        return previous_state, None
 
+    domain = _host_for_url(url)
+    # setdefault is atomic, so concurrent first checks of a domain all share one health record
+    health = DOMAIN_HEALTH.setdefault(domain, {
+        'strategy': 'playwright' if domain in PLAYWRIGHT_DOMAINS else 'requests',
+        'use_proxy': domain in DECODO_BLOCKED_DOMAINS,
+        'cooldown_until': None,
+        'history': [],
+        'success_rate': 1.0,
+        'failure_streak': 0,
+        'last_success': None,
+        'latency': []
+    })
 
-# =========================================================
-#  STORE UNAVAILABILITY DETECTION
-# =========================================================
-STORE_UNAVAILABLE_MARKERS = [
-    "enter using password", "password protected", "store closed",
-    "temporarily closed", "temporarily unavailable", "site is unavailable",
-    "maintenance mode", "under maintenance", "we'll be back soon",
-    "coming back soon", "closed until", "currently unavailable",
-    "are you the store owner", "admin login", "restricted access"
-]
+    if health['cooldown_until'] and datetime.now(timezone.utc) < health['cooldown_until']:
+        print(f" UNKNOWN (cooldown)")
+        if not is_verification:
+            stats['failed'] += 1
+            file_label = store_file.split('/')[-1].replace('.txt', '') if store_file else "Unknown"
+            HOURLY_FAILED_DETAILS.append({"url": domain, "file": file_label, "reason": "Cooldown"})
+        return {
+            "name": previous_state.get("name") if previous_state else None,
+            "in_stock": previous_state.get("in_stock") if previous_state else False,
+            "stock_status": "unknown",
+            "last_alerted": previous_state.get("last_alerted") if previous_state else None
+        }, None
 
+    try:
+        headers = get_headers_for_url(url)
+        timeout_s = get_timeout_for_url(url, health)
+        start_time = time.time()
 
-def is_store_unavailable(text: str) -> bool:
-    if not text:
-        return False
-    t = text.lower()
-    return any(marker in t for marker in STORE_UNAVAILABLE_MARKERS)
+        fast_result = None
+        if health['strategy'] == 'requests' and not should_use_playwright(url):
+            fast_result = fetch_fast_path(url, headers, timeout_s, health['use_proxy'], domain, is_verification)
 
+        if fast_result:
+            record_domain_success(health, time.time() - start_time)
+            if domain not in DOMAIN_PLATFORMS:
+                record_platform(domain, "shopify")
+            save_cookies_for_domain(domain, get_session_for_domain(domain))
 
-# =========================================================
-#  FETCH WRAPPERS
-# =========================================================
-BLOCKED_MARKERS = ["robot", "captcha", "blocked", "forbidden", "access denied", "cloudflare", "sorry, you have been blocked"]
+            if not is_verification:
+                stats['fetched'] += 1
 
-DOMAIN_HEALTH = {}  # per domain health
+            product_name = fast_result["name"] or urlparse(url).path.split('/')[-1].replace('-', ' ')[:100]
+            if not is_tcg_product(product_name, url):
+                return {
+                    "name": product_name,
+                    "in_stock": False,
+                    "stock_status": "out",
+                    "last_alerted": previous_state.get("last_alerted") if previous_state else None
+                }, None
 
-DOMAIN_COOKIES_DIR = 'cookies'
-os.makedirs(DOMAIN_COOKIES_DIR, exist_ok=True)
+            stock_status = fast_result["stock_status"]
+            details = ProductDetails(image_url=fast_result["image_url"], price=fast_result["price"])
+        else:
+            priority = PW_PRIORITY_VERIFY if is_verification else PW_PRIORITY_NORMAL
+            # Only revalidate against a state we can hand back; verifications always want a fresh page
+            can_reuse = (not is_verification and previous_state is not None
+                         and previous_state.get("stock_status") in ("in", "out", "preorder"))
+            validators = dict(VALIDATOR_CACHE.get(url, {})) if can_reuse else {}
+            status_code, final_url, html = fetch_html(url, headers, timeout_s, health['use_proxy'], domain, priority, validators)
+
+            if status_code == PW_TIMEOUT_STATUS:
+                raise requests.exceptions.Timeout(f"Playwright timed out after {timeout_s}s")
+            latency = time.time() - start_time
+
+            page_hash = body_hash(html) if status_code == 200 and html else None
+            if can_reuse and (status_code == 304 or (page_hash and page_hash == validators.get("body_hash"))):
+                record_domain_success(health, latency)
+                VALIDATOR_CACHE[url] = validators
+                if not is_verification:
+                    stats['fetched'] += 1
+                    stats['unchanged'] += 1
+                return dict(previous_state), None
+
+            if status_code != 200 or not html:
+                raise Exception(f"HTTP {status_code}")
+
+            html_lower = html.lower()
+            if any(marker in html_lower for marker in BLOCKED_MARKERS):
+                clear_cookies_for_domain(domain)
+                raise Exception("Blocked")
+
+            record_domain_success(health, latency)
+            if domain not in DOMAIN_PLATFORMS:
+                record_platform(domain, detect_platform(html))
+
+            if health['strategy'] == 'requests':
+                save_cookies_for_domain(domain, get_session_for_domain(domain))
+            # Playwright storage state is saved by the browser pool
+
+            if is_dormant:
+                original_path = urlparse(url).path.rstrip('/')
+                final_path = urlparse(final_url).path.rstrip('/')
+                if final_path == '' or final_path == '/' or (original_path != final_path and len(final_path) < 10):
+                    print(f"OUT - redirected")
+                    return {
+                        "name": None, "in_stock": False, "stock_status": "out",
+                        "last_alerted": previous_state.get("last_alerted") if previous_state else None
+                    }, None
+
+            if not is_verification:
+                stats['fetched'] += 1
+
+            parsed = run_parse_stage(html, url, final_url or url, FILE_FRANCHISE.get(store_file), domain,
+                                     validators.get("fingerprint"))
+            if parsed["status"] == "unchanged":
+                # Same buy box as the last classified page (only offered when can_reuse)
+                validators["body_hash"] = page_hash
+                VALIDATOR_CACHE[url] = validators
+                if not is_verification:
+                    stats['unchanged'] += 1
+                return dict(previous_state), None
+
+            if parsed["status"] == "unavailable":
+                print(" UNKNOWN (store unavailable)")
+                return {
+                    "name": previous_state.get("name") if previous_state else None,
+                    "in_stock": previous_state.get("in_stock") if previous_state else False,
+                    "stock_status": "unknown",
+                    "last_alerted": previous_state.get("last_alerted") if previous_state else None
+                }, None
 
-STATE_DIR = 'states'
-os.makedirs(STATE_DIR, exist_ok=True)
+            product_name = parsed["name"]
+            if parsed["status"] == "filtered":
+                return {
+                    "name": product_name,
+                    "in_stock": False,
+                    "stock_status": "out",
+                    "last_alerted": previous_state.get("last_alerted") if previous_state else None
+                }, None
 
-def get_session_for_domain(domain: str):
-    if domain not in DOMAIN_SESSIONS:
-        DOMAIN_SESSIONS[domain] = requests.Session()
-        DOMAIN_SESSIONS[domain].mount("http://", adapter)
-        DOMAIN_SESSIONS[domain].mount("https://", adapter)
+            stock_status = parsed["stock_status"]
+            if parsed["structured"]:
+                details = ProductDetails(image_url=parsed["image_url"], price=parsed["price"])
+            else:
+                details = ProductDetails(raw_html=html, base_url=url)
 
-        cookie_file = os.path.join(DOMAIN_COOKIES_DIR, f"{domain}.json")
-        if os.path.exists(cookie_file):
-            try:
-                with open(cookie_file, "r") as f:
-                    data = json.load(f)
-                DOMAIN_SESSIONS[domain].cookies = cookiejar_from_dict(data)
-            except Exception as e:
-                print(f"Failed to load cookies for {domain}: {e}")
+            validators["body_hash"] = page_hash
+            validators["fingerprint"] = parsed["fingerprint"]
+            VALIDATOR_CACHE[url] = validators
 
-    return DOMAIN_SESSIONS[domain]
+        is_available = stock_status in ("in", "preorder")
 
-def save_cookies_for_domain(domain: str, session):
-    cookie_file = os.path.join(DOMAIN_COOKIES_DIR, f"{domain}.json")
-    cookies = [c.get_dict() for c in session.cookies]
-    with open(cookie_file, 'w') as f:
-        json.dump(cookies, f)
+        current_state = {
+            "name": product_name,
+            "in_stock": is_available,
+            "stock_status": stock_status,
+            "last_alerted": previous_state.get("last_alerted") if previous_state else None,
+        }
+        if is_verification:
+            # The confirmed page's details feed the alert; sweep states are kept without them
+            current_state["details"] = details
 
+        change = None
+        if previous_state:
+            was_available = previous_state.get("in_stock", False)
+            if not was_available and is_available:
+                last_alerted = previous_state.get("last_alerted")
+                if should_alert(last_alerted):
+                    change = {
+                        "type": "preorder" if stock_status == "preorder" else "restock",
+                        "name": product_name,
+                        "url": url,
+                        "store_file": store_file,
+                        "details": details
+                    }
+        elif not previous_state and is_available:
+            change = {
+                "type": "preorder" if stock_status == "preorder" else "new",
+                "name": product_name,
+                "url": url,
+                "store_file": store_file,
+                "details": details
+            }
 
-def clear_cookies_for_domain(domain: str):
-    cookie_file = os.path.join(DOMAIN_COOKIES_DIR, f"{domain}.json")
-    if os.path.exists(cookie_file):
-        os.remove(cookie_file)
-    state_file = os.path.join(STATE_DIR, f"{domain}.json")
-    if os.path.exists(state_file):
-        os.remove(state_file)
-    if domain in DOMAIN_SESSIONS:
-        DOMAIN_SESSIONS[domain].cookies.clear()
+        return current_state, change
 
+    except requests.exceptions.Timeout:
+        record_latency(health, timeout_s)
+        health['history'].append('fail')
+        if len(health['history']) > 10:
+            health['history'].pop(0)
+        health['success_rate'] = health['history'].count('success') / len(health['history'])
+        health['failure_streak'] += 1
+        if health['failure_streak'] > 4:
+            health['cooldown_until'] = datetime.now(timezone.utc) + timedelta(minutes=10)
+        if health['success_rate'] < 0.5 and health['strategy'] == 'requests':
+            health['strategy'] = 'playwright'
+        if len(health['history']) >= 5 and health['history'][-5:].count('fail') > 3:
+            health['use_proxy'] = not health['use_proxy']
+        domain = urlparse(url).netloc
+        file_label = store_file.split('/')[-1].replace('.txt', '') if store_file else "Unknown"
+        if is_dormant:
+            print(f"OUT - timeout")
+            return {"name": None, "in_stock": False, "stock_status": "out",
+                    "last_alerted": previous_state.get("last_alerted") if previous_state else None}, None
+        print(f" UNKNOWN (timeout)")
+        mark_site_failed(url)
+        if not is_verification:
+            stats['failed'] += 1
+            HOURLY_FAILED_DETAILS.append({"url": domain, "file": file_label, "reason": "Timeout"})
+        return {
+            "name": previous_state.get("name") if previous_state else None,
+            "in_stock": previous_state.get("in_stock") if previous_state else False,
+            "stock_status": "unknown",
+            "last_alerted": previous_state.get("last_alerted") if previous_state else None
+        }, None
+    except Exception as e:
+        health['history'].append('fail')
+        if len(health['history']) > 10:
+            health['history'].pop(0)
+        health['success_rate'] = health['history'].count('success') / len(health['history'])
+        health['failure_streak'] += 1
+        if health['failure_streak'] > 4:
+            health['cooldown_until'] = datetime.now(timezone.utc) + timedelta(minutes=10)
+        if health['success_rate'] < 0.5 and health['strategy'] == 'requests':
+            health['strategy'] = 'playwright'
+        if len(health['history']) >= 5 and health['history'][-5:].count('fail') > 3:
+            health['use_proxy'] = not health['use_proxy']
+        domain = urlparse(url).netloc
+        file_label = store_file.split('/')[-1].replace('.txt', '') if store_file else "Unknown"
+        print(f" UNKNOWN ({str(e)[:80]})")
+        mark_site_failed(url)
+        if not is_verification:
+            stats['failed'] += 1
+            HOURLY_FAILED_DETAILS.append({"url": domain, "file": file_label, "reason": str(e)[:80]})
+        return {
+            "name": previous_state.get("name") if previous_state else None,
+            "in_stock": previous_state.get("in_stock") if previous_state else False,
+            "stock_status": "unknown",
+            "last_alerted": previous_state.get("last_alerted") if previous_state else None
+        }, None
 
-def fetch_html_requests(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str):
-    session = get_session_for_domain(domain)
-    proxies = proxies_for_url(url) if use_proxy else None
-    r = session.get(
-        url,
-        headers=headers,
-        timeout=timeout_s,
-        proxies=proxies,
-    )
-    return r.status_code, r.url, r.text
 
+# =========================================================
+#  CONNECTION WARM-UP (DNS cache, prewarm, keep-warm)
+# =========================================================
+# The first sweep after a deploy used to pay DNS, TCP and TLS for every shop.
+# Lookups are cached for DNS_CACHE_TTL seconds, each shop's pool gets a
+# keep-alive connection before the first sweep, and shops that have gone
+# quiet are touched again before their servers drop the idle connection.
+DNS_CACHE_TTL = int(os.getenv("DNS_CACHE_TTL", "300"))
+PREWARM_CONNECTIONS = os.getenv("PREWARM_CONNECTIONS", "1") == "1"
+PREWARM_WORKERS = int(os.getenv("PREWARM_WORKERS", "32"))
+PREWARM_TIMEOUT = 5
+KEEP_WARM_INTERVAL = int(os.getenv("KEEP_WARM_INTERVAL", "30"))  # 0 disables keep-warm
+KEEP_WARM_IDLE = int(os.getenv("KEEP_WARM_IDLE", "0"))  # 0 = just past the longest normal recheck gap
 
-def fetch_html_playwright(url: str, timeout_ms: int, use_proxy: bool, domain: str):
-    if not PLAYWRIGHT_AVAILABLE:
-        return 0, url, ""
+DNS_CACHE = {}  # {getaddrinfo args: (expires, result)}
+_SYSTEM_GETADDRINFO = socket.getaddrinfo
+ORIGIN_LAST_USED = {}  # {"https://host": monotonic time of the last response}
+KEEP_WARM_THREAD = None
 
-    proxy_cfg = playwright_proxy_for_url(url) if use_proxy else None
 
-    state_file = os.path.join(STATE_DIR, f"{domain}.json")
-    storage_state = None
-    if os.path.exists(state_file):
-        try:
-            with open(state_file, 'r') as f:
-                storage_state = json.load(f)
-        except:
-            pass
+def cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    key = (host, port, family, type, proto, flags)
+    now = time.monotonic()
+    entry = DNS_CACHE.get(key)
+    if entry and entry[0] > now:
+        return entry[1]
+    try:
+        result = _SYSTEM_GETADDRINFO(host, port, family, type, proto, flags)
+    except socket.gaierror:
+        if entry:
+            return entry[1]  # resolver hiccup: a stale answer beats a failed check
+        raise
+    DNS_CACHE[key] = (now + DNS_CACHE_TTL, result)
+    return result
 
-    with sync_playwright() as p:
-        launch_kwargs = {
-            "headless": True,
-            "args": [
-                "--no-sandbox",
-                "--disable-dev-shm-usage",
-                "--disable-http2",
-                "--disable-quic",
-                "--disable-blink-features=AutomationControlled",
-                "--disable-gpu",
-                "--disable-infobars",
-                "--window-size=1920,1080",
-            ],
-        }
-        if proxy_cfg:
-            launch_kwargs["proxy"] = proxy_cfg
-
-        context_kwargs = {
-            "user_agent": random.choice(REAL_UAS),
-            "viewport": {"width": 1920, "height": 1080},
-            "java_script_enabled": True,
-            "locale": "en-GB",
-            "timezone_id": "Europe/London",
-            "bypass_csp": True,
-            "storage_state": storage_state,
-        }
 
-        browser = None
-        try:
-            browser = p.chromium.launch(**launch_kwargs)
-            context = browser.new_context(**context_kwargs)
-            page = context.new_page()
-
-            # Apply full stealth — this is the key line
-            stealth(page)  # <-- Correct v2 call: stealth(page)
-
-            # Auto-accept consent banners (OneTrust common on UK retail)
-            consent_selectors = [
-                "#onetrust-accept-btn-handler",
-                "button:has-text('Accept all')",
-                "button:has-text('Accept All')",
-                "button:has-text('Accept')",
-                "[aria-label*='accept']",
-            ]
-            for sel in consent_selectors:
-                try:
-                    btn = page.locator(sel).first
-                    if btn.is_visible(timeout=3000):
-                        btn.click(timeout=5000)
-                        print(f"  Clicked consent button on {domain}")
-                        time.sleep(1.5)
-                        break
-                except:
-                    continue
+def install_dns_cache():
+    if DNS_CACHE_TTL > 0:
+        socket.getaddrinfo = cached_getaddrinfo
 
-            # Block heavy resources (keep images/fonts if needed for layout)
-            def route_filter(route):
-                rt = route.request.resource_type
-                if rt in ("media", "font"):  # removed "image" and "stylesheet" for realism
-                    return route.abort()
-                return route.continue_()
-            page.route("**/*", route_filter)
-
-            # Human-like startup: small scroll + delay
-            page.evaluate("() => window.scrollTo(0, random.randint(100, 400))")
-            time.sleep(random.uniform(0.5, 1.5))
-
-            # Goto with 20-second timeout
-            resp = page.goto(url, wait_until="domcontentloaded", timeout=20000)
-            status = resp.status if resp else 0
-            html = page.content() or ""
-            final_url = page.url
-
-            # Save storage state
-            try:
-                with open(state_file, 'w') as f:
-                    json.dump(context.storage_state(), f)
-            except Exception:
-                pass
 
-            return status, final_url, html
-
-        except Exception as e:
-            print(f" Playwright error on {url}: {str(e)[:120]}")
-            return 0, url, ""
-        finally:
-            if browser:
-                try:
-                    browser.close()
-                except Exception:
-                    pass
+def _origin_for_url(url: str) -> str:
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc.lower()}"
 
 
-def fetch_html(url: str, headers: dict, timeout_s: int, use_proxy: bool, domain: str):
-    timeout_s = min(timeout_s, MAX_TIMEOUT)
-    if should_use_playwright(url) and PLAYWRIGHT_AVAILABLE:
-        return fetch_html_playwright(url, timeout_ms=timeout_s * 1000, use_proxy=use_proxy, domain=domain)
-    return fetch_html_requests(url, headers=headers, timeout_s=timeout_s, use_proxy=use_proxy, domain=domain)
+def note_connection_use(response, *args, **kwargs):
+    ORIGIN_LAST_USED[_origin_for_url(response.url)] = time.monotonic()
+    return response
 
 
-# =========================================================
-#  DATABASE
-# =========================================================
-DB_LOCK = threading.Lock()
+def warmable_origins():
+    # Shops fetched directly with requests; proxied and Playwright shops connect elsewhere
+    _, groups = monitored_urls_snapshot()
+    origins = {}
+    for urls in groups.values():
+        for url in urls:
+            domain = _host_for_url(url)
+            health = DOMAIN_HEALTH.get(domain, {})
+            if (should_use_playwright(url) or health.get('strategy') == 'playwright'
+                    or health.get('use_proxy', domain in DECODO_BLOCKED_DOMAINS)):
+                continue
+            origins.setdefault(_origin_for_url(url), domain)
+    return origins
 
 
-def init_db_pool():
-    global DB_POOL
-    print(f" Checking database connection...")
-    if not DATABASE_URL:
-        print(" DATABASE_URL not found! Database disabled.")
+def warm_origin(origin, domain) -> bool:
+    # A HEAD of the home page resolves DNS and leaves a keep-alive connection in the shop's pool
+    if take_domain_token(domain, time.monotonic()):
         return False
-    if DB_POOL is None:
+    try:
+        session = get_session_for_domain(domain)
+        r = session.head(origin + "/", headers=get_headers_for_url(origin + "/"),
+                         timeout=PREWARM_TIMEOUT, allow_redirects=False)
+        r.close()
+        return True
+    except Exception:
+        return False
+
+
+def warm_origins(origins) -> int:
+    if not origins:
+        return 0
+    with ThreadPoolExecutor(max_workers=min(PREWARM_WORKERS, len(origins)), thread_name_prefix="prewarm") as executor:
+        return sum(executor.map(lambda item: warm_origin(*item), origins.items()))
+
+
+def prewarm_connections():
+    if not PREWARM_CONNECTIONS:
+        return
+    origins = warmable_origins()
+    start = time.time()
+    warmed = warm_origins(origins)
+    print(f" Prewarmed {warmed}/{len(origins)} shop connections in {time.time() - start:.1f}s")
+
+
+def keep_warm_idle():
+    # Shops checked on the normal interval are never touched; only ones quieter than that are
+    return KEEP_WARM_IDLE or CHECK_INTERVAL * (1 + CHECK_JITTER)
+
+
+def _keep_warm_loop():
+    while True:
+        time.sleep(KEEP_WARM_INTERVAL)
         try:
-            DB_POOL = pool.SimpleConnectionPool(1, 10, DATABASE_URL, connect_timeout=10)
-            print(" Database pool initialized")
-            return True
+            now = time.monotonic()
+            idle_s = keep_warm_idle()
+            idle = {
+                origin: domain for origin, domain in warmable_origins().items()
+                if now - ORIGIN_LAST_USED.get(origin, now) >= idle_s
+            }
+            warm_origins(idle)
         except Exception as e:
-            print(f" Failed to create pool: {e}")
-            return False
-    return True
+            print(f" Keep-warm error: {e}")
 
 
-def get_db_connection():
-    global DB_POOL
-    if DB_POOL:
-        return DB_POOL.getconn()
-    return psycopg2.connect(DATABASE_URL)
+def start_keep_warm():
+    global KEEP_WARM_THREAD
+    if not PREWARM_CONNECTIONS or KEEP_WARM_INTERVAL <= 0 or KEEP_WARM_THREAD is not None:
+        return
+    KEEP_WARM_THREAD = threading.Thread(target=_keep_warm_loop, name="keep-warm", daemon=True)
+    KEEP_WARM_THREAD.start()
 
 
-def return_db_connection(conn):
-    global DB_POOL
-    if DB_POOL and conn:
-        DB_POOL.putconn(conn)
-    elif conn:
-        conn.close()
+# =========================================================
+#  ASYNC FETCH ENGINE (requests lane)
+# =========================================================
+# An asyncio loop on a background thread admits checks under a global and a
+# per-domain in-flight cap; each admitted check runs the normal blocking
+# check_direct_product in a wide thread pool, so sessions, cookies,
+# DOMAIN_HEALTH and cooldowns behave exactly as before.
+FETCH_MAX_IN_FLIGHT = int(os.getenv("FETCH_MAX_IN_FLIGHT", "200"))
+DOMAIN_MAX_IN_FLIGHT = int(os.getenv("DOMAIN_MAX_IN_FLIGHT", "3"))
+DOMAIN_IN_FLIGHT_OVERRIDES = {
+    # "example.co.uk": 1,
+}
+# Live limits, moved by the autotuner below; overrides above stay fixed
+FETCH_LIMIT = FETCH_MAX_IN_FLIGHT
+DOMAIN_LIMITS = {}  # {domain: current in-flight cap}
 
+ENGINE_LOOP = None
+ENGINE_THREAD = None
+ENGINE_EXECUTOR = None
+ENGINE_CONDITION = None
+ENGINE_IN_FLIGHT = {}  # {domain: running checks}
+ENGINE_TOTAL_IN_FLIGHT = 0
+ENGINE_START_LOCK = threading.Lock()
 
-def init_database():
-    if not DATABASE_URL:
-        return False
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS product_state (
-                store_url TEXT NOT NULL,
-                product_url TEXT NOT NULL,
-                product_name TEXT,
-                in_stock BOOLEAN DEFAULT TRUE,
-                stock_status TEXT,
-                last_checked TIMESTAMP,
-                last_error TEXT,
-                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_alerted TIMESTAMP,
-                PRIMARY KEY (store_url, product_url)
-            )
-        """)
-        cur.execute("ALTER TABLE product_state ADD COLUMN IF NOT EXISTS last_alerted TIMESTAMP")
-        cur.execute("ALTER TABLE product_state ADD COLUMN IF NOT EXISTS stock_status TEXT")
-        cur.execute("ALTER TABLE product_state ADD COLUMN IF NOT EXISTS last_checked TIMESTAMP")
-        cur.execute("ALTER TABLE product_state ADD COLUMN IF NOT EXISTS last_error TEXT")
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS ping_state (
-                ping_type TEXT PRIMARY KEY,
-                last_ping TEXT
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS monitored_urls (
-                url TEXT NOT NULL,
-                file_group TEXT NOT NULL,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (url, file_group)
-            )
-        """)
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
-        print(" Database initialized")
-        return True
-    except Exception as e:
-        print(f" Database error: {e}")
-        if conn:
-            return_db_connection(conn)
-        return False
 
+def domain_concurrency_limit(domain: str) -> int:
+    if domain in DOMAIN_IN_FLIGHT_OVERRIDES:
+        return DOMAIN_IN_FLIGHT_OVERRIDES[domain]
+    return DOMAIN_LIMITS.get(domain, DOMAIN_MAX_IN_FLIGHT)
 
-def load_ping_state():
-    global LAST_HOURLY_PING, LAST_DAILY_PING
-    if not DATABASE_URL:
-        print(" Skipping ping state load (no DATABASE_URL).")
-        return
-    conn = None
+
+def start_fetch_engine():
+    global ENGINE_LOOP, ENGINE_THREAD, ENGINE_EXECUTOR
+    with ENGINE_START_LOCK:
+        if ENGINE_LOOP is not None:
+            return
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run_loop():
+            global ENGINE_CONDITION
+            asyncio.set_event_loop(loop)
+            ENGINE_CONDITION = asyncio.Condition()
+            ready.set()
+            loop.run_forever()
+
+        ENGINE_EXECUTOR = ThreadPoolExecutor(max_workers=FETCH_MAX_IN_FLIGHT, thread_name_prefix="fetch")
+        ENGINE_THREAD = threading.Thread(target=run_loop, name="fetch-engine", daemon=True)
+        ENGINE_THREAD.start()
+        ready.wait()
+        ENGINE_LOOP = loop
+
+
+def stop_fetch_engine():
+    global ENGINE_LOOP, ENGINE_THREAD, ENGINE_EXECUTOR
+    with ENGINE_START_LOCK:
+        if ENGINE_LOOP is None:
+            return
+        ENGINE_LOOP.call_soon_threadsafe(ENGINE_LOOP.stop)
+        ENGINE_THREAD.join(timeout=10)
+        ENGINE_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        ENGINE_LOOP = None
+        ENGINE_THREAD = None
+        ENGINE_EXECUTOR = None
+
+
+async def _run_engine_job(domain, fn, args):
+    global ENGINE_TOTAL_IN_FLIGHT
+    async with ENGINE_CONDITION:
+        await ENGINE_CONDITION.wait_for(
+            lambda: ENGINE_TOTAL_IN_FLIGHT < FETCH_LIMIT
+            and ENGINE_IN_FLIGHT.get(domain, 0) < domain_concurrency_limit(domain)
+        )
+        ENGINE_TOTAL_IN_FLIGHT += 1
+        ENGINE_IN_FLIGHT[domain] = ENGINE_IN_FLIGHT.get(domain, 0) + 1
+        note_admission(domain, ENGINE_IN_FLIGHT[domain], ENGINE_TOTAL_IN_FLIGHT)
+    failed = True
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT ping_type, last_ping FROM ping_state")
-        rows = cur.fetchall()
-        for ping_type, last_ping in rows:
-            if ping_type == "hourly":
-                LAST_HOURLY_PING = last_ping
-            elif ping_type == "daily":
-                LAST_DAILY_PING = last_ping
-        cur.close()
-        return_db_connection(conn)
-        if LAST_HOURLY_PING or LAST_DAILY_PING:
-            print(f" Loaded ping state: hourly={LAST_HOURLY_PING}, daily={LAST_DAILY_PING}")
-    except Exception as e:
-        print(f" Error loading ping state: {e}")
-        if conn:
-            return_db_connection(conn)
+        result = await asyncio.get_running_loop().run_in_executor(ENGINE_EXECUTOR, fn, *args)
+        state = result[0] if isinstance(result, tuple) else None
+        failed = not state or state.get("stock_status") == "unknown"
+        return result
+    finally:
+        note_outcome(domain, failed)
+        async with ENGINE_CONDITION:
+            ENGINE_TOTAL_IN_FLIGHT -= 1
+            ENGINE_IN_FLIGHT[domain] -= 1
+            if not ENGINE_IN_FLIGHT[domain]:
+                del ENGINE_IN_FLIGHT[domain]
+            ENGINE_CONDITION.notify_all()
 
 
-def save_ping_state(ping_type, value):
-    if not DATABASE_URL:
-        return
-    for attempt in range(3):
-        conn = None
-        try:
-            with DB_LOCK:
-                conn = get_db_connection()
-                cur = conn.cursor()
-                cur.execute("""
-                    INSERT INTO ping_state (ping_type, last_ping)
-                    VALUES (%s, %s)
-                    ON CONFLICT (ping_type) DO UPDATE SET last_ping = EXCLUDED.last_ping
-                """, (ping_type, value))
-                conn.commit()
-                cur.close()
-                return_db_connection(conn)
-            return
-        except Exception as e:
-            if conn:
-                try:
-                    conn.close()
-                except:
-                    pass
-            if attempt < 2:
-                time.sleep(1)
-                init_db_pool()
-            else:
-                print(f" Error saving ping state: {e}")
+def submit_fetch_job(domain: str, fn, *args):
+    # Returns a concurrent.futures.Future, so callers can use as_completed as before
+    start_fetch_engine()
+    return asyncio.run_coroutine_threadsafe(_run_engine_job(domain, fn, args), ENGINE_LOOP)
 
 
-def sync_urls_to_db():
-    if not DATABASE_URL:
-        return
-    conn = None
-    try:
-        with DB_LOCK:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            total_added = 0
-            total_removed = 0
-            for franchise in FRANCHISES:
-                for file_path in franchise.get("direct_files", []):
-                    file_urls = set()
-                    try:
-                        with open(file_path, "r") as f:
-                            for line in f:
-                                line = line.strip()
-                                if line and line.startswith("http"):
-                                    file_urls.add(line.split()[0])
-                    except FileNotFoundError:
-                        continue
-                    cur.execute("SELECT url FROM monitored_urls WHERE file_group = %s", (file_path,))
-                    db_urls = set(row[0] for row in cur.fetchall())
-                    new_urls = file_urls - db_urls
-                    removed_urls = db_urls - file_urls
-                    for url in new_urls:
-                        cur.execute(
-                            "INSERT INTO monitored_urls (url, file_group) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                            (url, file_path)
-                        )
-                        total_added += 1
-                    for url in removed_urls:
-                        cur.execute("DELETE FROM monitored_urls WHERE url = %s AND file_group = %s", (url, file_path))
-                        total_removed += 1
-            conn.commit()
-            cur.close()
-            return_db_connection(conn)
-        if total_added > 0 or total_removed > 0:
-            print(f" URL sync: {total_added} added, {total_removed} removed")
-        else:
-            print(f" URL sync: all up to date")
-    except Exception as e:
-        print(f" URL sync error: {e}")
-        if conn:
-            try:
-                conn.rollback()
-            except:
-                pass
-            return_db_connection(conn)
+async def _wake_engine():
+    async with ENGINE_CONDITION:
+        ENGINE_CONDITION.notify_all()
 
 
-def load_urls(file_list):
-    all_urls = set()
-    for file_path in file_list:
-        try:
-            with open(file_path, "r") as f:
-                for line in f:
-                    line = line.strip()
-                    if line and line.startswith("http"):
-                        all_urls.add(line.split()[0])
-        except FileNotFoundError:
-            print(f" File not found: {file_path}")
-    return list(all_urls)
+atexit.register(stop_fetch_engine)
 
 
-def load_urls_from_db(file_path):
-    if not DATABASE_URL:
-        return load_urls([file_path])
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT url FROM monitored_urls WHERE file_group = %s", (file_path,))
-        urls = [row[0] for row in cur.fetchall()]
-        cur.close()
-        return_db_connection(conn)
-        return urls
-    except Exception as e:
-        print(f" DB URL load error, falling back to file: {e}")
-        if conn:
-            return_db_connection(conn)
-        return load_urls([file_path])
+# =========================================================
+#  CONCURRENCY AUTOTUNING (AIMD)
+# =========================================================
+# Every AUTOTUNE_INTERVAL seconds the global and per-shop in-flight caps are
+# nudged up by a step while checks succeed and the cap is actually being hit,
+# and halved as soon as a shop starts failing, rate limiting or cooling down,
+# or the process tree gets close to the memory ceiling.
+AUTOTUNE_CONCURRENCY = os.getenv("AUTOTUNE_CONCURRENCY", "1") == "1"
+AUTOTUNE_INTERVAL = int(os.getenv("AUTOTUNE_INTERVAL", "30"))
+FETCH_MIN_IN_FLIGHT = int(os.getenv("FETCH_MIN_IN_FLIGHT", "10"))
+FETCH_START_IN_FLIGHT = int(os.getenv("FETCH_START_IN_FLIGHT", "50"))
+FETCH_STEP = int(os.getenv("FETCH_STEP", "10"))
+DOMAIN_MAX_IN_FLIGHT_CEILING = int(os.getenv("DOMAIN_MAX_IN_FLIGHT_CEILING", "6"))
+AUTOTUNE_MAX_ERROR_RATE = 0.2
+AUTOTUNE_MAX_RSS_MB = int(os.getenv("AUTOTUNE_MAX_RSS_MB", "2500"))
 
+AUTOTUNE_LOCK = threading.Lock()
+AUTOTUNE_WINDOW = {}  # {domain: {"done", "failed", "peak"}} since the last tick
+AUTOTUNE_PEAK = 0  # most checks in flight at once since the last tick
+AUTOTUNE_LAST_RATE = 0.0  # checks per second over the previous window
+AUTOTUNE_LAST_TICK = time.monotonic()
 
-def load_direct_state():
-    direct_state = {}
-    if not DATABASE_URL:
-        return direct_state
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT product_url, product_name, in_stock, stock_status, last_alerted, last_error, last_checked FROM product_state WHERE store_url = product_url")
-        rows = cur.fetchall()
-        for url, name, in_stock, stock_status, last_alerted, last_error, last_checked in rows:
-            direct_state[url] = {
-                "name": name or "",
-                "in_stock": in_stock,
-                "stock_status": stock_status or "unknown",
-                "last_alerted": last_alerted,
-                "last_error": last_error,
-                "last_checked": last_checked
-            }
-        cur.close()
-        return_db_connection(conn)
-        print(f" Loaded {len(rows)} direct products from DB")
-    except Exception as e:
-        print(f" Error loading direct state: {e}")
-        if conn:
-            return_db_connection(conn)
-    return direct_state
+if AUTOTUNE_CONCURRENCY:
+    FETCH_LIMIT = max(FETCH_MIN_IN_FLIGHT, min(FETCH_START_IN_FLIGHT, FETCH_MAX_IN_FLIGHT))
 
 
-def save_product(product_url, product_name, in_stock, stock_status, last_checked, last_error=None, retry=True):
-    if not DATABASE_URL:
+def note_admission(domain, domain_in_flight, total_in_flight):
+    global AUTOTUNE_PEAK
+    with AUTOTUNE_LOCK:
+        window = AUTOTUNE_WINDOW.setdefault(domain, {"done": 0, "failed": 0, "peak": 0})
+        window["peak"] = max(window["peak"], domain_in_flight)
+        AUTOTUNE_PEAK = max(AUTOTUNE_PEAK, total_in_flight)
+
+
+def note_outcome(domain, failed):
+    with AUTOTUNE_LOCK:
+        window = AUTOTUNE_WINDOW.setdefault(domain, {"done": 0, "failed": 0, "peak": 0})
+        window["done"] += 1
+        if failed:
+            window["failed"] += 1
+
+
+def domain_under_pressure(domain, window, now):
+    # Failing, rate limited or cooling down: back off before the anti-bot rules escalate
+    if window["done"] and window["failed"] / window["done"] > AUTOTUNE_MAX_ERROR_RATE:
+        return True
+    health = DOMAIN_HEALTH.get(domain)
+    if health:
+        if health['failure_streak'] >= 2:
+            return True
+        if health['cooldown_until'] and datetime.now(timezone.utc) < health['cooldown_until']:
+            return True
+    with DOMAIN_BUCKETS_LOCK:
+        bucket = DOMAIN_BUCKETS.get(domain)
+        return bool(bucket and bucket["blocked_until"] > now)
+
+
+def autotune_concurrency():
+    global FETCH_LIMIT, AUTOTUNE_PEAK, AUTOTUNE_LAST_RATE, AUTOTUNE_LAST_TICK
+    now = time.monotonic()
+    with AUTOTUNE_LOCK:
+        windows = dict(AUTOTUNE_WINDOW)
+        AUTOTUNE_WINDOW.clear()
+        peak = AUTOTUNE_PEAK
+        AUTOTUNE_PEAK = ENGINE_TOTAL_IN_FLIGHT
+    elapsed = max(now - AUTOTUNE_LAST_TICK, 1e-6)
+    AUTOTUNE_LAST_TICK = now
+    if not AUTOTUNE_CONCURRENCY:
         return
-    conn = None
-    try:
-        with DB_LOCK:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            update_in_stock = ", in_stock = EXCLUDED.in_stock" if stock_status != "unknown" else ""
-            cur.execute("""
-                INSERT INTO product_state (store_url, product_url, product_name, in_stock, stock_status, last_checked, last_error, last_seen)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-                ON CONFLICT (store_url, product_url)
-                DO UPDATE SET product_name = EXCLUDED.product_name,
-                              stock_status = EXCLUDED.stock_status,
-                              last_checked = EXCLUDED.last_checked,
-                              last_error = EXCLUDED.last_error,
-                              last_seen = CURRENT_TIMESTAMP
-                              """ + update_in_stock + """
-            """, (product_url, product_url, product_name, in_stock, stock_status, last_checked, last_error))
-            conn.commit()
-            cur.close()
-            return_db_connection(conn)
-    except Exception as e:
-        if conn:
-            try:
-                conn.close()
-            except:
-                pass
-        if retry and "SSL" in str(e):
-            time.sleep(1)
-            save_product(product_url, product_name, in_stock, stock_status, last_checked, last_error, retry=False)
+
+    raised = False
+    for domain, window in windows.items():
+        if domain in DOMAIN_IN_FLIGHT_OVERRIDES:
+            continue
+        limit = domain_concurrency_limit(domain)
+        if domain_under_pressure(domain, window, now):
+            new_limit = max(1, limit // 2)
+        elif not window["failed"] and window["peak"] >= limit:
+            new_limit = min(DOMAIN_MAX_IN_FLIGHT_CEILING, limit + 1)
         else:
-            print(f" Error saving product: {e}")
+            continue
+        if new_limit != limit:
+            raised |= new_limit > limit
+            DOMAIN_LIMITS[domain] = new_limit
+
+    done = sum(w["done"] for w in windows.values())
+    failed = sum(w["failed"] for w in windows.values())
+    rate = done / elapsed
+    rss = _process_tree_mb() if AUTOTUNE_MAX_RSS_MB else 0
+    limit = FETCH_LIMIT
+    if (AUTOTUNE_MAX_RSS_MB and rss > AUTOTUNE_MAX_RSS_MB) or (done and failed / done > AUTOTUNE_MAX_ERROR_RATE):
+        FETCH_LIMIT = max(FETCH_MIN_IN_FLIGHT, FETCH_LIMIT // 2)
+        print(f" Autotune: fetch concurrency {limit} -> {FETCH_LIMIT} "
+              f"({failed}/{done} failed, {rss:.0f}MB memory)")
+    elif peak >= FETCH_LIMIT and rate >= AUTOTUNE_LAST_RATE * 0.9:
+        # Only grow while the cap is the bottleneck and the extra slots still buy throughput
+        FETCH_LIMIT = min(FETCH_MAX_IN_FLIGHT, FETCH_LIMIT + FETCH_STEP)
+        raised |= FETCH_LIMIT > limit
+    AUTOTUNE_LAST_RATE = rate
+
+    if raised and ENGINE_LOOP is not None:
+        asyncio.run_coroutine_threadsafe(_wake_engine(), ENGINE_LOOP)
+
+
+def concurrency_summary():
+    throttled = sum(1 for limit in DOMAIN_LIMITS.values() if limit < DOMAIN_MAX_IN_FLIGHT)
+    raised = sum(1 for limit in DOMAIN_LIMITS.values() if limit > DOMAIN_MAX_IN_FLIGHT)
+    return (f"{FETCH_LIMIT}/{FETCH_MAX_IN_FLIGHT} in flight, "
+            f"{raised} shops raised, {throttled} shops throttled (default {DOMAIN_MAX_IN_FLIGHT} per shop)")
+
+
+# =========================================================
+#  GLOBAL SCHEDULER (one due-time queue across every file)
+# =========================================================
+CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "60"))  # seconds between checks of the same URL
+DORMANT_CHECK_INTERVAL = int(os.getenv("DORMANT_CHECK_INTERVAL", "300"))
+CHECK_JITTER = 0.15
+MAX_LAG_SAMPLES = 5000
+
+SCHEDULE = []  # heap of (next_due, seq, url, file_path)
+SCHEDULED = {}  # {(url, file_path): next_due} - also holds URLs that are currently being checked
+SCHEDULE_SEQ = itertools.count()
+LAST_CHECKED_AT = {}  # {(url, file_path): monotonic time the last check finished}
+URL_LAG = {}  # {(url, file_path): seconds since the previous check when last dispatched}
+HOURLY_LAGS = []
+
+FILE_FRANCHISE = {
+    file_path: franchise
+    for franchise in FRANCHISES
+    for file_path in franchise.get("direct_files", [])
+}
 
 
-def mark_alerted(product_url):
-    if not DATABASE_URL:
+def file_label(file_path):
+    return file_path.split('/')[-1].replace('.txt', '') if file_path else "Unknown"
+
+
+def is_dormant_file(file_path):
+    return file_path in FILE_FRANCHISE.get(file_path, {}).get("dormant_files", [])
+
+
+def schedule_check(url, file_path, due):
+    SCHEDULED[(url, file_path)] = due
+    heapq.heappush(SCHEDULE, (due, next(SCHEDULE_SEQ), url, file_path))
+
+
+def next_check_due(file_path, now):
+    interval = DORMANT_CHECK_INTERVAL if is_dormant_file(file_path) else CHECK_INTERVAL
+    return now + interval * random.uniform(1 - CHECK_JITTER, 1 + CHECK_JITTER)
+
+
+def refresh_schedule(now):
+    # New URLs are due straight away, removed ones are dropped; returns (url list version, {file_path: url count})
+    version, groups = monitored_urls_snapshot()
+    current = set()
+    counts = {}
+    for file_path in FILE_FRANCHISE:
+        urls = groups.get(file_path, set())
+        counts[file_path] = len(urls)
+        current.update((url, file_path) for url in urls)
+    for url, file_path in current - SCHEDULED.keys():
+        schedule_check(url, file_path, now)
+    current_urls = {url for url, _ in current}
+    update_shopify_handle_counts(current_urls)
+    for key in SCHEDULED.keys() - current:
+        del SCHEDULED[key]
+        LAST_CHECKED_AT.pop(key, None)
+        URL_LAG.pop(key, None)
+        if key[0] not in current_urls:
+            VALIDATOR_CACHE.pop(key[0], None)
+    return version, counts
+
+
+def sweep_keys():
+    # A sweep ends once every active URL has been checked; dormant files run on their own slower clock
+    active = {key for key in SCHEDULED if not is_dormant_file(key[1])}
+    return active or set(SCHEDULED)
+
+
+def record_lag(key, now, sweep_lags):
+    last = LAST_CHECKED_AT.get(key)
+    if last is None:
         return
-    conn = None
-    try:
-        with DB_LOCK:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("""
-                UPDATE product_state
-                SET last_alerted = CURRENT_TIMESTAMP
-                WHERE product_url = %s
-            """, (product_url,))
-            conn.commit()
-            cur.close()
-            return_db_connection(conn)
-    except Exception as e:
-        print(f" Error marking alerted: {e}")
-        if conn:
-            return_db_connection(conn)
+    lag = now - last
+    URL_LAG[key] = lag
+    sweep_lags.append(lag)
+    HOURLY_LAGS.append(lag)
+    if len(HOURLY_LAGS) > MAX_LAG_SAMPLES:
+        del HOURLY_LAGS[:len(HOURLY_LAGS) - MAX_LAG_SAMPLES]
+
+
+def lag_summary(lags):
+    if not lags:
+        return "n/a"
+    ordered = sorted(lags)
+    p50 = ordered[len(ordered) // 2]
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return f"p50 {p50:.0f}s, p95 {p95:.0f}s, max {ordered[-1]:.0f}s"
 
 
 # =========================================================
-#  STOCK CLASSIFICATION
+#  DELAYED VERIFICATION QUEUE (own lane, ahead of the sweep)
 # =========================================================
-PREORDER_TERMS = [
-    "pre-order now", "preorder now", "available for pre-order", "available for preorder",
-    "pre order now", "add to pre-order", "expected release", "expected dispatch",
-    "releasing soon", "available from", "releases on", "presale", "pre-sale",
-    "preorder available", "pre-order available"
-]
+VERIFY_DELAY_SECONDS = 5
+VERIFY_WORKERS = int(os.getenv("VERIFY_WORKERS", "4"))
 
-OUT_OF_STOCK_TERMS = [
-    "sold out", "out of stock", "currently unavailable", "temporarily out of stock",
-    "not in stock", "no stock available", "stock: 0", "out-of-stock", "soldout",
-    "item unavailable", "sold-out-btn", "notify when available", "notify me when in stock",
-    "backorder", "back order", "waitlist", "wait list", "email when available",
-    "check back soon", "notify me when", "register interest"
-]
+VERIFY_QUEUE = []  # heap of (due, seq, url, file_path, current_state, change)
+VERIFY_PENDING = set()  # URLs with a verification queued or running
 
-IN_STOCK_TEXT_TERMS = [
-    "in stock", "available now", "available to buy", "item in stock",
-    "stock available", "stock: available", "instock", "in-stock",
-    "ready to ship", "ships today", "in stock now",
-    "only a few left", "low stock", "limited stock", "few remaining"
-]
 
-ADD_TO_CART_BUTTON_TERMS = [
-    "add to cart", "add to basket", "add to bag", "add to trolley",
-    "add to order", "buy now", "order now", "add to shopping bag",
-    "add to shopping cart", "purchase now", "get it now"
-]
+def schedule_verification(url, file_path, current_state, change):
+    if url in VERIFY_PENDING:
+        return False
+    VERIFY_PENDING.add(url)
+    due = time.monotonic() + VERIFY_DELAY_SECONDS
+    heapq.heappush(VERIFY_QUEUE, (due, next(SCHEDULE_SEQ), url, file_path, current_state, change))
+    return True
 
-PREORDER_PATTERN = re.compile('|'.join(re.escape(term) for term in PREORDER_TERMS), re.IGNORECASE)
-OUT_OF_STOCK_PATTERN = re.compile('|'.join(re.escape(term) for term in OUT_OF_STOCK_TERMS), re.IGNORECASE)
-IN_STOCK_TEXT_PATTERN = re.compile('|'.join(re.escape(term) for term in IN_STOCK_TEXT_TERMS), re.IGNORECASE)
-ADD_TO_CART_PATTERN = re.compile('|'.join(re.escape(term) for term in ADD_TO_CART_BUTTON_TERMS), re.IGNORECASE)
 
+def handle_verification_result(url, file_path, current_state, change, verified_state, direct_state, file_stats):
+    global CURRENT_FRANCHISE
+    VERIFY_PENDING.discard(url)
+    prefix = f" [{file_label(file_path)}] {_host_for_url(url)}:"
+    if not verified_state:
+        print(f"{prefix} Verification failed (no response)")
+        return 0
+
+    verified_status = verified_state.get("stock_status", "unknown")
+    if verified_status not in ("in", "preorder"):
+        print(f"{prefix} Verification failed ({verified_status.upper()})")
+        save_product(url, current_state["name"], False, verified_status)
+        return 0
+
+    direct_state[url]["in_stock"] = True
+    last_alerted = direct_state[url].get("last_alerted")
+    if not should_alert(last_alerted):
+        print(f"{prefix} {'PREORDER' if verified_status == 'preorder' else 'IN STOCK'} (no alert)")
+        return 0
+
+    file_stats['alerts'] += 1
+    is_preorder = verified_status == "preorder"
+    print(f"{prefix} {'PREORDER CONFIRMED!' if is_preorder else 'RESTOCK CONFIRMED!'}")
+    details = [d for d in (verified_state.get("details"), change.get("details")) if d]
+    img = next((d.image_url for d in details if d.image_url), None)
+    prc = next((d.price for d in details if d.price), None)
+    CURRENT_FRANCHISE = FILE_FRANCHISE[file_path]
+    send_alert(
+        change['name'], change["url"], _host_for_url(url),
+        is_preorder=is_preorder, is_new=False,
+        image_url=img, price=prc,
+        store_file=file_path
+    )
+    direct_state[url]["last_alerted"] = datetime.now(timezone.utc)
+    save_product(url, current_state["name"], True, verified_status)
+    mark_alerted(url)
+    return 1
 
-def is_element_hidden(element):
-    current = element
-    while current and hasattr(current, 'get'):
-        style = current.get('style', '')
-        if style and ('display:none' in style.replace(' ', '') or 'display: none' in style):
-            return True
-        classes = current.get('class', [])
-        class_str = ' '.join(classes).lower() if classes else ''
-        if 'hidden' in class_str or 'hide' in class_str or 'd-none' in class_str:
-            return True
-        current = current.parent
-    return False
+
+# =========================================================
+#  MAIN LOOP
+# =========================================================
+def handle_check_result(url, file_path, prev, current_state, change, direct_state, file_stats, first_run):
+    if not current_state:
+        return
+
+    is_dormant = is_dormant_file(file_path)
+    prefix = f" [{file_label(file_path)}] {_host_for_url(url)}:"
+    direct_state[url] = current_state
+    detailed_status = current_state.get("stock_status", "unknown").upper()
+
+    if change and not first_run:
+        if schedule_verification(url, file_path, current_state, change):
+            print(f"{prefix} Potential {change.get('type', 'change')} - verifying in {VERIFY_DELAY_SECONDS}s...")
+    else:
+        if is_dormant and detailed_status == "OUT":
+            pass
+        elif detailed_status in ("IN", "PREORDER") and prev and prev.get("in_stock"):
+            print(f"{prefix} {detailed_status} - ping already sent")
+        else:
+            print(f"{prefix} {detailed_status}")
+
+    prev_in_stock = prev.get("in_stock") if prev else None
+    if current_state["in_stock"] != prev_in_stock:
+        save_product(url, current_state["name"], current_state["in_stock"], current_state.get("stock_status", "unknown"))
 
 
-def has_active_add_to_cart_button(soup):
-    buttons = soup.find_all(['button', 'input'])
-    for btn in buttons:
-        btn_text = btn.get('value', '') if btn.name == 'input' else btn.get_text(strip=True)
-        if ADD_TO_CART_PATTERN.search(btn_text.lower()):
-            is_disabled = (
-                btn.get('disabled') is not None or
-                'disabled' in btn.get('class', []) or
-                btn.get('aria-disabled') == 'true'
+def update_product_counts(counts):
+    for file_path, count in counts.items():
+        if is_dormant_file(file_path) or not count:
+            continue
+        file_name = file_label(file_path)
+        for bucket in (HOURLY_STATS, DAILY_STATS):
+            if file_name not in bucket:
+                bucket[file_name] = {'fetched': 0, 'failed': 0, 'alerts': 0, 'products': count}
+            else:
+                bucket[file_name]['products'] = count
+
+
+def send_status_pings(direct_state):
+    global LAST_HOURLY_PING, LAST_DAILY_PING, HOURLY_STATS, DAILY_STATS, TOTAL_SCANS, DAILY_SCANS
+
+    now_utc = datetime.now(timezone.utc)
+    now_london = now_utc.astimezone(ZoneInfo("Europe/London"))
+    current_hour = now_london.strftime("%Y-%m-%d %H")
+    current_day = now_london.strftime("%Y-%m-%d")
+
+    # HOURLY PING
+    if HOURLY_WEBHOOK := os.getenv("HOURLYDATA"):
+        if now_london.minute < 15 and LAST_HOURLY_PING != current_hour:
+            prev_hour = now_london - timedelta(hours=1)
+            time_range = f"{prev_hour.strftime('%H:%M')} - {now_london.strftime('%H:%M')}"
+
+            file_breakdown = ""
+            total_hourly_alerts = 0
+            total_hourly_fetched = 0
+            total_hourly_failed = 0
+            for file_name, st in sorted(HOURLY_STATS.items()):
+                file_breakdown += f"  • **{file_name}**: {st['products']} products, {st['fetched']} fetched, {st['failed']} failed, {st['alerts']} alerts\n"
+                total_hourly_alerts += st['alerts']
+                total_hourly_fetched += st['fetched']
+                total_hourly_failed += st['failed']
+
+            failed_sites_text = ""
+            if HOURLY_FAILED_DETAILS:
+                failed_sites_text = f"\n**Failed Requests ({len(HOURLY_FAILED_DETAILS)} total)**\n"
+                for fail in HOURLY_FAILED_DETAILS:
+                    failed_sites_text += f"  • {fail['url']} | {fail['file']} | {fail['reason']}\n"
+
+            hourly_summary = (
+                f"🟢 **Hourly Bot Status** ({now_london.strftime('%d %B %Y %H:00 UK time')})\n"
+                f"**Period covered: {time_range}**\n\n"
+                f"**Overall Stats**\n"
+                f"• **Products tracked**: {len(direct_state)}\n"
+                f"• **Full cycle scans completed**: {TOTAL_SCANS}\n"
+                f"• **Total fetched**: {total_hourly_fetched}\n"
+                f"• **Total failed**: {total_hourly_failed}\n"
+                f"• **Alerts sent**: {total_hourly_alerts}\n"
+                f"• **Freshness (time since last check)**: {lag_summary(HOURLY_LAGS)}\n"
+                f"• **Fetch concurrency**: {concurrency_summary()}\n\n"
+                f"**Per-File Breakdown**\n{file_breakdown}"
+                f"{failed_sites_text}\n"
+                f"• **Bot status**: ✅ Active"
             )
-            is_hidden = is_element_hidden(btn)
-            if not is_disabled and not is_hidden:
-                return True
-    return False
+            if len(hourly_summary) > 1950:
+                hourly_summary = hourly_summary[:1950] + "\n..."
+            try:
+                resp = SESSION.post(HOURLY_WEBHOOK, json={"content": hourly_summary}, timeout=10)
+                if resp.status_code == 204:
+                    print(" Sent hourly status ping")
+                else:
+                    print(f" Hourly ping returned HTTP {resp.status_code}: {resp.text[:100]}")
+                LAST_HOURLY_PING = current_hour
+                save_ping_state("hourly", current_hour)
+                HOURLY_STATS = {k: {'fetched': 0, 'failed': 0, 'alerts': 0, 'products': v['products']} for k, v in HOURLY_STATS.items()}
+                HOURLY_FAILED_DETAILS.clear()
+                HOURLY_LAGS.clear()
+                TOTAL_SCANS = 0
+            except Exception as e:
+                print(f" Hourly ping failed: {e}")
+
+    # DAILY PING
+    if DAILY_WEBHOOK := os.getenv("DAILYDATA"):
+        if now_london.hour == 8 and now_london.minute < 15 and LAST_DAILY_PING != current_day:
+            yesterday = (now_london - timedelta(days=1)).strftime("%d %B %Y")
+
+            daily_file_breakdown = ""
+            daily_total_alerts = 0
+            daily_total_fetched = 0
+            daily_total_failed = 0
+            for file_name, st in sorted(DAILY_STATS.items()):
+                daily_file_breakdown += f"  • **{file_name}**: {st['products']} products, {st['fetched']} fetched, {st['failed']} failed, {st['alerts']} alerts\n"
+                daily_total_alerts += st['alerts']
+                daily_total_fetched += st['fetched']
+                daily_total_failed += st['failed']
+
+            daily_summary = (
+                f"📅 **Daily Bot Report – {yesterday}**\n\n"
+                f"**Overall Summary**\n"
+                f"• **Total products tracked**: {len(direct_state)}\n"
+                f"• **Full cycle scans completed**: {DAILY_SCANS}\n"
+                f"• **Total fetched**: {daily_total_fetched}\n"
+                f"• **Total failed**: {daily_total_failed}\n"
+                f"• **Total alerts sent**: {daily_total_alerts}\n\n"
+                f"**Per-File Breakdown**\n{daily_file_breakdown}\n"
+                f"• **Bot status**: ✅ Active\n"
+                f"• **Last full cycle**: {datetime.now(timezone.utc).strftime('%H:%M UTC')}"
+            )
+            if len(daily_summary) > 1950:
+                daily_summary = daily_summary[:1950] + "\n..."
+            try:
+                resp = SESSION.post(DAILY_WEBHOOK, json={"content": daily_summary}, timeout=10)
+                if resp.status_code == 204:
+                    print(" Sent daily status ping (8 AM UK time)")
+                else:
+                    print(f" Daily ping returned HTTP {resp.status_code}: {resp.text[:100]}")
+                LAST_DAILY_PING = current_day
+                save_ping_state("daily", current_day)
+                DAILY_STATS = {k: {'fetched': 0, 'failed': 0, 'alerts': 0, 'products': v['products']} for k, v in DAILY_STATS.items()}
+                DAILY_SCANS = 0
+            except Exception as e:
+                print(f" Daily ping failed: {e}")
 
 
-def find_main_product_area(soup):
-    wix_product = soup.find(attrs={'data-hook': 'product-page'})
-    if wix_product:
-        return wix_product
-    main_selectors = [
-        'product-essential', 'product-main', 'product-info-main',
-        'product-details-wrapper', 'product-single', 'pdp-main',
-        'product-form', 'product-info', 'product-summary'
-    ]
-    for selector in main_selectors:
-        area = soup.find(class_=re.compile(rf'\b{selector}\b', re.I))
-        if area:
-            return area
-    return None
+def main():
+    global USE_MOBILE_HEADERS, TOTAL_SCANS, DAILY_SCANS
+
+    print(" Starting Store Monitor Bot...")
+    print(f"   Time: {datetime.now(timezone.utc)}")
+    print(f"   Production mode: {IS_PRODUCTION}")
+    print(f"   Franchises: {', '.join(f['name'] for f in FRANCHISES)}")
+    print(f"   Playwright available: {PLAYWRIGHT_AVAILABLE}")
+    if PLAYWRIGHT_AVAILABLE:
+        print(f"   Playwright domains: {', '.join(sorted(PLAYWRIGHT_DOMAINS))}")
+
+    db_ok = init_db_pool()
+    if not db_ok:
+        print(" Database not configured. Continuing without database.")
+    else:
+        if not init_database():
+            print(" Database init failed. Continuing without database.")
+            db_ok = False
+
+    if db_ok:
+        sync_urls_to_db()
+        url_files_changed()
+        load_ping_state()
+        load_domain_platforms()
+        direct_state = load_direct_state()
+        start_write_behind()
+    else:
+        direct_state = {}
+    load_extraction_profiles()
+
+    # Let deploy restarts run the atexit hooks (pending DB writes are flushed there)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    first_run = len(direct_state) == 0
+    if first_run:
+        print(" First run - building initial database (no alerts)...")
+
+    for franchise in FRANCHISES:
+        direct_files = franchise.get("direct_files", [])
+        webhook_groups = len(franchise.get("webhook_secrets", []))
+        print(f"   {franchise['name']}: {len(direct_files)} direct files, {webhook_groups} webhook groups")
+    print(f"   Check interval: {CHECK_INTERVAL}s per URL ({DORMANT_CHECK_INTERVAL}s dormant)")
+
+    pw_executor = ThreadPoolExecutor(max_workers=max(1, PW_POOL_SIZE), thread_name_prefix="pw-lane")
+    verify_executor = ThreadPoolExecutor(max_workers=max(1, VERIFY_WORKERS), thread_name_prefix="verify")
+    lane_limits = {"requests": FETCH_LIMIT, "playwright": max(1, PW_POOL_SIZE)}
+    in_flight = {"requests": 0, "playwright": 0}
+    completions = queue.Queue()
+    file_stats = {fp: {'fetched': 0, 'failed': 0, 'alerts': 0, 'skipped': 0, 'unchanged': 0} for fp in FILE_FRANCHISE}
+
+    load_monitored_urls()
+    if db_ok:
+        start_url_listener()
+    install_dns_cache()
+    prewarm_connections()
+    start_keep_warm()
+    url_version, counts = refresh_schedule(time.monotonic())
+    update_product_counts(counts)
+    sweep_pending = sweep_keys()
+    sweep_start = time.time()
+    sweep_alerts = 0
+    sweep_lags = []
+    last_file_check = time.monotonic()
+    next_autotune = time.monotonic() + AUTOTUNE_INTERVAL
+
+    while True:
+        if time.monotonic() >= next_autotune:
+            next_autotune = time.monotonic() + AUTOTUNE_INTERVAL
+            autotune_concurrency()
+            lane_limits["requests"] = FETCH_LIMIT
+
+        # Text file edits: synced to the DB in dev (the NOTIFY trigger then updates us), read directly without a DB
+        if not IS_PRODUCTION and time.monotonic() - last_file_check >= 1:
+            last_file_check = time.monotonic()
+            if url_files_changed():
+                if db_ok:
+                    sync_urls_to_db()
+                else:
+                    load_monitored_urls()
+
+        if URL_LIST_VERSION != url_version:
+            url_version, counts = refresh_schedule(time.monotonic())
+            update_product_counts(counts)
+            sweep_pending &= SCHEDULED.keys()
+
+        if not SCHEDULED:
+            print(f" No URLs to monitor. Checking again in {CHECK_INTERVAL} seconds...")
+            time.sleep(CHECK_INTERVAL)
+            continue
+
+        # Confirmations go first and on their own lane, so they never wait behind the sweep
+        now = time.monotonic()
+        while VERIFY_QUEUE and VERIFY_QUEUE[0][0] <= now:
+            _, _, url, file_path, current_state, change = heapq.heappop(VERIFY_QUEUE)
+            args = (url, direct_state.get(url), file_stats[file_path], file_path, True, is_dormant_file(file_path))
+            future = verify_executor.submit(check_direct_product, *args)
+            future.add_done_callback(
+                lambda f, key=(url, file_path), pending=(current_state, change): completions.put((key, pending, "verify", f))
+            )
+
+        # Dispatch everything that is due, as far as each lane has room
+        lane_full = []
+        while SCHEDULE and SCHEDULE[0][0] <= now:
+            due, _, url, file_path = heapq.heappop(SCHEDULE)
+            key = (url, file_path)
+            if SCHEDULED.get(key) != due:
+                continue  # removed, or superseded by a newer entry
+            domain = _host_for_url(url)
+            lane = "playwright" if DOMAIN_HEALTH.get(domain, {}).get('strategy', 'requests') == 'playwright' else "requests"
+            if in_flight[lane] >= lane_limits[lane]:
+                lane_full.append((due, url, file_path))
+                continue
+            ready_at = take_domain_token(domain, now)
+            if ready_at:
+                # Throttled shop: its URL waits in the schedule, not in a worker thread
+                schedule_check(url, file_path, ready_at)
+                continue
+
+            record_lag(key, now, sweep_lags)
+            prev = direct_state.get(url)
+            args = (url, prev, file_stats[file_path], file_path, False, is_dormant_file(file_path))
+            if lane == "requests":
+                future = submit_fetch_job(domain, check_direct_product, *args)
+            else:
+                future = pw_executor.submit(check_direct_product, *args)
+            in_flight[lane] += 1
+            future.add_done_callback(lambda f, key=key, prev=prev, lane=lane: completions.put((key, prev, lane, f)))
+        for due, url, file_path in lane_full:
+            heapq.heappush(SCHEDULE, (due, next(SCHEDULE_SEQ), url, file_path))
+
+        next_due = [q[0][0] for q in (SCHEDULE, VERIFY_QUEUE) if q]
+        if lane_full or not next_due:
+            wait_s = 1.0
+        else:
+            wait_s = min(1.0, max(0.05, min(next_due) - time.monotonic()))
+        try:
+            key, context, lane, future = completions.get(timeout=wait_s)
+        except queue.Empty:
+            continue
+
+        url, file_path = key
+        try:
+            result_state, change = future.result()
+        except Exception as e:
+            print(f" Check error for {url}: {e}")
+            traceback.print_exc()
+            result_state, change = None, None
+
+        if lane == "verify":
+            current_state, pending_change = context
+            sweep_alerts += handle_verification_result(
+                url, file_path, current_state, pending_change, result_state, direct_state, file_stats[file_path]
+            )
+            continue
+
+        in_flight[lane] -= 1
+        LAST_CHECKED_AT[key] = time.monotonic()
+        handle_check_result(
+            url, file_path, context, result_state, change, direct_state, file_stats[file_path], first_run
+        )
+        if key in SCHEDULED:
+            schedule_check(url, file_path, next_check_due(file_path, time.monotonic()))
+
+        sweep_pending.discard(key)
+        if sweep_pending:
+            continue
+
+        # Every monitored URL has been checked once since the sweep started
+        sweep_time = round(time.time() - sweep_start, 1)
+        header_type = " Mobile" if USE_MOBILE_HEADERS else " Desktop"
+        TOTAL_SCANS += 1
+        DAILY_SCANS += 1
+
+        total_fetched = 0
+        total_failed = 0
+        total_unchanged = 0
+        for fp, st in file_stats.items():
+            total_fetched += st['fetched']
+            total_failed += st['failed']
+            total_unchanged += st['unchanged']
+            file_name = file_label(fp)
+            if not is_dormant_file(fp) and file_name in HOURLY_STATS:
+                for k in ('fetched', 'failed', 'alerts'):
+                    HOURLY_STATS[file_name][k] += st[k]
+                    DAILY_STATS[file_name][k] += st[k]
+            for k in st:
+                st[k] = 0
+
+        print(f"\n{'='*50}")
+        if first_run:
+            print(f" Initial scan complete! Tracking {len(direct_state)} products")
+            print("   Future changes will trigger Discord alerts.")
+            first_run = False
+        elif sweep_alerts > 0:
+            print(f" Sweep complete. {sweep_alerts} total alerts sent.")
+        else:
+            print(f" Sweep complete. No changes detected.")
+        print(f" Total: {total_fetched} fetched ({total_unchanged} unchanged), {total_failed} failed | {header_type} | Sweep: {sweep_time}s")
+        print(f" Freshness (time since last check): {lag_summary(sweep_lags)}")
+        print(f"{'='*50}\n")
+
+        flush_pending_writes()
+        save_extraction_profiles()
+        send_status_pings(direct_state)
+
+        USE_MOBILE_HEADERS = not USE_MOBILE_HEADERS
+        sweep_pending = sweep_keys()
+        sweep_start = time.time()
+        sweep_alerts = 0
+        sweep_lags = []
+
+
+if __name__ == "__main__":
+    main()
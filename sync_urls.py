@@ -1,6 +1,8 @@
 import os
 import psycopg2
 
+from store_monitor import MONITORED_URLS_NOTIFY_SQL
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 FRANCHISES = [
@@ -45,6 +47,8 @@ def sync():
             PRIMARY KEY (url, file_group)
         )
     """)
+    # Same trigger the bot installs (shared definition): every row change is pushed to the running bot via NOTIFY
+    cur.execute(MONITORED_URLS_NOTIFY_SQL)
     conn.commit()
 
     total_added = 0
@@ -86,7 +90,7 @@ def sync():
     conn.close()
 
     print(f"\nDone! {total_added} added, {total_removed} removed")
-    print("The running bot will pick up these changes on the next scan cycle.")
+    print("The running bot picks these changes up within a second (LISTEN/NOTIFY).")
 
 if __name__ == "__main__":
     print("Syncing URL files to database...\n")
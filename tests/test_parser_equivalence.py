@@ -0,0 +1,112 @@
+# Classification must not depend on which tree builder parsed the page.
+# html.parser's tree is the baseline; make_soup uses lxml (the default PARSER_BACKEND)
+# only for pages where lxml builds the same tree, and html.parser for the rest.
+import random
+
+import pytest
+from bs4 import BeautifulSoup
+
+import store_monitor as m
+
+FIXTURES = {
+    # Well-formed pages
+    "in_stock": ('<html><body><main><div class="product"><h1>Booster Box</h1>'
+                 '<button class="add-to-cart">Add to cart</button></div></main></body></html>', "in"),
+    "out_of_stock": ('<html><body><main><div class="product"><h1>Booster Box</h1>'
+                     '<p class="stock">Out of stock</p></div></main></body></html>', "out"),
+    "preorder": ('<html><body><main><div class="product"><h1>Booster Box</h1>'
+                 '<button class="add-to-cart">Pre-order now</button></div></main></body></html>', "preorder"),
+    "disabled_button": ('<html><body><main><div class="product"><h1>Booster Box</h1>'
+                        '<button class="add-to-cart" disabled>Add to cart</button>'
+                        '<p>Sold out</p></div></main></body></html>', "out"),
+    "hidden_button": ('<html><body><main><div class="product"><h1>Booster Box</h1>'
+                      '<button class="add-to-cart" style="display:none">Add to cart</button>'
+                      '<p>Sold out</p></div></main></body></html>', "out"),
+    # Malformed nesting
+    "div_inside_p": ('<html><body><main><div class="product"><h1>Booster Box</h1><p class="product-info">Great box'
+                     '<div class="actions"><button>Add to cart</button></div></p></div></main></body></html>', "in"),
+    "unclosed_divs": ('<html><body><main><div class="product"><h1>Booster Box</h1><div class="actions">'
+                      '<button class="add-to-cart">Add to cart</button></main></body></html>', "in"),
+    "stray_close_tags": ('<html><body><main><div class="product"></span><h1>Booster Box</h1></b>'
+                         '<p>Out of stock</p></div></div></main></body></html>', "out"),
+    "form_in_table": ('<html><body><main><div class="product"><h1>Booster Box</h1><table><tr>'
+                      '<form><td><button class="add-to-cart">Add to cart</button></td></form>'
+                      '</tr></table></div></main></body></html>', "in"),
+    "unclosed_li": ('<html><body><main><div class="product"><h1>Booster Box</h1><ul><li>Sealed'
+                    '<li>Out of stock</ul></div></main></body></html>', "out"),
+    "p_inside_p": ('<html><body><main><p class="product-info">Booster Box<p class="actions">'
+                   '<button class="add-to-cart">Add to cart</button></p></p></main></body></html>', "in"),
+    "li_inside_li": ('<html><body><main><ul class="product-info"><li>Booster Box<li>'
+                     '<button class="add-to-cart">Add to cart</button></li></li></ul></main></body></html>', "in"),
+    "picture_sources": ('<html><body><main><div class="product-info"><picture><source srcset="a.webp">'
+                        '<img src="a.jpg"></picture><h1>Booster Box</h1><p>Sold out</p></div></main></body></html>', "out"),
+}
+
+# Pages lxml alone would classify differently (it closes the <p> early, moving the button out)
+LXML_DIVERGENCES = {"div_inside_p", "p_inside_p"}
+
+
+def classify(raw_html, backend):
+    soup = BeautifulSoup(raw_html, backend)
+    return m.classify_stock_with_soup(soup, soup.get_text(), raw_html)
+
+
+def test_default_backend_is_lxml():
+    assert m.PARSER_BACKEND == "lxml"
+
+
+@pytest.mark.parametrize("name", sorted(FIXTURES))
+def test_make_soup_matches_baseline(name):
+    raw_html, expected = FIXTURES[name]
+    assert classify(raw_html, "html.parser") == expected
+    soup = m.make_soup(raw_html)
+    assert m.classify_stock_with_soup(soup, soup.get_text(), raw_html) == expected
+
+
+@pytest.mark.parametrize("name", sorted(FIXTURES))
+def test_gate_sends_divergent_pages_to_html_parser(name):
+    raw_html, expected = FIXTURES[name]
+    if name in LXML_DIVERGENCES:
+        assert classify(raw_html, "lxml") != expected
+        assert not m.lxml_builds_same_tree(raw_html)
+    elif m.lxml_builds_same_tree(raw_html):
+        assert classify(raw_html, "lxml") == expected
+
+
+def test_gate_accepts_well_formed_pages():
+    for name in ("in_stock", "out_of_stock", "preorder", "disabled_button", "hidden_button", "picture_sources"):
+        assert m.lxml_builds_same_tree(FIXTURES[name][0]), name
+
+
+TAGS = ["div", "p", "span", "form", "ul", "li", "table", "tr", "td", "section", "a", "b", "dl", "dd",
+        "h2", "select", "option", "label", "font", "pre", "product-form"]
+SNIPPETS = ["Add to cart", "Sold out", "Pre-order", "In stock", "x < y", "<!-- c -->", "<br>", "<hr>",
+            "<img src=x>", "<input type=hidden value=1>", "<picture><source srcset=x><img src=y></picture>",
+            "<script>var a='<div>';</script>", '<button class="add-to-cart">Add to cart</button>',
+            '<button class="add-to-cart" disabled>Add to cart</button>']
+CLASSES = ["product-info", "product-form", "related", "actions", "", ""]
+
+
+def random_markup(rng, depth=0):
+    out = []
+    for _ in range(rng.randint(1, 3)):
+        if depth < 5 and rng.random() < 0.6:
+            tag, css = rng.choice(TAGS), rng.choice(CLASSES)
+            attrs = f' class="{css}"' if css else ''
+            close = f'</{tag}>' if rng.random() < 0.9 else ''
+            out.append(f'<{tag}{attrs}>{random_markup(rng, depth + 1)}{close}')
+        else:
+            out.append(rng.choice(SNIPPETS))
+    return ''.join(out)
+
+
+def test_randomly_nested_pages_classify_like_html_parser():
+    pytest.importorskip("lxml")
+    rng = random.Random(20261017)
+    for _ in range(1500):
+        raw_html = f'<html><body><h1>Booster Box</h1>{random_markup(rng)}</body></html>'
+        baseline = BeautifulSoup(raw_html, "html.parser")
+        soup = m.make_soup(raw_html)
+        assert soup.get_text() == baseline.get_text(), raw_html
+        assert (m.classify_stock_with_soup(soup, soup.get_text(), raw_html)
+                == m.classify_stock_with_soup(baseline, baseline.get_text(), raw_html)), raw_html
@@ -0,0 +1,41 @@
+# Microdata availability must come from the page's own product, never a related-products carousel
+import store_monitor as m
+
+RELATED_IN_STOCK = (
+    '<div itemscope itemtype="https://schema.org/Product"><span itemprop="name">Other Box</span>'
+    '<div itemprop="offers" itemscope itemtype="https://schema.org/Offer">'
+    '<link itemprop="availability" href="https://schema.org/InStock"></div></div>'
+)
+
+
+def status(raw_html):
+    offer = m.extract_structured_offer(raw_html, "https://shop.example/products/box")
+    return offer and offer["stock_status"]
+
+
+def test_related_product_alone_is_ignored():
+    page = ('<html><body><div class="product-info"><h1>Booster Box</h1><p>Sold out</p></div>'
+            f'<div class="related">{RELATED_IN_STOCK}</div></body></html>')
+    assert status(page) is None
+
+
+def test_main_product_wins_over_related():
+    page = ('<html><body><div itemscope itemtype="http://schema.org/Product"><h1 itemprop="name">Booster Box</h1>'
+            '<div itemprop="offers" itemscope itemtype="http://schema.org/Offer">'
+            '<link itemprop="availability" href="http://schema.org/OutOfStock"></div></div>'
+            f'{RELATED_IN_STOCK}</body></html>')
+    assert status(page) == "out"
+
+
+def test_nested_related_product_is_ignored():
+    page = ('<html><body><div itemscope itemtype="http://schema.org/Product"><h1 itemprop="name">Booster Box</h1>'
+            '<meta itemprop="availability" content="https://schema.org/OutOfStock">'
+            f'<div itemprop="isRelatedTo">{RELATED_IN_STOCK}</div></div></body></html>')
+    assert status(page) == "out"
+
+
+def test_main_product_in_stock():
+    page = ('<html><body><div itemscope itemtype="http://schema.org/Product"><h1 itemprop="name">Booster Box</h1>'
+            '<div itemprop="offers" itemscope itemtype="http://schema.org/Offer">'
+            '<link itemprop="availability" href="http://schema.org/InStock"></div></div></body></html>')
+    assert status(page) == "in"